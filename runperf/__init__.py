@@ -31,7 +31,10 @@ import aexpect
 from . import exceptions, tests, result, utils
 from .machine import Controller
 from .version import __version__
-from .utils import CONTEXT
+from .utils import CONTEXT, history, image_cache
+
+# Journal of finished tests used by --resume
+CHECKPOINT_FILE = "RUNPERF_CHECKPOINTS.jsonl"
 
 PROG = 'run-perf'
 DESCRIPTION = ("A tool to execute the same tasks on pre-defined scenarios/"
@@ -125,6 +128,44 @@ def _parse_args():
                         "via 'dnf install -y '", nargs="+")
     parser.add_argument("--keep-tmp-files", action="store_true", help="Keep "
                         "the temporary files (local/remote)")
+    parser.add_argument("--duration-history", help="Path to the local "
+                        "history of tests durations used to estimate the "
+                        "ETA, to order tests and to fit the --time-budget; "
+                        "use '' to disable (%(default)s)",
+                        default=history.DEFAULT_PATH)
+    parser.add_argument("--test-order", help="Order of tests inside each "
+                        "profile based on the duration history; 'shortest' "
+                        "first or 'longest' first (tests without history "
+                        "are considered the longest) (%(default)s)",
+                        choices=("given", "shortest", "longest"),
+                        default="given")
+    parser.add_argument("--time-budget", help="Time budget of the whole "
+                        "execution (eg. 3600, 90m or 2h); optional tests "
+                        "(marked by '__OPTIONAL__: true' test param) that "
+                        "would not fit based on the duration history are "
+                        "skipped", type=history.parse_duration)
+    parser.add_argument("--image-cache", help="Controller-side guest image "
+                        "cache; 'download' the cloud image only once on the "
+                        "controller or 'prepare' (download and customize) it "
+                        "there (requires libguestfs tools on the "
+                        "controller) and copy it to all hosts (%(default)s)",
+                        choices=image_cache.MODES, default="off")
+    parser.add_argument("--image-cache-dir", help="Location of the "
+                        "content-addressed image cache (%(default)s)",
+                        default=image_cache.DEFAULT_PATH)
+    parser.add_argument("--plan-profiles", action="store_true", help="Reorder "
+                        "profiles to minimize the number of reboots and keep "
+                        "the persistent setup between consecutive profiles "
+                        "with identical persistent setup (skipping the "
+                        "revert-then-apply cycle)")
+    parser.add_argument("--dry-run", action="store_true", help="Only print "
+                        "the profiles plan and the estimated number of "
+                        "reboots without touching the machines")
+    parser.add_argument("--resume", action="store_true", help="Resume "
+                        "previously interrupted execution in --output "
+                        "skipping the tests already finished (according to "
+                        f"the {CHECKPOINT_FILE} journal); by default the "
+                        "existing results are removed")
     parser.add_argument("--output",
                         help="Force output directory (%(default)s)",
                         default=f"./result_{time.strftime('%Y%m%d_%H%M%S')}",
@@ -170,6 +211,29 @@ def logging_argparse(parser):
                         help="Increase the stderr verbosity level")
 
 
+def results_filter_argparse(parser):
+    """
+    Define result filtering argparse arguments
+    """
+    parser.add_argument("--include", nargs="+", action="extend", default=[],
+                        help="Only process results matching any of the "
+                        "PROFILE[/TEST[/ITERATION[/WORKFLOW]]] patterns "
+                        "(eg. 'TunedLibvirt/fio/read-*')")
+    parser.add_argument("--exclude", nargs="+", action="extend", default=[],
+                        help="Skip results matching any of the "
+                        "PROFILE[/TEST[/ITERATION[/WORKFLOW]]] patterns "
+                        "(eg. '*/uperf/*/latency')")
+
+
+def results_filter_setup(args):
+    """
+    Create results filter according to args (None when not filtering)
+    """
+    if not (args.include or args.exclude):
+        return None
+    return result.ResultsFilter(args.include, args.exclude)
+
+
 def logging_setup(args, fmt=None):
     """
     Setup logging according to args
@@ -244,6 +308,134 @@ def create_metadata(output_dir, args):
             output.write(f"\nmachine_url:{args.hosts[0][1]}")
 
 
+def load_checkpoints(output_dir):
+    """
+    Load finished tests from the CHECKPOINT_FILE journal
+
+    Only entries whose results still exist are reported.
+
+    :param output_dir: run-perf results dir
+    :return: list of checkpoint entries
+    """
+    path = os.path.join(output_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return []
+    checkpoints = []
+    with open(path, encoding="utf-8") as journal:
+        for line in journal:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Possibly interrupted write
+                continue
+            result = entry.pop("result", None)
+            if result and not os.path.exists(os.path.join(output_dir,
+                                                          result)):
+                continue
+            if entry not in checkpoints:
+                checkpoints.append(entry)
+    return checkpoints
+
+
+def write_checkpoint(output_dir, entry):
+    """
+    Append a finished test entry into the CHECKPOINT_FILE journal
+
+    :param output_dir: run-perf results dir
+    :param entry: checkpoint entry (dict), "result" item should point to
+                  the relative results path (or None when skipped)
+    """
+    with open(os.path.join(output_dir, CHECKPOINT_FILE), "a",
+              encoding="utf-8") as journal:
+        journal.write(json.dumps(entry) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def pending_profiles(args, checkpoints, log):
+    """
+    Get the profiles with their pending tests
+
+    :param args: parsed run-perf arguments
+    :param checkpoints: finished tests (see `load_checkpoints`)
+    :param log: logger to report the skipped tests
+    :return: list of (profile, profile_args, test_defs) where test_defs
+             are (test, extra, checkpoint, optional) tuples
+    """
+    default_set = list(tests.get(test, extra) for test, extra in args.tests)
+    pending = []
+    for profile_index, (profile, profile_args) in enumerate(args.profiles):
+        # Check whether this profile changes test set
+        test_defs = []
+        for i, (test, extra) in enumerate(
+                profile_test_defs(profile_args, default_set)):
+            optional = utils.human_to_bool(extra.get("__OPTIONAL__", "no"))
+            extra = {key: value for key, value in extra.items()
+                     if key != "__OPTIONAL__"}
+            # The same profile might be listed multiple times (eg. with
+            # different params), use its position to distinguish them
+            checkpoint = {"profile": profile, "profile_index": profile_index,
+                          "index": i, "test": test.name, "extra": extra}
+            if checkpoint in checkpoints:
+                log.info("Skipping %s@%s (%s) finished in previous "
+                         "execution", test.name, profile, i)
+            else:
+                test_defs.append((test, extra, checkpoint, optional))
+        if test_defs:
+            pending.append((profile, profile_args, test_defs))
+        else:
+            log.info("Skipping profile %s, all tests already finished",
+                     profile)
+    return pending
+
+
+def schedule_profiles(plan, pending, schedule, order="given"):
+    """
+    Add the planned items into the schedule and order the tests
+
+    :param plan: list of `runperf.machine.ProfilePlan` items
+    :param pending: pending profiles (see `pending_profiles`), the test
+                    defs are re-ordered in place
+    :param schedule: `runperf.utils.history.Schedule` instance
+    :param order: order of tests ("given", "shortest" or "longest" first)
+    """
+    schedule.add("setup", "", history.SETUP)
+    for step in plan:
+        profile, profile_args, test_defs = pending[step.index]
+        profile_key = history.profile_key(profile, profile_args)
+        schedule.add(("profile", step.index), profile_key, history.PROFILE)
+        estimates = [schedule.add(("test", step.index, checkpoint["index"]),
+                                  profile_key, test.name, extra, optional)
+                     for test, extra, checkpoint, optional in test_defs]
+        if order == "given":
+            continue
+        ordered = sorted(zip(estimates, test_defs),
+                         key=lambda _: float("inf") if _[0] is None else _[0],
+                         reverse=order == "longest")
+        test_defs[:] = [_[1] for _ in ordered]
+
+
+def format_plan(plan, reboots=None):
+    """
+    Format the profiles plan in human readable form
+
+    :param plan: list of `runperf.machine.ProfilePlan` items
+    :param reboots: estimated number of reboots to be reported
+    :return: human readable plan (str)
+    """
+    matrix = []
+    for i, step in enumerate(plan):
+        setup = sorted(set(key for setup in step.setups for key in setup))
+        matrix.append([str(i), step.profile, ",".join(setup) or "-",
+                       "keep persistent" if step.keep_persistent
+                       else "full"])
+    out = utils.tabular_output(matrix, ["ORDER", "PROFILE",
+                                        "PERSISTENT SETUP", "REVERT"])
+    if reboots is not None:
+        out += f"\nEstimated number of reboots: {reboots}"
+    return out
+
+
 def profile_test_defs(profile_args, default_set):
     """
     Process profile args and return suitable test set
@@ -276,8 +468,27 @@ def main():
     logging_setup(args)
 
     log = logging.getLogger("controller")
+    checkpoints = []
+    if os.path.exists(args.output) and args.resume:
+        checkpoints = load_checkpoints(args.output)
+    durations = history.DurationHistory(args.duration_history)
+    schedule = history.Schedule(durations,
+                                ",".join(_[1] for _ in args.hosts),
+                                args.time_budget)
+    if args.dry_run:
+        hosts = Controller(args, log)
+        pending = pending_profiles(args, checkpoints, log)
+        plan = hosts.plan_profiles([_[:2] for _ in pending],
+                                   args.plan_profiles)
+        schedule_profiles(plan, pending, schedule, args.test_order)
+        print(format_plan(plan, hosts.estimate_reboots(plan)) +
+              f"\nEstimated duration: {schedule.eta()}")
+        return 0
     # create results (or re-use if asked for)
-    if os.path.exists(args.output):
+    if os.path.exists(args.output) and args.resume:
+        CONTEXT.set_root(args.output, "Resuming previous results: "
+                         f"{args.output} ({len(checkpoints)} tests finished)")
+    elif os.path.exists(args.output):
         CONTEXT.set_root(args.output, "Removing previously existing results: "
                          f"{args.output}")
         shutil.rmtree(args.output)
@@ -287,29 +498,44 @@ def main():
         os.makedirs(args.output)
     except FileExistsError:
         pass
-    create_metadata(args.output, args)
+    if not os.path.exists(os.path.join(args.output, "RUNPERF_METADATA")):
+        create_metadata(args.output, args)
 
     hosts = None
     try:
         # Initialize all hosts
         hosts = Controller(args, log)
-        _test_defs = list(tests.get(test, extra) for test, extra in args.tests)
+        pending = pending_profiles(args, checkpoints, log)
+        plan = hosts.plan_profiles([_[:2] for _ in pending],
+                                   args.plan_profiles)
+        log.info("Profiles plan (estimated reboots %s):\n%s",
+                 hosts.estimate_reboots(plan), format_plan(plan))
+        schedule_profiles(plan, pending, schedule, args.test_order)
+        log.info("Estimated duration: %s", schedule.eta())
         # provision, fetch assets, ...
+        start = time.time()
         hosts.setup()
-        try:
-            CONTEXT.set(0, "__sysinfo_before__")
-            hosts.fetch_logs(CONTEXT.get())
-        except Exception as exc:    # pylint: disable=W0703
-            utils.record_failure(CONTEXT.get(), exc)
-        for profile, profile_args in args.profiles:
+        schedule.done("setup", "", history.SETUP, None, time.time() - start)
+        durations.save()
+        if not checkpoints:
+            try:
+                CONTEXT.set(0, "__sysinfo_before__")
+                hosts.fetch_logs(CONTEXT.get())
+            except Exception as exc:    # pylint: disable=W0703
+                utils.record_failure(CONTEXT.get(), exc)
+        for step in plan:
             CONTEXT.set_level(0)
-            # Check whether this profile changes test set
-            test_defs = profile_test_defs(profile_args, _test_defs)
+            profile, profile_args, test_defs = pending[step.index]
+            profile_key = history.profile_key(profile, profile_args)
+            profile_start = time.time()
+            tests_duration = 0
             # Applies profile and set `hosts.workers` to contain list of IP
             # addrs to be used in tests. It might retry on failure
             for i in range(args.retry_tests):
                 try:
-                    workers = hosts.apply_profile(profile, profile_args)
+                    with CONTEXT.phase("apply_profile", "controller",
+                                       profile=profile, attempt=i):
+                        workers = hosts.apply_profile(profile, profile_args)
                     break
                 except exceptions.StepFailed:
                     try:
@@ -319,14 +545,32 @@ def main():
             else:
                 log.error("ERROR applying profile %s, all tests will be "
                           "SKIPPED!", profile)
+                schedule.done(("profile", step.index))
+                for _, _, checkpoint, _ in test_defs:
+                    schedule.done(("test", step.index, checkpoint["index"]))
                 continue
 
             # Run all tests under current profile
             profile_path = os.path.join(args.output, hosts.profile)
-            for test, extra in test_defs:
+            for test, extra, checkpoint, optional in test_defs:
+                item = ("test", step.index, checkpoint["index"])
+                if optional and not schedule.fits(item):
+                    log.warning("SKIPPING optional test %s@%s, it does not "
+                                "fit into --time-budget", test.name,
+                                hosts.profile)
+                    schedule.done(item)
+                    continue
+                test_start = time.time()
                 for i in range(args.retry_tests):
                     try:
-                        hosts.run_test(test, workers, extra)
+                        path = hosts.run_test(test, workers, extra)
+                        if path:
+                            path = os.path.relpath(path, args.output)
+                        write_checkpoint(args.output,
+                                         dict(checkpoint, result=path))
+                        schedule.done(item, profile_key, test.name, extra,
+                                      time.time() - test_start)
+                        durations.save()
                         break
                     except (AssertionError, aexpect.ExpectError,
                             aexpect.ShellError, RuntimeError) as details:
@@ -338,6 +582,9 @@ def main():
                 else:
                     log.error("ERROR running %s@%s, test will be SKIPPED!",
                               test.test, hosts.profile)
+                    schedule.done(item)
+                tests_duration += time.time() - test_start
+                log.info("%s", schedule.eta())
             # Fetch logs
             try:
                 CONTEXT.set(1, "__sysinfo__")
@@ -348,7 +595,11 @@ def main():
             # Revert profile changes. In case manual reboot is required return
             # non-zero.
             CONTEXT.set_level(1, "Reverting profile")
-            hosts.revert_profile()
+            hosts.revert_profile(step.keep_persistent)
+            schedule.done(("profile", step.index), profile_key,
+                          history.PROFILE, None,
+                          time.time() - profile_start - tests_duration)
+            durations.save()
         # Remove unnecessary files
         hosts.cleanup()
         aexpect.kill_tail_threads()
@@ -440,6 +691,10 @@ class ComparePerf:
                             type=float, default=0)
         parser.add_argument("--n-out-of-results-n", help="How many builds "
                             "can fail to report PASS", type=int, default=2)
+        parser.add_argument("--primary-only", action="store_true",
+                            help="Only process primary results; "
+                            "non-primary results are ignored while parsing "
+                            "the results which speeds-up the processing.")
         parser.add_argument("--html", help="Create a single-file HTML report "
                             "in the provided path.")
         parser.add_argument("--html-with-charts", action="store_true",
@@ -449,6 +704,14 @@ class ComparePerf:
                             "size.", action="store_true")
         parser.add_argument("--xunit", help="Write XUnit/JUnit results to "
                             "specified file.")
+        parser.add_argument("--baseline-digest", help="Use reference "
+                            "builds stored by digest-perf in the specified "
+                            "file (inserted before the reference builds "
+                            "specified via positional arguments)")
+        parser.add_argument("--dump-state", help="Store the evaluated "
+                            "results into the specified file to allow "
+                            "re-rendering them by render-perf.")
+        results_filter_argparse(parser)
         logging_argparse(parser)
         args = parser.parse_args()
         logging_setup(args, "%(levelname)-5s| %(message)s")
@@ -471,8 +734,11 @@ class ComparePerf:
                                           models,
                                           args.results[0][0],
                                           args.results[0][1],
-                                          modifiers)
+                                          modifiers, args.primary_only,
+                                          results_filter_setup(args))
         skip_incorrect = not args.include_incorrect_results
+        if args.baseline_digest:
+            results.add_digest(result.load_digest(args.baseline_digest))
         for name, path in args.results[1:-1]:
             res = results.add_result_by_path(name, path,
                                              skip_incorrect=skip_incorrect)
@@ -481,10 +747,13 @@ class ComparePerf:
                                          args.results[-1][1], last=True,
                                          skip_incorrect=skip_incorrect)
         if args.xunit:
-            with open(args.xunit, 'wb') as xunit_fd:
-                xunit_fd.write(res.get_xunit())
+            with open(args.xunit, 'w', encoding="utf-8") as xunit_fd:
+                res.write_xunit(xunit_fd)
             self.log.info("XUnit results written to %s", args.xunit)
         res.evaluate()
+        if args.dump_state:
+            result.dump_state(results, args.dump_state)
+            self.log.info("Results state written to %s", args.dump_state)
         if args.html:
             # Import this only when needed to prevent optional deps
             from . import html_report  # pylint: disable=C0415
@@ -495,6 +764,376 @@ class ComparePerf:
         return res.finish()
 
 
+class RenderPerf:
+
+    """
+    Renders html/xunit results out of the compare-perf state file
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger("compare")
+
+    def __call__(self):
+        """
+        Renders the results
+        """
+        parser = ArgumentParser(prog="render-perf",
+                                description="Tool to render results stored "
+                                "by compare-perf --dump-state without "
+                                "re-processing them")
+        parser.add_argument("state", help="Path to the state file produced "
+                            "by compare-perf --dump-state",
+                            type=get_abs_path)
+        parser.add_argument("--html", help="Create a single-file HTML report "
+                            "in the provided path.")
+        parser.add_argument("--html-with-charts", action="store_true",
+                            help="Generate charts in the html results")
+        parser.add_argument("--html-small-file", help="Do not include the "
+                            "full environments and such to minimize the report"
+                            "size.", action="store_true")
+        parser.add_argument("--xunit", help="Write XUnit/JUnit results to "
+                            "specified file.")
+        logging_argparse(parser)
+        args = parser.parse_args()
+        logging_setup(args, "%(levelname)-5s| %(message)s")
+        results = result.load_state(self.log, args.state)
+        if not results:
+            raise ValueError(f"No results in {args.state}")
+        res = next(reversed(results))
+        if args.xunit:
+            with open(args.xunit, 'w', encoding="utf-8") as xunit_fd:
+                # compare-perf writes xunit before grouping the dst results
+                res.write_xunit(xunit_fd, include_grouped=False)
+            self.log.info("XUnit results written to %s", args.xunit)
+        if args.html:
+            # Import this only when needed to prevent optional deps
+            from . import html_report  # pylint: disable=C0415
+            self.log.debug("Generating HTML report: %s", args.html)
+            html_report.generate_report(args.html, results,
+                                        args.html_with_charts,
+                                        args.html_small_file)
+        return res.finish()
+
+
+class DigestPerf:
+
+    """
+    Creates digest of reference builds to be used by compare-perf
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger("compare")
+
+    def __call__(self):
+        """
+        Creates the digest
+        """
+        parser = ArgumentParser(prog="digest-perf",
+                                description="Tool to process reference "
+                                "run-perf results into a single digest "
+                                "file usable by compare-perf "
+                                "--baseline-digest")
+        parser.add_argument("results", help="Path to run-perf results; the "
+                            "first one is the source result (the same one "
+                            "has to be used in compare-perf), the remaining "
+                            "ones are the reference results.", nargs="+",
+                            type=ComparePerf._get_name_and_path)  # pylint: disable=W0212
+        parser.add_argument("--output", "-o", help="Path to store the digest "
+                            "to", required=True)
+        parser.add_argument("--include-incorrect-results", action="store_true",
+                            help="Include incorrect/partial results (by "
+                            "default we only include [0-9]* iterations)")
+        parser.add_argument("--tolerance", "-t", help="Acceptable tolerance "
+                            "(+-%(default)s%%)", default=5, type=float)
+        parser.add_argument("--stddev-tolerance", "-s", help="Acceptable "
+                            "standard deviation tolerance (+-%(default)s%%)",
+                            default=5, type=float)
+        parser.add_argument("--model-linear-regression", "-l", help="Use "
+                            "linear regression model for matching results",
+                            nargs='+', default=[])
+        parser.add_argument("--primary-only", action="store_true",
+                            help="Only process primary results")
+        results_filter_argparse(parser)
+        logging_argparse(parser)
+        args = parser.parse_args()
+        logging_setup(args, "%(levelname)-5s| %(message)s")
+        if len(args.results) < 2:
+            raise ValueError("Please specify the source and at least one "
+                             "reference result")
+        models = [result.ModelLinearRegression(args.tolerance,
+                                               args.stddev_tolerance, path)
+                  for path in args.model_linear_regression]
+        results = result.ResultsContainer(self.log, args.tolerance,
+                                          args.stddev_tolerance,
+                                          models,
+                                          args.results[0][0],
+                                          args.results[0][1],
+                                          [], args.primary_only,
+                                          results_filter_setup(args),
+                                          digest=True)
+        skip_incorrect = not args.include_incorrect_results
+        for name, path in args.results[1:]:
+            res = results.add_result_by_path(name, path,
+                                             skip_incorrect=skip_incorrect)
+            res.expand_grouped_results()
+        result.dump_digest(results, args.output)
+        self.log.info("Digest of %s reference results written to %s",
+                      len(results), args.output)
+        return 0
+
+
+class TracePerf:
+
+    """
+    Summarizes the operations trace recorded by run-perf
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger("trace")
+
+    @staticmethod
+    def load_trace(path):
+        """
+        Load the trace records
+
+        :param path: path to the trace file or run-perf results dir
+        :return: list of trace records (dicts)
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, utils.TRACE_FILE)
+        records = []
+        with open(path, encoding="utf-8") as trace_fd:
+            for line in trace_fd:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+        return records
+
+    @staticmethod
+    def summarize(records, top=10):
+        """
+        Generate the human readable summary of the trace records
+
+        :param records: list of trace records
+        :param top: number of the slowest operations to be reported
+        :return: summary (str)
+        """
+        out = [f"Top {top} slowest operations:"]
+        slowest = sorted(records, key=lambda _: _["duration"],
+                         reverse=True)[:top]
+        out.append(utils.tabular_output(
+            [[f"{_['duration']:.3f}", _["stage"], _["machine"], _["kind"],
+              _["status"], _["cmd"].splitlines()[0] if _["cmd"] else ""]
+             for _ in slowest],
+            ["DURATION", "STAGE", "MACHINE", "KIND", "STATUS", "COMMAND"]))
+        stages = {}
+        for record in records:
+            stage = stages.setdefault(record["stage"], [0, 0, 0])
+            stage[0] += 1
+            stage[1] += record["duration"]
+            stage[2] = max(stage[2], record["duration"])
+        out.append("")
+        out.append("Per-stage totals:")
+        out.append(utils.tabular_output(
+            [[stage, count, f"{total:.3f}", f"{longest:.3f}"]
+             for stage, (count, total, longest) in sorted(
+                 stages.items(), key=lambda _: _[1][1], reverse=True)],
+            ["STAGE", "OPERATIONS", "TOTAL", "LONGEST"]))
+        return "\n".join(out)
+
+    def __call__(self):
+        """
+        Reports the summary
+        """
+        parser = ArgumentParser(prog="trace-perf",
+                                description="Tool to summarize where "
+                                "run-perf spent the time based on the "
+                                f"{utils.TRACE_FILE} operations trace")
+        parser.add_argument("path", help="Path to run-perf results (or "
+                            "directly to the trace file)")
+        parser.add_argument("--top", "-n", help="Number of the slowest "
+                            "operations to report (%(default)s)", default=10,
+                            type=int)
+        logging_argparse(parser)
+        args = parser.parse_args()
+        logging_setup(args, "%(levelname)-5s| %(message)s")
+        records = self.load_trace(args.path)
+        if not records:
+            self.log.error("No trace records found in %s", args.path)
+            return 1
+        print(self.summarize(records, args.top))
+        return 0
+
+
+class TimelinePerf:
+
+    """
+    Renders the per-phase timeline recorded by run-perf and compares it
+    across builds
+    """
+
+    def __init__(self):
+        self.log = logging.getLogger("timeline")
+
+    @staticmethod
+    def load_timeline(path):
+        """
+        Load the timeline records sorted by their start
+
+        :param path: path to the timeline file or run-perf results dir
+        :return: list of timeline records (dicts)
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, utils.TIMELINE_FILE)
+        records = []
+        with open(path, encoding="utf-8") as timeline_fd:
+            for line in timeline_fd:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+        return sorted(records, key=lambda _: (_["start"], -_["end"]))
+
+    @staticmethod
+    def phase_name(record):
+        """
+        Human readable name of the phase (without attempt/host)
+
+        :param record: timeline record
+        :return: phase name (eg. "test_run Localhost/uperf")
+        """
+        name = record["phase"]
+        where = "/".join(str(record[_]) for _ in ("profile", "test")
+                         if _ in record)
+        if where:
+            name += f" {where}"
+        if "reason" in record:
+            name += f" ({record['reason']})"
+        return name
+
+    @classmethod
+    def compare(cls, timelines):
+        """
+        Sum the durations of each phase per build
+
+        :param timelines: list of (name, records) tuples
+        :return: list of [host, phase, [duration_per_build]] where duration
+                 is None when the phase is missing in the build
+        """
+        phases = collections.OrderedDict()
+        for i, (_, records) in enumerate(timelines):
+            for record in records:
+                key = (record["host"], cls.phase_name(record))
+                durations = phases.setdefault(key, [None] * len(timelines))
+                durations[i] = ((durations[i] or 0) +
+                                record["end"] - record["start"])
+        return [[host, phase, durations]
+                for (host, phase), durations in phases.items()]
+
+    @classmethod
+    def gantt(cls, records):
+        """
+        Process the timeline records into Gantt chart rows
+
+        :param records: list of timeline records
+        :return: tuple(total_duration, [[offset, duration, host, phase,
+                 status], ...])
+        """
+        if not records:
+            return 0, []
+        start = min(_["start"] for _ in records)
+        rows = []
+        for record in records:
+            phase = cls.phase_name(record)
+            if record.get("attempt"):
+                phase += f" #{record['attempt']}"
+            rows.append([record["start"] - start,
+                         record["end"] - record["start"], record["host"],
+                         phase, record["status"]])
+        return max(_["end"] for _ in records) - start, rows
+
+    @classmethod
+    def render_text(cls, timelines, width=60):
+        """
+        Generate the text timeline (and comparison) of the builds
+
+        :param timelines: list of (name, records) tuples
+        :param width: width of the Gantt bars
+        :return: human readable timeline (str)
+        """
+        out = []
+        for name, records in timelines:
+            duration, rows = cls.gantt(records)
+            if not rows:
+                out.append(f"Timeline of {name}: no phases recorded")
+                out.append("")
+                continue
+            scale = width / duration if duration else 0
+            out.append(f"Timeline of {name} ({duration:.1f}s):")
+            matrix = []
+            for offset, length, host, phase, status in rows:
+                bar_start = min(int(offset * scale), width - 1)
+                bar_len = min(max(int(round(length * scale)), 1),
+                              width - bar_start)
+                char = "#" if status == "ok" else "!"
+                bar = " " * bar_start + char * bar_len
+                matrix.append([f"{offset:.1f}", f"{length:.1f}", host, phase,
+                               f"|{bar:{width}}|"])
+            out.append(utils.tabular_output(matrix, ["OFFSET", "DURATION",
+                                                     "HOST", "PHASE", ""]))
+            out.append("")
+        if len(timelines) > 1:
+            out.append("Phase durations comparison:")
+            matrix = []
+            for host, phase, durations in cls.compare(timelines):
+                row = [host, phase]
+                row.extend("-" if _ is None else f"{_:.1f}"
+                           for _ in durations)
+                if durations[0] and durations[-1] is not None:
+                    diff = (durations[-1] / durations[0] - 1) * 100
+                    row.append(f"{diff:+.1f}%")
+                else:
+                    row.append("")
+                matrix.append(row)
+            out.append(utils.tabular_output(
+                matrix, ["HOST", "PHASE"] + [_[0] for _ in timelines] +
+                ["DIFF"]))
+        return "\n".join(out).rstrip()
+
+    def __call__(self):
+        """
+        Reports the timeline(s)
+        """
+        parser = ArgumentParser(prog="timeline-perf",
+                                description="Tool to render the per-phase "
+                                "timeline of run-perf results and to compare "
+                                "the phase durations across builds")
+        parser.add_argument("results", help="Path to run-perf results (or "
+                            f"directly to the {utils.TIMELINE_FILE}), "
+                            "optionally prefixed by 'name:'; when multiple "
+                            "results are specified the durations are "
+                            "compared to the first one.", nargs='+',
+                            type=ComparePerf._get_name_and_path)  # pylint: disable=W0212
+        parser.add_argument("--html", help="Create a single-file HTML "
+                            "timeline in the provided path.")
+        parser.add_argument("--width", help="Width of the text timeline "
+                            "bars (%(default)s)", default=60, type=int)
+        logging_argparse(parser)
+        args = parser.parse_args()
+        logging_setup(args, "%(levelname)-5s| %(message)s")
+        timelines = [(name, self.load_timeline(path))
+                     for name, path in args.results]
+        print(self.render_text(timelines, args.width))
+        if args.html:
+            # Import this only when needed to prevent optional deps
+            from . import html_report  # pylint: disable=C0415
+            self.log.debug("Generating HTML timeline: %s", args.html)
+            html_report.generate_timeline_report(
+                args.html, [(name, self.gantt(records))
+                            for name, records in timelines],
+                self.compare(timelines))
+        return 0
+
+
 class DiffPerf:
 
     """
@@ -543,6 +1182,7 @@ class DiffPerf:
                             help="Coefficient used to flatten the probability "
                             "curve based on the standard deviation. "
                             "(%(default)s)", default=1)
+        results_filter_argparse(parser)
         logging_argparse(parser)
         args = parser.parse_args()
         logging_setup(args, "%(levelname)-5s| %(message)s")
@@ -553,7 +1193,8 @@ class DiffPerf:
         if (len(groups) < 2):
             raise RuntimeError("Please specify at least one src and two dst ("
                                "or group of dst) results")
-        return result.closest_result(src, groups, args.flatten_coefficient)
+        return result.closest_result(src, groups, args.flatten_coefficient,
+                                     results_filter_setup(args))
 
 
 class AnalyzePerf:
@@ -607,9 +1248,11 @@ class AnalyzePerf:
         parser.add_argument("-t", "--tolerance", help="Tolerance (-x,+x) used "
                             "by models, by default (%(default)s)",
                             default=4, type=float)
+        results_filter_argparse(parser)
         logging_argparse(parser)
         args = parser.parse_args()
         logging_setup(args, "%(levelname)-5s| %(message)s")
+        results_filter = results_filter_setup(args)
 
         primary = set()
         storage = {}
@@ -617,7 +1260,8 @@ class AnalyzePerf:
         for path in args.results:
             results_name = os.path.basename(path)
             result_names.add(results_name)
-            for test, score, prim, _ in result.iter_results(path, True):
+            for test, score, prim, _ in result.iter_results(
+                    path, True, results_filter=results_filter):
                 if prim:
                     primary.add(test)
                 if test not in storage:
@@ -688,9 +1332,11 @@ class StripPerf:
                             action="store_true")
         parser.add_argument("-s", "--attach-sysinfo", help="Copy the assets "
                             "of failed the results", action="store_true")
+        results_filter_argparse(parser)
         logging_argparse(parser)
         args = parser.parse_args()
         logging_setup(args, "%(levelname)-5s| %(message)s")
+        results_filter = results_filter_setup(args)
         os.makedirs(args.dst, exist_ok=True)
         # Main metadata
         metadata_path = os.path.join(args.src, "RUNPERF_METADATA")
@@ -699,11 +1345,14 @@ class StripPerf:
                         os.path.join(args.dst, "RUNPERF_METADATA"))
         # Results
         for src_json in result.iter_results_jsons(args.src,
-                                                  not args.include_incorrect):
-            dst_path = self.process_result_json(src_json, args.dst)
+                                                  not args.include_incorrect,
+                                                  results_filter):
+            dst_path = self.process_result_json(src_json, args.dst,
+                                                results_filter)
             self.process_result_metadata(os.path.dirname(src_json), dst_path)
         # Exceptions
-        for level, src_path in result.iter_results_errors(args.src):
+        for level, src_path in result.iter_results_errors(args.src,
+                                                          results_filter):
             split_path = src_path.split(os.sep)[-(level + 1):]
             result_id = "/".join(split_path)
             shutil.copytree(src_path, os.path.join(args.dst, result_id),
@@ -713,7 +1362,7 @@ class StripPerf:
             self.process_sysinfo(args.src, args.dst)
 
     @staticmethod
-    def process_result_json(src_path, dst_base):
+    def process_result_json(src_path, dst_base, results_filter=None):
         """Gather result.json data"""
         def get_workflow_type_data(src_workflow):
             out = []
@@ -740,6 +1389,11 @@ class StripPerf:
             for workflow in ('throughput', 'latency'):
                 if workflow not in src_iteration_data:
                     continue
+                if (results_filter is not None and
+                        not results_filter.is_selected(
+                            *profile_test, iteration["iteration_name"],
+                            workflow)):
+                    continue
                 iteration_data[workflow] = {}
                 workflow_items = src_iteration_data[workflow].items()
                 for workflow_type, results in workflow_items:
@@ -750,6 +1404,7 @@ class StripPerf:
         with open(src_path, 'r', encoding="utf-8") as src_fd:
             src = json.load(src_fd)
         result_id = os.sep.join(src_path.split(os.sep)[-4:])
+        profile_test = src_path.split(os.sep)[-4:-2]
         res = []
         for src_iteration in src:
             if "iteration_name" not in src_iteration:
@@ -758,6 +1413,10 @@ class StripPerf:
                 continue
             if "parameters" not in src_iteration["iteration_data"]:
                 continue
+            if (results_filter is not None and
+                    not results_filter.is_selected(
+                        *profile_test, src_iteration["iteration_name"])):
+                continue
             iteration = get_iteration_data(src_iteration)
             res.append(iteration)
         dst_json = os.path.join(dst_base, result_id)
@@ -37,3 +37,17 @@ class StepFailed(RuntimeError):
     """
     Exception used to mark failed steps
     """
+
+
+class FanOutError(RuntimeError):
+
+    """
+    Exception used when some of the concurrent per-machine tasks failed
+    """
+
+    def __init__(self, errors, results):
+        details = ", ".join(f"{machine}: {exc!r}"
+                            for machine, exc in errors.items())
+        super().__init__(f"Failed on {len(errors)} machine(s): {details}")
+        self.errors = errors
+        self.results = results
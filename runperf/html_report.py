@@ -553,6 +553,9 @@ def generate_report(path, results, with_charts=False, small_file=False):
 
     def get_build_param_diff(all_src_params, record):
         """Generate param diffs"""
+        if record.params is None:
+            # Params are not available (eg. results from digest)
+            return {}, ""
         params_raw = record.params.copy()
         params_diff = []
         src_params = all_src_params.get(record.name, {})
@@ -690,3 +693,47 @@ def generate_report(path, results, with_charts=False, small_file=False):
     template = env.get_template("report_template.html")
     with open(path, 'w', encoding="utf-8") as output:
         output.write(template.render(values))
+
+
+def generate_timeline_report(path, timelines, comparison):
+    """
+    Generate html Gantt-style timeline report
+
+    :param path: Path to the output html file
+    :param timelines: list of (name, (duration, gantt_rows)) tuples as
+                      produced by `runperf.TimelinePerf.gantt`
+    :param comparison: per-phase durations as produced by
+                       `runperf.TimelinePerf.compare`
+    """
+    colors = ["#4e79a7", "#59a14f", "#edc948", "#b07aa1", "#76b7b2",
+              "#ff9da7", "#9c755f", "#bab0ac"]
+    hosts = {}
+    builds = []
+    for name, (duration, rows) in timelines:
+        phases = []
+        for offset, length, host, phase, status in rows:
+            if host not in hosts:
+                hosts[host] = colors[len(hosts) % len(colors)]
+            phases.append({"host": host, "phase": phase, "status": status,
+                           "offset": offset, "duration": length,
+                           "left": offset / duration * 100 if duration else 0,
+                           "width": length / duration * 100 if duration
+                           else 100,
+                           "color": hosts[host] if status == "ok"
+                           else "#e15759"})
+        builds.append({"name": name, "duration": duration,
+                       "phases": phases})
+    phases = []
+    for host, phase, durations in comparison:
+        if durations[0] and durations[-1] is not None:
+            diff = (durations[-1] / durations[0] - 1) * 100
+        else:
+            diff = None
+        phases.append({"host": host, "phase": phase, "durations": durations,
+                       "diff": diff})
+    values = {"builds": builds, "comparison": phases, "hosts": hosts}
+    loader = jinja2.PackageLoader("runperf", "assets/html_report")
+    env = jinja2.Environment(loader=loader, autoescape=True)
+    template = env.get_template("timeline_template.html")
+    with open(path, 'w', encoding="utf-8") as output:
+        output.write(template.render(values))
@@ -13,11 +13,13 @@
 # Copyright: Red Hat Inc. 2018
 # Author: Lukas Doktor <ldoktor@redhat.com>
 
+import collections
 import contextlib
 import json
 import logging
 import os
 import re
+import threading
 import time
 import uuid
 
@@ -26,52 +28,69 @@ import yaml
 
 from . import exceptions, profiles, utils
 from .utils import MutableShellSession as ShellSession
+from .utils import image_cache
 from .utils import CONTEXT
 
 
 LOG = logging.getLogger(__name__)
+# : Planned profile, see Controller.plan_profiles
+ProfilePlan = collections.namedtuple("ProfilePlan", ["index", "profile",
+                                                     "extra", "setups",
+                                                     "keep_persistent"])
+
 # : Path to yaml files with host configurations
 HOSTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'hosts'))
 # : Minimal set of required keys for host definition
 HOST_KEYS = {'hugepage_kb', 'numa_nodes', 'host_cpus',
              'guest_cpus', 'guest_mem_m', 'arch'}
+# : Command to report the current boot ID (changes on each boot)
+BOOT_ID_CMD = "cat /proc/sys/kernel/random/boot_id"
+# : Command to reboot the machine detached from the current session (so
+# : closing the session can not interrupt it)
+REBOOT_CMD = ("systemd-run --on-active=1 reboot || (nohup sh -c 'sleep 1; "
+              "reboot' >/dev/null 2>&1 &)")
+# : Maximum delay between readiness checks while waiting for boot
+BOOT_POLL_MAX_STEP = 15
+# : "systemctl is-system-running" states of a still booting system
+SYSTEM_BOOTING_STATES = ("initializing", "starting")
+# : Marker separating per-guest outputs of LibvirtGuest.discover_addrs
+ADDR_MARKER = "__RUNPERF_GUEST__ "
+# : Maximum delay between guest address discovery rounds
+ADDR_POLL_MAX_STEP = 10
 
 
 def get_distro_info(machine):
     """Various basic sysinfo"""
     out = {"general": f"Name:{machine.name}\nDistro:{machine.distro}"}
-    with machine.get_session_cont() as session:
-        # Get basic kernel info
-        kernel = session.cmd("uname -r; uname -v; uname -m; uname -o",
-                             print_func='mute', ignore_all_errors=True)
-        kernel_ver = kernel.split('\n', 1)[0].strip()
-        # Do not include kernel_version in the cmdline
-        kernel_cmd = session.cmd("cat /proc/cmdline", print_func='mute',
-                                 ignore_all_errors=True)
-        out["kernel_raw"] = kernel + '\n' + kernel_cmd
-        kernel_cmd = kernel_cmd.replace(kernel_ver, "FILTERED")
-        # Sort the kernel_cmdline parts as the order does not matter
-        out["kernel"] = (kernel + '\n' +
-                         " ".join(sorted(_.strip()
-                                         for _ in kernel_cmd.split(' ')
-                                         if _.strip())))
-        out["mitigations"] = session.cmd("grep --color=never . "
-                                         "/sys/devices/system/cpu/"
-                                         "vulnerabilities/*",
-                                         print_func='mute',
-                                         ignore_all_errors=True)
-        if session.cmd_status("which rpm", print_func='mute') == 0:
-            out["rpm"] = session.cmd("rpm -qa | sort", print_func='mute',
-                                     ignore_all_errors=True)
-        out["systemctl"] = session.cmd("systemctl | "
-                                       "grep -v 'session-[0-9]*\\.scope'"
-                                       " | tr -s ' ' | uniq | sort",
-                                       print_func='mute',
-                                       ignore_all_errors=True)
-        out["runperf_sysinfo"] = session.cmd("cat /var/lib/runperf/sysinfo "
-                                             "| uniq | sort",
-                                             print_func='mute',
-                                             ignore_all_errors=True)
+    cmds = ["uname -r; uname -v; uname -m; uname -o",
+            "cat /proc/cmdline",
+            "grep --color=never . /sys/devices/system/cpu/vulnerabilities/*",
+            "which rpm",
+            "rpm -qa | sort",
+            "systemctl | grep -v 'session-[0-9]*\\.scope' | tr -s ' ' | "
+            "uniq | sort",
+            "cat /var/lib/runperf/sysinfo | uniq | sort"]
+    with machine.get_session_cont(reuse=True) as session:
+        (kernel, kernel_cmd, mitigations, which_rpm, rpm, systemctl,
+         sysinfo) = utils.batch_cmd_status_output(session, cmds,
+                                                  ignore_all_errors=True)
+    # Get basic kernel info
+    kernel = kernel[1]
+    kernel_ver = kernel.split('\n', 1)[0].strip()
+    # Do not include kernel_version in the cmdline
+    kernel_cmd = kernel_cmd[1]
+    out["kernel_raw"] = kernel + '\n' + kernel_cmd
+    kernel_cmd = kernel_cmd.replace(kernel_ver, "FILTERED")
+    # Sort the kernel_cmdline parts as the order does not matter
+    out["kernel"] = (kernel + '\n' +
+                     " ".join(sorted(_.strip()
+                                     for _ in kernel_cmd.split(' ')
+                                     if _.strip())))
+    out["mitigations"] = mitigations[1]
+    if which_rpm[0] == 0:
+        out["rpm"] = rpm[1]
+    out["systemctl"] = systemctl[1]
+    out["runperf_sysinfo"] = sysinfo[1]
     return out
 
 
@@ -89,6 +108,11 @@ class BaseMachine:
         self.log_fetcher = utils.LogFetcher()
         # For the first time collect everything
         self.log_fetcher.params["since"] = 0
+        # Idle sessions per ssh command available to get_session_cont
+        self._session_pool = {}
+        self._session_pool_lock = threading.Lock()
+        # (key, info) of the last get_info call (see _get_info_cache_key)
+        self._info_cache = None
 
     def __str__(self):
         return self.name
@@ -193,23 +217,78 @@ class BaseMachine:
         raise RuntimeError("Timeout while getting ssh session "
                            f"({self.get_ssh_cmd(hop)})")
 
+    def _get_pooled_session(self, key):
+        """
+        Get an idle session from the pool (or None)
+
+        :param key: session pool key (ssh command)
+        """
+        with self._session_pool_lock:
+            sessions = self._session_pool.get(key)
+            while sessions:
+                session = sessions.pop()
+                if session.is_alive():
+                    return session
+                session.close()
+        return None
+
+    def _return_pooled_session(self, key, session):
+        """
+        Return the session to the pool (or close it when not alive)
+
+        :param key: session pool key (ssh command)
+        :param session: session to be returned
+        """
+        if not session.is_alive():
+            session.close()
+            return
+        with self._session_pool_lock:
+            self._session_pool.setdefault(key, []).append(session)
+
+    def close_sessions(self):
+        """
+        Close all idle pooled sessions (eg. before reboot)
+        """
+        with self._session_pool_lock:
+            pool = self._session_pool
+            self._session_pool = {}
+        for sessions in pool.values():
+            for session in sessions:
+                session.close()
+
     @contextlib.contextmanager
-    def get_session_cont(self, timeout=60, hop=None):
+    def get_session_cont(self, timeout=60, hop=None, reuse=False):
         """
         Get session to this machine suitable for "with" usage
 
+        The session is borrowed from the pool of idle sessions (or created
+        when no idle session is available) and it's exclusively used by
+        the current thread. With ``reuse=True`` it's returned back to the
+        pool afterwards, unless the execution was interrupted by an
+        exception, otherwise it's closed.
+
         :param timeout: timeout
         :param hop: ssh proxy machine
         :type hop: BaseMachine
+        :param reuse: whether to return the session back to the pool; only
+                      use it when the shell state (cwd, environment,
+                      background jobs, ...) is not modified as it would
+                      affect the next user of the session
         :return: aexpect shell session
         """
-        session = None
-        try:
+        key = self.get_ssh_cmd(hop)
+        session = self._get_pooled_session(key)
+        if session is None:
             session = self.get_session(timeout, hop)
+        try:
             yield session
-        finally:
-            if session:
-                session.close()
+        except BaseException:
+            session.close()
+            raise
+        if reuse:
+            self._return_pooled_session(key, session)
+        else:
+            session.close()
 
     def copy_from(self, src, dst):
         """
@@ -222,7 +301,8 @@ class BaseMachine:
                "-o ControlPath='/var/tmp/%r@%h-%p' -o ControlPersist=60" +
                " -o BatchMode=yes", f"root@{self.get_addr()}:{src}",
                dst]
-        utils.check_output(cmd)
+        with CONTEXT.trace("copy_from", self.name, f"{src} -> {dst}"):
+            utils.check_output(cmd)
 
     def copy_to(self, src, dst):
         """
@@ -234,17 +314,180 @@ class BaseMachine:
                "-o UserKnownHostsFile=/dev/null -o ControlMaster=auto " +
                "-o ControlPath='/var/tmp/%r@%h-%p' -o ControlPersist=60" +
                " -o BatchMode=yes", src, f"root@{self.get_addr()}:{dst}"]
-        utils.check_output(cmd)
+        with CONTEXT.trace("copy_to", self.name, f"{src} -> {dst}"):
+            utils.check_output(cmd)
+
+    def write_file(self, path, content, append=False, session=None,
+                   hop=None, timeout=600):
+        """
+        Write/append content to a file on this machine in a single operation
+
+        Small content is written via plain heredoc, bigger content is
+        streamed as compressed base64 stream with integrity check (see
+        :func:`runperf.utils.shell_write_content_bulk_cmd`).
+
+        :param path: destination path
+        :param content: content to be written
+        :param append: append instead of overwrite
+        :param session: session to be used (new session is acquired when
+                        not specified)
+        :param hop: ssh proxy machine (only used without session)
+        :param timeout: command timeout
+        """
+        if len(content) < 4096:
+            cmd = utils.shell_write_content_cmd(path, content, append)
+            kwargs = {}
+        else:
+            cmd = utils.shell_write_content_bulk_cmd(path, content, append)
+            kwargs = {"print_func": "mute"}
+        if session is not None:
+            return session.cmd(cmd, timeout=timeout, **kwargs)
+        with self.get_session_cont(hop=hop) as session:
+            return session.cmd(cmd, timeout=timeout, **kwargs)
+
+    def get_boot_id(self, hop=None):
+        """
+        Report the current boot ID (changes on each boot)
+
+        :param hop: ssh proxy machine
+        :return: boot ID or empty string when not available
+        """
+        with self.get_session_cont(hop=hop, reuse=True) as session:
+            return session.cmd(BOOT_ID_CMD, print_func='mute',
+                               ignore_all_errors=True).strip()
+
+    def try_get_boot_id(self, timeout=10, hop=None):
+        """
+        Report the current boot ID without waiting for the machine
+
+        Always uses a fresh session as the pooled ones might belong to
+        the previous boot.
+
+        :param timeout: timeout to get the session
+        :param hop: ssh proxy machine
+        :return: boot ID, empty string when not available or None when
+                 the machine is not reachable
+        """
+        try:
+            session = self.get_session(timeout, hop)
+        except RuntimeError as details:
+            self.log.debug("Machine not reachable: %s", details)
+            return None
+        try:
+            return session.cmd(BOOT_ID_CMD, print_func='mute',
+                               ignore_all_errors=True).strip()
+        finally:
+            session.close()
+
+    def _get_system_state(self, hop=None):
+        """
+        Report systemd state unless the system is still booting
+
+        :param hop: ssh proxy machine
+        :return: state or None when still booting
+        """
+        try:
+            with self.get_session_cont(hop=hop, reuse=True) as session:
+                state = session.cmd_output("systemctl is-system-running",
+                                           print_func='mute').strip()
+        except (RuntimeError, aexpect.ExpectError, aexpect.ShellError):
+            return None
+        if not state or state in SYSTEM_BOOTING_STATES:
+            return None
+        return state
+
+    def wait_for_boot(self, old_boot_id=None, timeout=360, hop=None,
+                      system_running=False, fallback_delay=30):
+        """
+        Wait until the machine (re)boots and is reachable
+
+        The machine is polled with backoff until it is reachable via ssh
+        and reports a boot ID different from ``old_boot_id``, therefore
+        fast-booting machines are not delayed and the old, still shutting
+        down system is never mistaken for the new one.
+
+        :param old_boot_id: boot ID before the reboot
+        :param timeout: overall timeout
+        :param hop: ssh proxy machine
+        :param system_running: also wait until systemd finishes booting
+                               (``systemctl is-system-running``)
+        :param fallback_delay: delay to let the old system go down when
+                               the ``old_boot_id`` is not available
+        :return: the new boot ID (might be empty when not available)
+        :raise RuntimeError: when the machine is not reachable in time
+        """
+        start = time.time()
+        end = start + timeout
+        if not old_boot_id:
+            self.log.debug("  Boot ID not available, waiting %ss to let the "
+                           "machine go down", fallback_delay)
+            time.sleep(fallback_delay)
+
+        def new_boot_id():
+            boot_id = self.try_get_boot_id(
+                max(min(end - time.time(), BOOT_POLL_MAX_STEP), 1), hop)
+            if boot_id is None:
+                return None
+            if old_boot_id and boot_id in ("", old_boot_id):
+                return None
+            return (boot_id,)
+
+        out = utils.wait_for(new_boot_id, end - time.time(), 1, backoff=2,
+                             max_step=BOOT_POLL_MAX_STEP)
+        if not out:
+            raise RuntimeError(f"Machine {self} did not boot in {timeout}s "
+                               f"({self.get_ssh_cmd(hop)})")
+        self.log.debug("  Machine reachable after %.1fs", time.time() - start)
+        if system_running:
+            state = utils.wait_for(self._get_system_state,
+                                   max(end - time.time(), 1), 1, args=(hop,),
+                                   backoff=2, max_step=BOOT_POLL_MAX_STEP)
+            if not state:
+                self.log.warning("System did not finish booting in %ss, "
+                                 "proceeding anyway!", timeout)
+            elif state != "running":
+                self.log.warning("System finished booting in state %s",
+                                 state)
+            else:
+                self.log.debug("  System running after %.1fs",
+                               time.time() - start)
+        return out[0]
+
+    def _get_info_cache_key(self):
+        """
+        Key identifying the state of the system for the get_info cache
+
+        :return: key or None when the state can not be identified
+        """
+        boot_id = self.get_boot_id()
+        if not boot_id:
+            return None
+        return (boot_id,)
+
+    def invalidate_info(self):
+        """
+        Drop the cached get_info output (eg. after system modification)
+        """
+        self._info_cache = None
 
     def get_info(self):
         """
         Report basic info about this machine
+
+        The output is cached and reused as long as the machine was not
+        rebooted (or the cache invalidated via ``invalidate_info``).
         """
+        key = self._get_info_cache_key()
+        if key is not None and self._info_cache is not None:
+            if self._info_cache[0] == key:
+                return dict(self._info_cache[1])
         output = {}
         for entry in utils.sorted_entry_points('runperf.machine.distro_info'):
             out = entry.load()(self)
             if out:
                 output.update(out)
+        if key is not None:
+            self._info_cache = (key, dict(output))
         return output
 
     def fetch_logs(self, path):
@@ -277,9 +520,15 @@ class Controller:
                               self.main_host))
         self.hosts = hosts
         self.metadata = args.metadata
+        if args.image_cache != "off":
+            cache = image_cache.ImageCache(args.image_cache_dir,
+                                           args.image_cache)
+            for host in self.hosts:
+                host.image_cache = cache
 
     @staticmethod
-    def for_each_host(hosts, method, args=tuple(), kwargs=None):
+    def for_each_host(hosts, method, args=tuple(), kwargs=None,
+                      details=None):
         """
         Perform action in parallel on each host, signal RebootRequest if
         necessary.
@@ -288,14 +537,21 @@ class Controller:
         :param method: host.$method to be performed per each host
         :param args: positional arguments forwarded to the called methods
         :param kwargs: key word arguments forwarded to the called methods
+        :param details: extra details to be recorded in the timeline
         :raise exceptions.RebootRequest: When any of the actions report
                                          non-zero return.
         """
+        def run_phase(host):
+            with CONTEXT.phase(method, host, **details):
+                getattr(host, method)(*args, **kwargs)
+
         if kwargs is None:
             kwargs = {}
-        threads = [utils.ThreadWithStatus(target=getattr(host, method),
+        if details is None:
+            details = {}
+        threads = [utils.ThreadWithStatus(target=run_phase,
                                           name=f"{host.name}-{method}",
-                                          args=args, kwargs=kwargs)
+                                          args=(host,))
                    for host in hosts]
         for thread in threads:
             thread.start()
@@ -312,7 +568,7 @@ class Controller:
             raise exceptions.RebootRequest(reboot_request, method)
 
     def for_each_host_retry(self, attempts, hosts, method, args=tuple(),
-                            kwargs=None):
+                            kwargs=None, details=None):
         """
         Perform action in parallel on each host while allowing re-try if
         available.
@@ -324,22 +580,28 @@ class Controller:
         :param method: host.$method to be performed per each host
         :param args: positional arguments forwarded to the called methods
         :param kwargs: key word arguments forwarded to the called methods
+        :param details: extra details to be recorded in the timeline
         :raise exceptions.RebootRequest: When any of the actions report
                                          non-zero return.
         """
         if kwargs is None:
             kwargs = {}
+        if details is None:
+            details = {}
         i = 0
         all_hosts = hosts
         while True:
             try:
-                self.for_each_host(hosts, method, args, kwargs)
+                self.for_each_host(hosts, method, args, kwargs,
+                                   dict(details, attempt=i))
                 return
             except exceptions.RebootRequest as exc:
                 # Retry only with hosts that requested retry
                 hosts = exc.hosts
                 for host in hosts:
-                    host.reboot()
+                    with CONTEXT.phase("reboot", host, reason=method,
+                                       attempt=i, **details):
+                        host.reboot()
             i += 1
             if i >= attempts:
                 raise RuntimeError(f"Failed to {method} on "
@@ -349,6 +611,10 @@ class Controller:
 
     def setup(self):
         """Basic setup like ssh keys, pbench installation and such"""
+        with CONTEXT.phase("setup", "controller"):
+            self._setup()
+
+    def _setup(self):
         CONTEXT.msg(f"SETUP hosts {','.join(str(_) for _ in self.hosts)}")
         if self._provisioner:
             self.log.info("PROVISION %s", self.hosts)
@@ -388,7 +654,8 @@ class Controller:
         """
         Fetch logs from all hosts
         """
-        self.for_each_host(self.hosts, 'fetch_logs', (path, ))
+        self.for_each_host(self.hosts, 'fetch_logs', (path, ),
+                           details={"profile": self.profile})
 
     def _step(self):
         """
@@ -425,7 +692,7 @@ class Controller:
             setup_script += utils.shell_dnf_install_cmd(self._args.worker_rpms)
         self.for_each_host_retry(5, self.hosts, 'apply_profile',
                                  (profile, extra, setup_script,
-                                  self.paths))
+                                  self.paths), details={"profile": profile})
         self.profile = self.main_host.profile.name
         return [host.workers for host in self.hosts]
 
@@ -433,7 +700,58 @@ class Controller:
         """Apply profile on each host, report list of lists of workers"""
         return self._step()(self._apply_profile)(profile, extra)
 
-    def _revert_profile(self):
+    def plan_profiles(self, profile_defs, optimize=True):
+        """
+        Plan the profiles execution to minimize the number of reboots
+
+        Profiles are grouped by their persistent setup (keeping the order
+        of the first occurrence) and consecutive profiles with identical
+        non-empty persistent setup are marked to keep it on revert.
+
+        :param profile_defs: list of (profile, extra) tuples
+        :param optimize: reorder the profiles and share the persistent
+                         setup (otherwise only describe the profiles in
+                         the original order)
+        :return: list of `ProfilePlan` items
+        """
+        groups = collections.OrderedDict()
+        for i, (profile, extra) in enumerate(profile_defs):
+            setups = [profiles.get_persistent_setup(profile, extra, host)
+                      for host in self.hosts]
+            key = json.dumps(setups, sort_keys=True)
+            if not optimize:
+                # Unique key to preserve the order
+                key = (i, key)
+            groups.setdefault(key, []).append((i, profile, extra, setups))
+        items = [item for group in groups.values() for item in group]
+        plan = []
+        for i, (index, profile, extra, setups) in enumerate(items):
+            keep = (optimize and i + 1 < len(items) and any(setups) and
+                    setups == items[i + 1][3])
+            plan.append(ProfilePlan(index, profile, extra, setups, keep))
+        return plan
+
+    @staticmethod
+    def estimate_reboots(plan):
+        """
+        Estimate the number of (parallel) reboots required by the plan
+
+        :param plan: list of `ProfilePlan` items
+        :return: estimated number of reboots
+        """
+        reboots = 0
+        kept = False
+        for step in plan:
+            apply, revert = zip(*[profiles.persistent_setup_reboots(setup)
+                                  for setup in step.setups])
+            if not kept and any(apply):
+                reboots += 1
+            if not step.keep_persistent and any(revert):
+                reboots += 1
+            kept = step.keep_persistent
+        return reboots
+
+    def _revert_profile(self, keep_persistent=False):
         CONTEXT.msg(f"REVERT profile {self.profile}")
         # Collect information about the profile in case it was applied
         if self.profile is not None:
@@ -447,12 +765,19 @@ class Controller:
                                 json.dumps(env))
         # Allow 3 attempts, one to revert previous profile, one to apply
         # and one extra in case one boot fails to get resources (eg. hugepages)
-        self.for_each_host_retry(3, self.hosts, 'revert_profile')
+        self.for_each_host_retry(3, self.hosts, 'revert_profile',
+                                 (keep_persistent,),
+                                 details={"profile": self.profile})
         self.profile = None
 
-    def revert_profile(self):
-        """Revert profile"""
-        return self._step()(self._revert_profile)()
+    def revert_profile(self, keep_persistent=False):
+        """
+        Revert profile
+
+        :param keep_persistent: keep the persistent setup for the next
+                                profile (see `plan_profiles`)
+        """
+        return self._step()(self._revert_profile)(keep_persistent)
 
     @staticmethod
     def _move_results(tmp_path):
@@ -474,27 +799,42 @@ class Controller:
         :param test_class: class to be instantiated and executed via this
                            controller
         :param workers: list of workers to be made available for execution
+        :return: path to the test results (None when the test was skipped)
         """
         test = test_class(self.main_host, workers,
                           os.path.join(self._args.output, self.profile),
                           self.metadata, extra.copy())
         name = test.name
         CONTEXT.set(1, test.output, "Running test")
+        details = {"profile": self.profile, "test": name}
         try:
-            test.setup()
-            test.run()
+            with CONTEXT.phase("test_setup", "controller", **details):
+                test.setup()
+            with CONTEXT.phase("test_run", "controller", **details):
+                test.run()
+            # Ensure the session transcripts are written before moving
+            CONTEXT.flush()
             path = self._move_results(test.output)
             CONTEXT.set(1, path, f"{name} FINISHED")
+            return path
         except exceptions.TestSkip as exc:
             CONTEXT.msg(f"{name} SKIPPED: {exc}")
+            return None
         except Exception as exc:
             CONTEXT.msg(f"{name} INTERRUPTED: {exc}")
             raise
         finally:
-            test.cleanup()
+            with CONTEXT.phase("test_cleanup", "controller", **details):
+                test.cleanup()
 
     def cleanup(self):
         """Post-testing cleanup"""
+        stats = {host.name: dict(host.image_stats) for host in self.hosts
+                 if host.image_stats}
+        if self.hosts[0].image_cache is not None:
+            stats["controller"] = dict(self.hosts[0].image_cache.stats)
+        if stats:
+            self.write_metadata("guest_image_cache", json.dumps(stats))
         CONTEXT.msg(f"CLEANUP hosts {self.hosts}")
         self.for_each_host_retry(2, self.hosts, 'cleanup')
 
@@ -512,6 +852,10 @@ class Host(BaseMachine):
         self.hop = hop
 
         self.shared_pub_key = None
+        # Controller-side image cache (see runperf.utils.image_cache)
+        self.image_cache = None
+        # Guest image hit/miss/evicted statistics
+        self.image_stats = collections.Counter()
         self.reboot_request = False
         self.profile = None
         self._cleanup = []
@@ -525,7 +869,7 @@ class Host(BaseMachine):
         Prepare host
         """
         if self.params.get("disable_smt"):
-            with self.get_session_cont() as session:
+            with self.get_session_cont(reuse=True) as session:
                 smt_control = session.cmd("cat /sys/devices/system/cpu/smt/"
                                           "control").strip()
                 if smt_control != "forceoff":
@@ -591,7 +935,7 @@ class Host(BaseMachine):
         """
         Generate/reuse ssh key in ~/.ssh/id_rsa
         """
-        with self.get_session_cont() as session:
+        with self.get_session_cont(reuse=True) as session:
             if (session.cmd_status('[ -e ~/.ssh/id_rsa.pub ]') or
                     session.cmd_output('[ -e ~/.ssh/id_rsa ]')):
                 self._cleanup.append("ssh_keys")
@@ -605,7 +949,7 @@ class Host(BaseMachine):
         """
         Runs a script on the machine
         """
-        with self.get_session_cont() as session:
+        with self.get_session_cont(reuse=True) as session:
             tmp = session.cmd_output("mktemp").strip()
             session.cmd(utils.shell_write_content_cmd(tmp, script, False))
             session.cmd(f"sh -x {tmp}", timeout)
@@ -613,18 +957,26 @@ class Host(BaseMachine):
     def reboot(self):
         """Gracefully reboot the machine"""
         self.log.debug("  Rebooting...")
-        with self.get_session_cont() as session:
-            session.sendline("reboot")
-            time.sleep(30)
-        with self.get_session_cont(360):
-            # Just checking whether it's obtainable
-            pass
+        self.close_sessions()
+        self.invalidate_info()
+        session = self.get_session()
+        try:
+            boot_id = session.cmd(BOOT_ID_CMD, print_func='mute',
+                                  ignore_all_errors=True).strip()
+            session.cmd(REBOOT_CMD, print_func='mute',
+                        ignore_all_errors=True)
+        finally:
+            session.close()
+        self.wait_for_boot(boot_id, 390, system_running=self.params.get(
+            "wait_system_running", False))
         self.log.debug("  Reboot DONE")
         self.reboot_request = False
 
     def provision(self, provisioner):
         """Provision the machine"""
         self.log.debug("  Provisioning using %s...", provisioner)
+        self.close_sessions()
+        self.invalidate_info()
         provisioner.provision(self)
         self.log.debug("  Provisioning DONE")
 
@@ -638,19 +990,30 @@ class Host(BaseMachine):
         """
         self.profile = profiles.get(profile, extra, self, rp_paths)
         CONTEXT.set(0, self.profile.name, f"Applying profile {profile}")
-        ret = self.profile.apply(setup_script)
+        try:
+            ret = self.profile.apply(setup_script)
+        finally:
+            self.invalidate_info()
         if ret is True:
             self.reboot_request = True
         else:
             self.workers = ret
 
-    def revert_profile(self):
-        """Revert profile if any profile set"""
+    def revert_profile(self, keep_persistent=False):
+        """
+        Revert profile if any profile set
+
+        :param keep_persistent: keep the persistent setup for the next
+                                profile
+        """
         self.log.debug("  Reverting profile %s", self.profile)
         if self.profile is None:
             return
-        if self.profile.revert():
-            self.reboot_request = True
+        try:
+            if self.profile.revert(keep_persistent):
+                self.reboot_request = True
+        finally:
+            self.invalidate_info()
         self.workers = []
         self.profile = None
 
@@ -659,10 +1022,17 @@ class Host(BaseMachine):
         if self.profile is not None:
             self.profile.revert()
         if "ssh_key" in self._cleanup:
-            with self.get_session_cont() as session:
+            with self.get_session_cont(reuse=True) as session:
                 session.cmd_status("rm -f ~/.ssh/id_rsa.pub")
                 session.cmd_status("rm -f ~/.ssh/id_rsa")
         self._cleanup = []
+        self.close_sessions()
+
+    def _get_info_cache_key(self):
+        key = BaseMachine._get_info_cache_key(self)
+        if key is None:
+            return None
+        return key + (getattr(self.profile, "name", None),)
 
     def get_info(self):
         out = BaseMachine.get_info(self)
@@ -693,6 +1063,12 @@ class LibvirtGuest(BaseMachine):
                    (re.compile(r"portid=[\"'][^\"']+[\"']"), "PORTID"),
                    (re.compile(r"[\"']/dev/pts[^\"']*[\"']"), "PTS"),
                    (re.compile(r"\sid=['\"]\d+['\"]"), " ID"))
+    # : How to create the VM image out of the base image ("image_strategy"
+    # : extra param); "copy" - full copy/conversion (preallocated images),
+    # : "reflink" - copy-on-write copy when supported by the filesystem
+    # : (falls back to "copy"), "overlay" - qcow2 overlay backed by the
+    # : base image
+    IMAGE_STRATEGIES = ("copy", "reflink", "overlay")
 
     def __init__(self, host, name, distro, base_image, smp, mem,
                  default_passwords=None, extra_params=None):
@@ -792,23 +1168,14 @@ class LibvirtGuest(BaseMachine):
         fmt = self.extra_params.get("image_format", "qcow2")
         src_fmt = self.base_image.rsplit('.', 1)[-1]
         image = f"{self.base_image[:-(len(src_fmt) + 1)]}-{self.name}.{fmt}"
-        if fmt == src_fmt:
-            session.cmd(f"\\cp -f {self.base_image} {image}",
-                        timeout=600)
-        else:
-            session.cmd(f"qemu-img convert -f {src_fmt} -O {fmt} "
-                        f"{self.base_image} {image}",
-                        timeout=600)
-        # System might get a bit laggy after huge-file copy, use sync to
-        # avoid unresponsive system
-        session.cmd("sync", timeout=600)
+        self._create_image(session, image, fmt, src_fmt)
         self.image = image
 
         xml = self.extra_params.get("xml", None)
         if xml:
             session.cmd("cat << \\EOF | "
                         f"virt-xml --edit --disk path={image} | "
-                        "virt-xml --edit --disk driver_type=raw | "
+                        f"virt-xml --edit --disk driver_type={fmt} | "
                         f"virt-xml --edit --metadata name={self.name} | "
                         f"virt-xml --edit --metadata uuid={uuid.uuid1()} > "
                         f"'{self._log_path('.xml')}'\n{xml}\nEOF")
@@ -828,6 +1195,44 @@ class LibvirtGuest(BaseMachine):
         session.cmd("chown -R qemu:qemu /dev/hugepages/")
         session.cmd(f"virsh create '{self._log_path('.xml')}'")
 
+    def _create_image(self, session, image, fmt, src_fmt):
+        """
+        Create the VM image out of the base image
+
+        Uses the "image_strategy" extra param (see `IMAGE_STRATEGIES`).
+        """
+        strategy = self.extra_params.get("image_strategy", "copy")
+        if strategy not in self.IMAGE_STRATEGIES:
+            raise ValueError(f"Unsupported image_strategy {strategy}, use "
+                             f"one of {', '.join(self.IMAGE_STRATEGIES)}")
+        if strategy == "overlay":
+            if fmt != "qcow2":
+                raise ValueError("Overlay image_strategy requires qcow2 "
+                                 f"image_format (not {fmt})")
+            session.cmd(f"qemu-img create -f qcow2 -F {src_fmt} -b "
+                        f"{self.base_image} {image}")
+            return
+        if strategy == "reflink":
+            if fmt != src_fmt:
+                self.log.warning("Unable to reflink %s image into %s, using "
+                                 "full conversion", src_fmt, fmt)
+            elif not session.cmd_status(f"\\cp -f --reflink=always "
+                                        f"{self.base_image} {image}"):
+                return
+            else:
+                self.log.warning("Reflink not supported, using full copy of "
+                                 "%s", self.base_image)
+        if fmt == src_fmt:
+            session.cmd(f"\\cp -f {self.base_image} {image}",
+                        timeout=600)
+        else:
+            session.cmd(f"qemu-img convert -f {src_fmt} -O {fmt} "
+                        f"{self.base_image} {image}",
+                        timeout=600)
+        # System might get a bit laggy after huge-file copy, use sync to
+        # avoid unresponsive system
+        session.cmd("sync", timeout=600)
+
     def is_running(self):
         """Whether VM is running"""
         out = self.get_host_session().cmd_output("virsh list")
@@ -841,19 +1246,48 @@ class LibvirtGuest(BaseMachine):
     def get_addr(self):
         if self._addr is not None:
             return self._addr
+        if self.discover_addrs([self]):
+            raise RuntimeError(f"Failed to get {self.name} IP addr in 240s")
+        return self._addr
 
-        end = time.time() + 240
-        session = self.get_host_session()
-        out = ""
-        while time.time() < end:
-            out = session.cmd_output(f"virsh domifaddr {self.name}",
-                                     print_func='mute')
-            addrs = self._RE_IPADDR.findall(out)
-            if addrs:
-                self.log.debug(out)
-                self._addr = addrs[-1]
-                return self._addr
-        raise RuntimeError(f"Failed to get {self.name} IP addr in 240s: {out}")
+    @classmethod
+    def discover_addrs(cls, guests, timeout=240):
+        """
+        Discover IP addresses of (multiple) guests running on the same host
+
+        All guests without known address are queried by a single command
+        per round and the rounds are spaced with backoff to reduce the
+        load of the host while the guests are booting.
+
+        :param guests: list of guests (all defined on the same host)
+        :param timeout: overall timeout
+        :return: list of guests whose address was not discovered
+        """
+        pending = [guest for guest in guests if guest._addr is None]
+        if not pending:
+            return []
+        host = pending[0].host
+
+        def discover():
+            cmd = "; ".join(f"echo '{ADDR_MARKER}{guest.name}'; "
+                            f"virsh domifaddr '{guest.name}'"
+                            for guest in pending)
+            with host.get_session_cont(reuse=True) as session:
+                out = session.cmd_output(cmd, print_func='mute')
+            outputs = dict(_.split('\n', 1) if '\n' in _ else (_, "")
+                           for _ in out.split(ADDR_MARKER)[1:])
+            for guest in pending[:]:
+                out = outputs.get(guest.name, "")
+                addrs = cls._RE_IPADDR.findall(out)
+                if addrs:
+                    guest.log.debug(out)
+                    guest._addr = addrs[-1]
+                    pending.remove(guest)
+            return not pending
+
+        utils.wait_for(discover, timeout, 1, backoff=2,
+                       max_step=ADDR_POLL_MAX_STEP)
+        return pending
 
     def get_host_addr(self):
         return self.host.get_addr()
@@ -861,6 +1295,7 @@ class LibvirtGuest(BaseMachine):
     def cleanup(self):
         """Destroy the machine and close host connection"""
         errs = []
+        self.close_sessions()
         if not self._started:
             if self._host_session:
                 self._host_session.close()
@@ -12,8 +12,16 @@
 #
 # Copyright: Red Hat Inc. 2018
 # Author: Lukas Doktor <ldoktor@redhat.com>
+import base64
+import copy
+import hashlib
+import io
+import json
 import logging
 import os
+import re
+import shlex
+import tarfile
 import time
 
 from importlib.metadata import entry_points
@@ -24,6 +32,169 @@ from . import utils
 LOG = logging.getLogger(__name__)
 # : Persistent storage path
 CONFIG_DIR = '/var/lib/runperf/'
+# : Persistent setup items that require reboot on apply resp. revert
+APPLY_REBOOT_SETUP = frozenset(("rc_local", "grub_args", "irqbalance"))
+REVERT_REBOOT_SETUP = frozenset(("grub_args", "irqbalance"))
+
+
+class PersistentState:
+
+    """
+    Cached key-value persistent storage of a machine
+
+    Each key is stored in a separate ``CONFIG_DIR + key`` file (the layout
+    used by rc.local scripts as well as older runperf versions), but all
+    keys are loaded by a single command and the modifications are written
+    back in a single operation by ``flush`` (each file is replaced
+    atomically).
+    """
+
+    # Not anchored to the line start as the output might follow a prompt
+    _RE_STATE = re.compile(r"RUNPERF_STATE:([A-Za-z0-9+/=]*)\r?$",
+                           re.MULTILINE)
+    _RE_LARGE = re.compile(r"RUNPERF_LARGE:([A-Za-z0-9+/=]*)\r?$",
+                           re.MULTILINE)
+
+    def __init__(self, get_session):
+        """
+        :param get_session: callable returning the session to be used
+        """
+        self._get_session = get_session
+        self._values = None
+        self._dirty = set()
+
+    def _load(self):
+        if self._values is not None:
+            return self._values
+        # Skip test-specific data (eg. runperf-nbd disk images) and load
+        # big files separately to keep the single-line output reasonable
+        config_dir = shlex.quote(CONFIG_DIR)
+        find = (f"cd {config_dir} 2>/dev/null && find . -type f ! -path "
+                "'./runperf-*' ! -path './.state-*'")
+        session = self._get_session()
+        out = session.cmd_output(
+            f"echo \"RUNPERF_STATE:$({find} -size -1024k -print0 | tar "
+            "--null -T - -czf - | base64 -w0)\"; echo \"RUNPERF_LARGE:"
+            f"$({find} ! -size -1024k -print0 | base64 -w0)\"",
+            print_func='mute')
+        values = {}
+        self._parse_state(out, values)
+        match = self._RE_LARGE.search(out)
+        if match and match[1]:
+            for name in base64.b64decode(match[1]).split(b"\0"):
+                if not name:
+                    continue
+                name = shlex.quote(name.decode("utf-8", errors="replace"))
+                out = session.cmd_output(
+                    f"echo \"RUNPERF_STATE:$(cd {config_dir} && tar -czf - "
+                    f"{name} | base64 -w0)\"", print_func='mute')
+                self._parse_state(out, values)
+        self._values = values
+        return values
+
+    def _parse_state(self, out, values):
+        """Update values by the RUNPERF_STATE tarball from the output"""
+        match = self._RE_STATE.search(out)
+        if not match:
+            raise RuntimeError(f"Failed to load runperf state:\n{out}")
+        if not match[1]:
+            return
+        with tarfile.open(fileobj=io.BytesIO(base64.b64decode(match[1])),
+                          mode="r:gz") as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    content = tar.extractfile(member).read()
+                    values[os.path.normpath(member.name)] = (
+                        content.decode("utf-8", errors="replace"))
+
+    def refresh(self):
+        """
+        Flush pending modifications and drop the cached values (they'll be
+        re-loaded on the next access)
+        """
+        self.flush()
+        self._values = None
+
+    def get(self, key, default=-1):
+        """
+        Get value (without the trailing newline) or default when not set
+        """
+        values = self._load()
+        if key not in values:
+            return default
+        value = values[key]
+        if value.endswith('\n'):
+            return value[:-1]
+        return value
+
+    def exists(self, key):
+        """
+        Whether the key is set
+        """
+        return key in self._load()
+
+    def set(self, key, value, flush=False):
+        """
+        Set the value (newline is appended, as done by the heredocs)
+
+        :param flush: write the modifications immediately (use for entries
+                      that must survive a crash/reboot, eg. backups)
+        """
+        self._load()[key] = value + '\n'
+        self._dirty.add(key)
+        if flush:
+            self.flush()
+
+    def append(self, key, value, flush=False):
+        """
+        Append value as a new line
+
+        :param flush: write the modifications immediately
+        """
+        values = self._load()
+        values[key] = values.get(key, "") + value + '\n'
+        self._dirty.add(key)
+        if flush:
+            self.flush()
+
+    def remove(self, key):
+        """
+        Remove the key (including all keys nested under it)
+        """
+        values = self._load()
+        prefix = key + '/'
+        for _key in list(values):
+            if _key == key or _key.startswith(prefix):
+                del values[_key]
+        self._dirty.add(key)
+
+    def flush(self):
+        """
+        Write all pending modifications in a single command
+        """
+        if not self._dirty:
+            return
+        values = self._load()
+        config_dir = shlex.quote(CONFIG_DIR)
+        cmd = ["(", "set -e", f"mkdir -p {config_dir}",
+               f"RP_STAGE=$(mktemp -d {config_dir}.state-XXXXXX)"]
+        # Removals first as they might cover nested keys that are set
+        for key in sorted(self._dirty):
+            if key not in values:
+                cmd.append(f"rm -rf {shlex.quote(CONFIG_DIR + key)}")
+        for i, key in enumerate(sorted(self._dirty)):
+            if key not in values:
+                continue
+            path = shlex.quote(CONFIG_DIR + key)
+            payload = base64.encodebytes(values[key].encode("utf-8"))
+            cmd.append(f"mkdir -p \"$(dirname {path})\"")
+            cmd.append(f"base64 -d > \"$RP_STAGE/{i}\" << \\RUNPERF_EOF")
+            cmd.append(payload.decode("ascii") + "RUNPERF_EOF")
+            cmd.append(f"mv -f \"$RP_STAGE/{i}\" {path}")
+        cmd.append("rmdir \"$RP_STAGE\"")
+        cmd.append(")")
+        self._get_session().cmd("\n".join(cmd), print_func='mute')
+        self._dirty = set()
 
 
 class BaseProfile:
@@ -60,10 +231,28 @@ class BaseProfile:
             self._path_to_be_removed = lambda _: True
         else:
             self._path_to_be_removed = self.__path_to_be_removed
+        self._state = PersistentState(lambda: self.session)
         # List of available workers
         self.workers = []
         self.log_fetcher = utils.LogFetcher()
         self.workers_log_fetcher = utils.LogFetcher()
+        # Whether to keep the persistent setup on revert (see revert())
+        self._keep_persistent = False
+
+    @classmethod
+    def get_persistent_setup(cls, host, extra):
+        """
+        Describe the persistent (surviving reboot) setup without touching
+        the machine
+
+        Profiles with identical persistent setup can share it (see
+        ``revert(keep_persistent=True)``).
+
+        :param host: Host machine the profile would be applied on
+        :param extra: profile extra params (not modified)
+        :return: dict describing the persistent setup (empty when none)
+        """
+        return {}
 
     def _refresh_session(self):
         """
@@ -84,7 +273,7 @@ class BaseProfile:
         """
         Write/append to file on libvirt host
         """
-        self.session.cmd(utils.shell_write_content_cmd(path, content, append))
+        self.host.write_file(path, content, append, session=self.session)
 
     def _read_file(self, path, default=-1):
         if not self._exists(path):
@@ -95,6 +284,10 @@ class BaseProfile:
         return out
 
     def _persistent_storage_path(self, key):
+        """
+        Get path to the key to be used directly (flushes the pending state)
+        """
+        self._state.flush()
         path = CONFIG_DIR + key
         ppath = os.path.dirname(path)
         if not self._exists(ppath):
@@ -108,33 +301,36 @@ class BaseProfile:
         """
         Get value from persistent storage
         """
-        path = CONFIG_DIR + key
-        return self._read_file(path, default)
+        return self._state.get(key, default)
 
-    def _set(self, key, value, fail_if_exists=False):
+    def _set(self, key, value, fail_if_exists=False, flush=False):
         """
         Set value to persistent storage
+
+        :param flush: write it immediately rather than on the next flush;
+                      required for backups of the system setup and markers
+                      read after reboot as revert depends on them
         """
-        path = self._persistent_storage_path(key)
-        if fail_if_exists and self._exists(path):
+        if fail_if_exists and self._state.exists(key):
             raise ValueError(f"Key {key} is already set")
-        self._write_file(path, value)
+        self._state.set(key, value, flush)
 
-    def _append(self, key, value):
+    def _append(self, key, value, flush=False):
         """
         Append value to \n separated list of items in persistent storage
+
+        :param flush: write it immediately (see ``_set``)
         """
         if "\n" in value:
             raise ValueError(f"Unable to set {key}, "
                              f"list values must not contain '\n' ({value})")
-        path = self._persistent_storage_path(key)
-        self._write_file(path, value, True)
+        self._state.append(key, value, flush)
 
     def _remove(self, key):
         """
         Remove key from persistent storage
         """
-        self.session.cmd(f"rm -rf {CONFIG_DIR + key}")
+        self._state.remove(key)
 
     def __path_to_be_removed(self, path):
         """
@@ -150,6 +346,7 @@ class BaseProfile:
                   [worker1, worker2, ...] - on success
         """
         self._refresh_session()
+        self._state.refresh()
         # First check whether we have persistent setup set
         _profile = self._get("set_profile")
         if _profile == -1:
@@ -157,11 +354,14 @@ class BaseProfile:
         else:
             raise RuntimeError("Trying to apply profile but there is already "
                                "'%s' persistent profile applied.")
-        self._set("set_profile", self.name)
-        self.session.runperf_stage(f"Applying profile {self.name}")
-        reboot = self._apply(setup_script)
-        if reboot:
-            self._remove("set_profile")
+        try:
+            self._set("set_profile", self.name, flush=True)
+            self.session.runperf_stage(f"Applying profile {self.name}")
+            reboot = self._apply(setup_script)
+            if reboot:
+                self._remove("set_profile")
+        finally:
+            self._state.flush()
         return reboot
 
     def _apply(self, setup_script):
@@ -170,17 +370,22 @@ class BaseProfile:
         """
         raise NotImplementedError
 
-    def revert(self):
+    def revert(self, keep_persistent=False):
         """
         Revert the profile
 
+        :param keep_persistent: keep the persistent setup (to be re-used by
+                                the next profile with identical persistent
+                                setup, see ``get_persistent_setup``)
         :return: True - when the machine needs to be rebooted
                  False - when everything is reverted properly
         """
         if not self.session:  # Avoid cleaning twice... (cleanup on error)
             return None
+        self._keep_persistent = keep_persistent
         self.session.runperf_stage(f"Reverting profile {self.name}")
         self._refresh_session()
+        self._state.refresh()
         _profile = self._get("set_profile")
         if _profile == -1:
             # Profile might not be fully set, just applied
@@ -192,7 +397,11 @@ class BaseProfile:
             raise NotImplementedError("Reverting non-matching profiles not "
                                       f"yet supported ({_profile} != "
                                       f"{self.name})")
-        return self._do_revert(_profile)
+        try:
+            return self._do_revert(_profile)
+        finally:
+            if self.session:
+                self._state.flush()
 
     def _do_revert(self, profile):
         """
@@ -205,6 +414,7 @@ class BaseProfile:
         for path in self._get("cleanup/paths_to_be_removed", "").splitlines():
             self.session.cmd(f"rm -rf '{path}'", print_func="mute")
         self._remove("cleanup/paths_to_be_removed")
+        self._state.flush()
         session = self.session
         self.session = None
         session.close()
@@ -286,13 +496,46 @@ class PersistentProfile(BaseProfile):
         if 'tuned_adm_profile' in extra:
             self._tuned_adm_profile = extra["tuned_adm_profile"]
         if 'rc_local_file' in extra:
-            with open(extra["rc_local_file"],
-                      encoding="utf-8") as rc_local_fd:
-                params = {"performed_setup_path": self.performed_setup_path}
-                params.update(host.params)
-                if 'rc_local_file_params' in extra:
-                    params.update(extra["rc_local_file_params"])
-                self._rc_local = rc_local_fd.read() % params
+            self._rc_local = self._render_rc_local(host, extra)
+
+    @staticmethod
+    def _render_rc_local(host, extra):
+        """Render the extra["rc_local_file"] using host and extra params"""
+        with open(extra["rc_local_file"], encoding="utf-8") as rc_local_fd:
+            params = {"performed_setup_path":
+                      CONFIG_DIR + "persistent_setup_finished"}
+            params.update(host.params)
+            if 'rc_local_file_params' in extra:
+                params.update(extra["rc_local_file_params"])
+            return rc_local_fd.read() % params
+
+    @classmethod
+    def get_persistent_setup(cls, host, extra):
+        setup = {}
+        grub_args = set(cls._grub_args or ())
+        grub_args.update(extra.get("grub_args", []))
+        if grub_args:
+            setup["grub_args"] = sorted(grub_args)
+        if 'rc_local_file' in extra:
+            rc_local = cls._render_rc_local(host, extra)
+        else:
+            rc_local = cls._rc_local
+        if rc_local:
+            setup["rc_local"] = hashlib.sha256(
+                rc_local.encode("utf-8")).hexdigest()
+        tuned_adm_profile = extra.get("tuned_adm_profile",
+                                      cls._tuned_adm_profile)
+        if tuned_adm_profile:
+            setup["tuned_adm_profile"] = tuned_adm_profile
+        irqbalance = extra.get("irqbalance", cls._irqbalance)
+        if irqbalance is not None:
+            setup["irqbalance"] = irqbalance
+        return setup
+
+    def _persistent_fingerprint(self):
+        """Identifier of the persistent setup stored in persistent storage"""
+        return json.dumps(self.get_persistent_setup(self.host, self.extra),
+                          sort_keys=True)
 
     def _apply(self, setup_script):
         """
@@ -304,6 +547,15 @@ class PersistentProfile(BaseProfile):
         if persistent_setup == -1:
             # Persistent setup not applied
             return self._apply_persistent()
+        fingerprint = self._get("persistent_setup_fingerprint", -1)
+        if fingerprint not in (-1, self._persistent_fingerprint()):
+            # Persistent setup kept by a different profile, revert it and
+            # apply the new one after reboot (reverted grub_args are still
+            # present in /proc/cmdline until then)
+            self.log.info("Replacing persistent setup %s by %s", fingerprint,
+                          self._persistent_fingerprint())
+            self._revert_persistent()
+            return True
         exp_setup = set(persistent_setup.splitlines())
         # Wait for all persistent setups to finish
         end = time.time() + 60
@@ -322,9 +574,11 @@ class PersistentProfile(BaseProfile):
         self._append("persistent_setup_expected", "rc_local")
         rc_local_content = self._read_file("/etc/rc.d/rc.local", -1)
         if rc_local_content == -1:
-            self._set('persistent_setup/rc_local_was_missing', "missing")
+            self._set('persistent_setup/rc_local_was_missing', "missing",
+                      flush=True)
         else:
-            self._set('persistent_setup/rc_local', rc_local_content, True)
+            self._set('persistent_setup/rc_local', rc_local_content, True,
+                      flush=True)
         self._write_file("/etc/rc.d/rc.local", rc_local, False)
         if rc_local_content != -1:
             self._write_file("/etc/rc.d/rc.local", "\n\n" + rc_local_content,
@@ -336,7 +590,8 @@ class PersistentProfile(BaseProfile):
         tune_current = tune_current.split(':', 1)[1].strip()
         if tune_current != "virtual-host":
             # Change the profile
-            self._set("persistent_setup/tuned_adm_profile", tune_current)
+            self._set("persistent_setup/tuned_adm_profile", tune_current,
+                      flush=True)
             self.session.cmd(f"tuned-adm profile {profile}")
 
     def _persistent_grub_args(self, grub_args):
@@ -346,7 +601,7 @@ class PersistentProfile(BaseProfile):
         if not args:
             return
         self.host.reboot_request = True
-        self._set("persistent_setup/grub_args", args)
+        self._set("persistent_setup/grub_args", args, flush=True)
         self.session.cmd(f'grubby --args="{args}" --update-kernel='
                          '"$(grubby --default-kernel)"')
 
@@ -355,7 +610,7 @@ class PersistentProfile(BaseProfile):
         if status == _status:
             # We are done, they are configured correctly
             return
-        self._set("persistent_setup/irqbalance", _status)
+        self._set("persistent_setup/irqbalance", _status, flush=True)
         self.session.cmd(f"systemctl {'enable' if status else 'disable'} "
                          "irqbalance")
         self.host.reboot_request = True
@@ -366,6 +621,8 @@ class PersistentProfile(BaseProfile):
         """
         # set_profile will be set on the next boot (if succeeds)
         self._set("persistent_profile_expected", "")
+        self._set("persistent_setup_fingerprint",
+                  self._persistent_fingerprint(), flush=True)
         if self._rc_local:
             self._persistent_rc_local(self._rc_local)
 
@@ -380,6 +637,17 @@ class PersistentProfile(BaseProfile):
         return self.host.reboot_request
 
     def _revert(self):
+        if self._keep_persistent:
+            self.log.debug("Keeping persistent setup of %s", self.name)
+            return False
+        return self._revert_persistent()
+
+    def _revert_persistent(self):
+        """
+        Revert the persistent setup
+
+        :return: True when reboot is required
+        """
         reboot = False
         irqbalance = self._get("persistent_setup/irqbalance", -1)
         if irqbalance != -1:
@@ -403,6 +671,7 @@ class PersistentProfile(BaseProfile):
             self.session.cmd("rm -f /etc/rc.d/rc.local")
         self.session.cmd(f"rm -Rf {self.performed_setup_path}")
         self._remove("persistent_setup_expected")
+        self._remove("persistent_setup_fingerprint")
         self._remove("profile/TunedLibvirt/persistent")
         return reboot
 
@@ -411,12 +680,21 @@ class PersistentProfile(BaseProfile):
         if 'persistent' not in info:
             info['persistent'] = {}
         params = info['persistent']
+        cmds = {}
         if self._rc_local:
-            params["rc_local"] = self._read_file("/etc/rc.d/rc.local")
-        if self._tuned_adm_profile:
-            params["tuned_adm_profile"] = self.session.cmd("tuned-adm active")
-        params["tuned_adm_profile"] = self.session.cmd_status_output(
-            "systemctl is-enabled irqbalance")[1]
+            cmds["rc_local"] = "cat /etc/rc.d/rc.local"
+        cmds["irqbalance"] = "systemctl is-enabled irqbalance"
+        outputs = dict(zip(cmds, utils.batch_cmd_status_output(
+            self.session, list(cmds.values()), ignore_all_errors=True)))
+        if "rc_local" in outputs:
+            status, rc_local = outputs["rc_local"]
+            if status:
+                params["rc_local"] = -1
+            else:
+                params["rc_local"] = (rc_local[:-1] if rc_local.endswith('\n')
+                                      else rc_local)
+        # irqbalance state is historically reported as tuned_adm_profile
+        params["tuned_adm_profile"] = outputs["irqbalance"][1]
         return info
 
 
@@ -448,6 +726,12 @@ class DefaultLibvirt(PersistentProfile):
     * force_guest_mem - override guest_mem
     * force_no_vms - override no vms
     * qemu_bin - custom qemu bin location
+    * image_format - format of the VM images (qcow2)
+    * image_strategy - how to create VM images out of the base image,
+      "copy" (default), "reflink" or "overlay" (see
+      :attr:`runperf.machine.LibvirtGuest.IMAGE_STRATEGIES`)
+    * keep_images - how many most recently used base images (per distro,
+      setup script and public key) to keep on the host (3)
     """
 
     name = "DefaultLibvirt"
@@ -469,7 +753,7 @@ class DefaultLibvirt(PersistentProfile):
             if value:
                 self._guest[param] = value
         # Remove previously existing libvirt logs
-        with self.host.get_session_cont() as session:
+        with self.host.get_session_cont(reuse=True) as session:
             session.cmd_status("rm -Rf /var/log/libvirt/*")
         self.log_fetcher.paths.add('/var/log/libvirt/')
         self.log_fetcher.globs_kernel_log_path.append(
@@ -486,12 +770,15 @@ class DefaultLibvirt(PersistentProfile):
         self._guest["image"] = self._get_image(self.session, setup_script)
         ret = self._start_vms()
         # Make sure vms are accessible
-        for vm in self.vms:
-            with vm.get_session_cont(timeout=360) as session:
-                session.cmd("true")
+        utils.fan_out(self.vms, self._wait_for_vm)
         self._set("applied_profile", self.name)
         return ret
 
+    @staticmethod
+    def _wait_for_vm(vm):
+        with vm.get_session_cont(timeout=360, reuse=True) as session:
+            session.cmd("true")
+
     def _prerequisities(self, session):
         if self._custom_qemu:
             deps = self.deps + " git"
@@ -507,24 +794,6 @@ class DefaultLibvirt(PersistentProfile):
                             timeout=600)
             session.cmd("systemctl start libvirtd")
 
-    def _image_up_to_date(self, session, pubkey, image, setup_script,
-                          setup_script_path):
-        image_exists = session.cmd_status(f"[ -e '{image}' ]") == 0
-        if not image_exists:
-            return "does not exists"
-        img_pubkey = session.cmd_output(f"[ -e '{pubkey}' ] && cat '{pubkey}'")
-        if img_pubkey.strip() != self.shared_pub_key.strip():
-            return "has wrong public key"
-        if setup_script:
-            if session.cmd_status(f"[ -e '{setup_script_path}' ]"):
-                return "not created with setup script"
-            act = session.cmd_output(f"cat '{setup_script_path}'").strip()
-            if act != setup_script.strip():
-                return "created with a different setup script"
-        elif not session.cmd_status(f"[ -e '{setup_script_path}' ]"):
-            return "created with setup script"
-        return None
-
     def _get_image(self, session, setup_script):
         entry_point = 'runperf.utils.cloud_image_providers'
         for entry in utils.sorted_entry_points(entry_point):
@@ -532,11 +801,15 @@ class DefaultLibvirt(PersistentProfile):
             if klass.is_for(self._guest["distro"], self.host.params['arch']):
                 plugin = klass(self._guest["distro"], self.host.params['arch'],
                                self.shared_pub_key, self.img_base, session,
-                               setup_script)
+                               setup_script, machine=self.host,
+                               image_cache=self.host.image_cache)
                 out = plugin.is_up_to_date()
                 if not out:
-                    self.log.debug("Reusing existing image")
+                    self.log.debug("Reusing existing image %s", plugin.image)
+                    self.host.image_stats["hit"] += 1
+                    self._use_image(plugin)
                     return plugin.image
+                self.host.image_stats["miss"] += 1
                 self.log.debug("Fetching %s image using %s because %s",
                                self._guest["distro"], str(plugin), out)
                 for path in plugin.paths:
@@ -547,12 +820,21 @@ class DefaultLibvirt(PersistentProfile):
                                      self._guest["distro"], out)
                     continue
                 self.log.debug("Image %s ready", self._guest["distro"])
+                self._use_image(plugin)
                 return plugin.image
         providers = ", ".join(str(_)
                               for _ in entry_points(group=entry_point))
         raise RuntimeError(f"Fail to fetch {self._guest['distro']} "
                            f"using {providers} providers")
 
+    def _use_image(self, plugin):
+        """Mark the image as used and evict the least recently used ones"""
+        plugin.mark_used()
+        evicted = plugin.evict_unused(int(self.extra.get("keep_images", 3)))
+        if evicted:
+            self.log.debug("Evicted least recently used images %s", evicted)
+            self.host.image_stats["evicted"] += len(evicted)
+
     def _start_vms(self):
         from . import machine   # py2 issue pylint: disable=C0415
         if not self._guest.get('guest_mem'):
@@ -568,10 +850,20 @@ class DefaultLibvirt(PersistentProfile):
                                       [self._guest["default_password"]],
                                       self.extra)
             self.vms.append(vm)
-            vm.start()
-
+        # Create the images and start all VMs concurrently (already
+        # registered VMs are cleaned by revert even on failure)
+        utils.fan_out(self.vms, self._start_vm)
+        # Discover addresses of all VMs at once
+        pending = machine.LibvirtGuest.discover_addrs(self.vms)
+        if pending:
+            raise RuntimeError("Failed to get IP addr of "
+                               f"{', '.join(str(_) for _ in pending)}")
         return self.vms
 
+    @staticmethod
+    def _start_vm(vm):
+        vm.start()
+
     def get_info(self):
         out = PersistentProfile.get_info(self)
         for i, vm in enumerate(self.vms):
@@ -674,6 +966,12 @@ class TunedLibvirt(DefaultLibvirt):
         if "xml" not in extra:
             extra["xml"] = self._get_xml(host, rp_paths,
                                          extra.get("xml_suffix", "-tuned"))
+        self._set_persistent_defaults(host, extra)
+        DefaultLibvirt.__init__(self, host, rp_paths, extra)
+
+    @staticmethod
+    def _set_persistent_defaults(host, extra):
+        """Fill the default persistent setup params into extra"""
         total_hp = int(host.params["guest_mem_m"] * 1024 /
                        host.params["hugepage_kb"])
         if "grub_args" not in extra:
@@ -690,7 +988,12 @@ class TunedLibvirt(DefaultLibvirt):
             mem_per_node = int(total_hp / host.params["numa_nodes"])
             params = {"mem_per_node": mem_per_node}
             extra["rc_local_file_params"] = params
-        DefaultLibvirt.__init__(self, host, rp_paths, extra)
+
+    @classmethod
+    def get_persistent_setup(cls, host, extra):
+        extra = copy.deepcopy(extra)
+        cls._set_persistent_defaults(host, extra)
+        return super().get_persistent_setup(host, extra)
 
     def _get_xml(self, host, rp_paths, suffix):
         for path in rp_paths:
@@ -703,6 +1006,30 @@ class TunedLibvirt(DefaultLibvirt):
                          f"unable to apply {self.name}")
 
 
+def get_persistent_setup(profile, extra, host):
+    """
+    Describe the persistent setup of a profile without touching the machine
+
+    :param profile: name of the profile
+    :param extra: profile extra params
+    :param host: Host machine the profile would be applied on
+    :return: dict describing the persistent setup (empty when none)
+    """
+    plugin = utils.named_entry_point('runperf.profiles', profile)
+    return plugin.get_persistent_setup(host, extra)
+
+
+def persistent_setup_reboots(setup):
+    """
+    Estimate whether the persistent setup requires reboot
+
+    :param setup: persistent setup (see ``get_persistent_setup``)
+    :return: tuple(reboot_on_apply, reboot_on_revert)
+    """
+    return (bool(APPLY_REBOOT_SETUP.intersection(setup)),
+            bool(REVERT_REBOOT_SETUP.intersection(setup)))
+
+
 def get(profile, extra, host, paths):
     """
     Get initialized/started guests object matching the definition
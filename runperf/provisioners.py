@@ -13,7 +13,6 @@
 # Copyright: Red Hat Inc. 2020
 # Author: Lukas Doktor <ldoktor@redhat.com>
 import re
-import time
 
 from runperf import utils
 
@@ -43,12 +42,16 @@ class Beaker:
                                   machine.distro, "--format", "json"])
         distro_tree_id = re.search(r'"distro_tree_id": (\d+),',
                                    out).group(1)
+        old_boot_id = machine.try_get_boot_id()
         utils.check_output(["bkr", "system-provision", "--distro-tree",
                             distro_tree_id, machine.addr])
-        # Wait for 3 minutes to let beaker to restart the machine
-        time.sleep(180)
+        # Wait for the provisioned system (without knowing the previous
+        # boot ID give beaker 3 minutes to restart the machine)
+        system_running = machine.params.get("wait_system_running", False)
+        machine.wait_for_boot(old_boot_id, 3180, system_running=system_running,
+                              fallback_delay=180)
 
-        with machine.get_session_cont(3000) as session:
+        with machine.get_session_cont(reuse=True) as session:
             if not utils.wait_for_machine_calms_down(session, 1800):
                 machine.log.warning("Machine did not stabilize in 1800s, "
                                     "proceeding on a loaded machine!")
@@ -18,14 +18,17 @@
 
 import collections
 import datetime
+import fnmatch
 import glob
+import gzip
+import hashlib
+import io
 import json
 import logging
 import math
 import os
 import re
 import string
-from xml.dom.minidom import Document  # nosec
 
 import numpy
 
@@ -53,6 +56,14 @@ PRINTABLE = string.ascii_letters + string.digits + string.punctuation + '\n\r '
 
 _RE_FAILED_ITERATION_NAME = re.compile(r'.*-fail(\d+)$')
 
+# Version of the serialized ResultsContainer state (see dump_state)
+STATE_VERSION = 1
+# Version of the reference builds digest (see dump_digest)
+DIGEST_VERSION = 2
+# Build metadata (besides the "environment_*" ones) kept in the digest
+DIGEST_METADATA = ("build", "machine", "machine_url", "url", "distro",
+                   "runperf_cmd", "runperf_version", "guest_distro")
+
 LOG = logging.getLogger(__name__)
 
 
@@ -96,6 +107,14 @@ class Model:
         """
         raise NotImplementedError
 
+    def get_identity(self):
+        """
+        Identifier of this model (its type and content)
+        """
+        content = json.dumps(getattr(self, "model", None), sort_keys=True)
+        return (f"{self.__class__.__name__}:"
+                f"{hashlib.sha256(content.encode()).hexdigest()[:12]}")
+
 
 class ModelLinearRegression(Model):
 
@@ -461,36 +480,151 @@ class Result:
         self._add(difference, weight, src)
         self.error.append(f"{name}{suffix} {details}")
 
+    def get_state(self):
+        """
+        Report the evaluated result as a list of values (see `from_state`)
+        """
+        if self._status is None:
+            self._recalculate()
+        state = [getattr(self, _) for _ in self.__slots__]
+        # json turns int keys into str, keep the params as list of pairs
+        if self.params is not None:
+            state[self.__slots__.index("params")] = list(self.params.items())
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Restore the evaluated result out of the `get_state` output
+        """
+        result = cls.__new__(cls)
+        for key, value in zip(cls.__slots__, state):
+            setattr(result, key, value)
+        if result.params is not None:
+            result.params = dict(result.params)
+        return result
+
+    def get_digest_state(self):
+        """
+        Report the minimal state used by reports (see `from_digest_state`)
+        """
+        return [self.name, self.score, self.status, self.primary]
+
+    @classmethod
+    def from_digest_state(cls, state):
+        """
+        Restore the result out of the `get_digest_state` output
+
+        :note: Details are not available and params are set to None
+        """
+        name, score, status, primary = state
+        result = cls(name, None, None, primary)
+        result._score = score
+        result._status = status
+        result._details = "(from digest)"
+        result.params = None
+        return result
+
+
+class ResultsFilter:
+
+    """
+    Select results based on PROFILE[/TEST[/ITERATION[/WORKFLOW]]] patterns
+
+    Each part of the pattern is a shell-like (fnmatch) pattern, missing
+    trailing parts match anything. Results are selected when they match
+    any of the include patterns (or there are none) and don't match any
+    of the exclude patterns.
+    """
+
+    PARTS = ("profile", "test", "iteration", "workflow")
+
+    def __init__(self, include=None, exclude=None):
+        self.include = [self._compile(_) for _ in include or []]
+        self.exclude = [self._compile(_) for _ in exclude or []]
+
+    def _compile(self, pattern):
+        parts = pattern.split('/')
+        if len(parts) > len(self.PARTS):
+            raise ValueError(f"Too many parts in filter pattern {pattern}, "
+                             f"expected {'/'.join(self.PARTS)}")
+        return [re.compile(fnmatch.translate(_)) for _ in parts]
+
+    @staticmethod
+    def _matches(pattern, parts):
+        """Whether all parts defined by both pattern and parts match"""
+        return all(regex.match(part) for regex, part in zip(pattern, parts))
+
+    def is_selected(self, *parts):
+        """
+        Whether the result is selected
+
+        :param parts: leading (profile, test, iteration, workflow) parts
+                      of the result; when only some are specified it
+                      reports whether anything underneath can be selected
+        """
+        if self.include and not any(self._matches(pattern, parts)
+                                    for pattern in self.include):
+            return False
+        for pattern in self.exclude:
+            if len(pattern) <= len(parts) and self._matches(pattern, parts):
+                return False
+        return True
+
 
-def iter_results_jsons(path, skip_incorrect=False):
+def iter_results_jsons(path, skip_incorrect=False, results_filter=None):
     """
     Process runperf results and yield the result.json files
+
+    :param results_filter: `ResultsFilter` used to skip unselected
+                           profiles/tests without entering their dirs
     """
     if skip_incorrect:
         result_name_glob = '[0-9]*'
     else:
         result_name_glob = '*'
-    for src_path in glob.glob(os.path.join(path, '*', '*', result_name_glob,
-                                           'result.json')):
-        yield src_path
+    if results_filter is None:
+        yield from glob.glob(os.path.join(path, '*', '*', result_name_glob,
+                                          'result.json'))
+        return
+    for profile_path in glob.glob(os.path.join(path, '*')):
+        profile = os.path.basename(profile_path)
+        if not results_filter.is_selected(profile):
+            continue
+        for test_path in glob.glob(os.path.join(profile_path, '*')):
+            if not results_filter.is_selected(profile,
+                                              os.path.basename(test_path)):
+                continue
+            yield from glob.glob(os.path.join(test_path, result_name_glob,
+                                              'result.json'))
 
 
-def iter_results_errors(path):
+def iter_results_errors(path, results_filter=None):
     """
     Process runperf results and yield the dirs with runperf errors
+
+    :param results_filter: `ResultsFilter` to skip errors of unselected
+                           profiles/tests (global errors are always reported)
     """
     for level in range(4):
         level_path = (path,) + ('*',) * level + ('__error*__',)
         for src_path in glob.glob(os.path.join(*level_path)):
+            if results_filter is not None:
+                parts = src_path.split(os.sep)[-(level + 1):-1][:2]
+                if not results_filter.is_selected(*parts):
+                    continue
             yield level, src_path
 
 
-def iter_results(path, skip_incorrect=False):
+def iter_results(path, skip_incorrect=False, primary_only=False,
+                 results_filter=None):
     """
     Process runperf results and yield individual results
 
     :param path: base path to runperf results
     :param skip_incorrect: don't yield incorrect results
+    :param primary_only: don't yield non-primary results
+    :param results_filter: `ResultsFilter` to select only some results
     :yield result: tuple(test_name, score, is_primary)
     """
     def _find_all_result(test, results):
@@ -517,6 +651,10 @@ def iter_results(path, skip_incorrect=False):
             if "profile" in benchmark:
                 test_params[f"user{i}"] = (f"profile: {benchmark['profile']}")
         for workflow in ('throughput', 'latency'):
+            if (results_filter is not None and
+                    not results_filter.is_selected(*split_path[-4:-2],
+                                                   iteration_name, workflow)):
+                continue
             workflow_items = data.get(workflow, {}).items()
             for workflow_type, results in workflow_items:
                 test = (f"{result_id}:./{iteration_name}/{workflow}/"
@@ -525,6 +663,8 @@ def iter_results(path, skip_incorrect=False):
                 if not res:
                     continue
                 primary = bool(workflow_type in primary_metrics)
+                if primary_only and not primary:
+                    continue
                 yield (f"{result_id}:./{iteration_name}/{workflow}/"
                        f"{workflow_type}.mean",
                        res['mean'],  # pylint: disable=W0631
@@ -538,7 +678,7 @@ def iter_results(path, skip_incorrect=False):
 
     LOG.debug("Processing %s", path)
     # Process results
-    for src_path in iter_results_jsons(path, skip_incorrect):
+    for src_path in iter_results_jsons(path, skip_incorrect, results_filter):
         with open(src_path, 'r', encoding="utf-8") as src_fd:
             src = json.load(src_fd)
         split_path = src_path.split(os.sep)
@@ -549,9 +689,13 @@ def iter_results(path, skip_incorrect=False):
                     _RE_FAILED_ITERATION_NAME.match(iteration_name)):
                 # Skip failed iterations
                 continue
+            if (results_filter is not None and
+                    not results_filter.is_selected(*split_path[-4:-2],
+                                                   iteration_name)):
+                continue
             yield from _handle_iteration(src_result['iteration_data'])
     # Process errors
-    for level, src_path in iter_results_errors(path):
+    for level, src_path in iter_results_errors(path, results_filter):
         split_path = src_path.split(os.sep)[-(level + 1): -1]
         split_path = split_path + ['*'] * (3 - level)
         result_id = "/".join(split_path)
@@ -595,6 +739,14 @@ class Modifier:
         """
         raise NotImplementedError
 
+    def add_digest(self, aggregates):
+        """
+        Add reference results aggregated by `ResultsContainer.get_digest`
+
+        :param aggregates: {test_name: [count, score_sum, failures]}
+        """
+        raise NotImplementedError
+
     def _adjust_weight(self, count):
         """
         Adjust the weight based on the number of items
@@ -622,6 +774,11 @@ class AveragesModifier(Modifier):
         self.averages[result.name][1] += 1
         return []
 
+    def add_digest(self, aggregates):
+        for name, (count, score_sum, _) in aggregates.items():
+            self.averages[name][0] += score_sum
+            self.averages[name][1] += count
+
     def check_result(self, result):
         self.add_result(result)
         if result.name in self.averages:
@@ -654,6 +811,12 @@ class NOutOfResultsModifier(Modifier):
             entry[0] += 1
         return []
 
+    def add_digest(self, aggregates):
+        for name, (count, _, failures) in aggregates.items():
+            entry = self.failures[name]
+            entry[0] += failures
+            entry[1] += count
+
     def check_result(self, result):
         self.add_result(result)
         entry = self.failures[result.name]
@@ -670,21 +833,30 @@ class ResultsContainer:
     """
 
     def __init__(self, log, tolerance, stddev_tolerance, models,
-                 src_name, src_path, modifiers):
+                 src_name, src_path, modifiers, primary_only=False,
+                 results_filter=None, digest=False):
+        """
+        :param digest: collect the aggregates required by `get_digest`
+        """
         self.log = log
         self.tolerance = tolerance
         self.stddev_tolerance = stddev_tolerance
         self.models = models
         self.results = collections.OrderedDict()
         self.src_name = src_name
+        self.primary_only = primary_only
+        self.results_filter = results_filter
         self.src_results = {test: (score, primary, params)
-                            for test, score, primary, params in iter_results(src_path, True)}
+                            for test, score, primary, params
+                            in iter_results(src_path, True, primary_only,
+                                            results_filter)}
         for model in self.models:
             for test, params in model.model.items():
                 if "mmin" in params and test in self.src_results:
                     self.src_results[test] = self.src_results[test] + ([params["mmax"], params["mmin"]],)
         self.src_metadata = self._parse_metadata(src_name, src_path)
         self.modifiers = modifiers
+        self.aggregates = {} if digest else None
 
     def __iter__(self):
         return iter(self.results.values())
@@ -695,6 +867,97 @@ class ResultsContainer:
     def __reversed__(self):
         return reversed(self.results.values())
 
+    def get_state(self):
+        """
+        Report the evaluated results in a serializable form
+
+        :note: Models and modifiers are not part of the state, the state
+               is only meant to allow re-rendering the evaluated results.
+        """
+        src_results = [[test, value[0], value[1], list(value[2].items())] +
+                       list(value[3:])
+                       for test, value in self.src_results.items()]
+        return {"version": STATE_VERSION,
+                "tolerance": self.tolerance,
+                "stddev_tolerance": self.stddev_tolerance,
+                "src_name": self.src_name,
+                "src_metadata": dict(self.src_metadata),
+                "src_results": src_results,
+                "results": [[name, res.get_state()]
+                            for name, res in self.results.items()]}
+
+    @classmethod
+    def from_state(cls, log, state):
+        """
+        Restore evaluated results out of the `get_state` output without
+        parsing nor evaluating anything.
+        """
+        if state.get("version") != STATE_VERSION:
+            raise ValueError(f"Unsupported state version {state.get('version')}"
+                             f" (expected {STATE_VERSION})")
+        results = cls.__new__(cls)
+        results.log = log
+        results.tolerance = state["tolerance"]
+        results.stddev_tolerance = state["stddev_tolerance"]
+        results.models = []
+        results.modifiers = []
+        results.src_name = state["src_name"]
+        results.primary_only = False
+        results.results_filter = None
+        results.src_metadata = collections.defaultdict(lambda: "Unknown")
+        results.src_metadata.update(state["src_metadata"])
+        results.src_results = {
+            value[0]: (value[1], value[2], dict(value[3])) + tuple(value[4:])
+            for value in state["src_results"]}
+        results.results = collections.OrderedDict()
+        for name, res_state in state["results"]:
+            results.results[name] = RelativeResults.from_state(
+                log, results.tolerance, results.stddev_tolerance, res_state)
+        return results
+
+    def get_digest(self):
+        """
+        Report the digest of all (reference) results
+
+        It contains per-test aggregates (count, score_sum, failures) used
+        by modifiers, identities of the used models and the per-build
+        score/status of each result used by reports.
+        """
+        if self.aggregates is None:
+            raise RuntimeError("Aggregates are not collected, use "
+                               "ResultsContainer(digest=True)")
+        return {"version": DIGEST_VERSION,
+                "src_name": self.src_name,
+                "tolerance": self.tolerance,
+                "stddev_tolerance": self.stddev_tolerance,
+                "models": [_.get_identity() for _ in self.models],
+                "aggregates": self.aggregates,
+                "builds": [[name, res.get_digest_state()]
+                           for name, res in self.results.items()]}
+
+    def add_digest(self, digest):
+        """
+        Insert reference results out of `get_digest` output
+        """
+        if digest.get("version") != DIGEST_VERSION:
+            raise ValueError("Unsupported digest version "
+                             f"{digest.get('version')} (expected "
+                             f"{DIGEST_VERSION})")
+        for key in ("src_name", "tolerance", "stddev_tolerance"):
+            if digest[key] != getattr(self, key):
+                self.log.warning("Digest was created with %s=%s but %s is "
+                                 "used now, results might be inaccurate",
+                                 key, digest[key], getattr(self, key))
+        models = [_.get_identity() for _ in self.models]
+        if digest["models"] != models:
+            raise ValueError(f"Digest was created with models "
+                             f"{digest['models']} but {models} are used now")
+        for modifier in self.modifiers:
+            modifier.add_digest(digest["aggregates"])
+        for name, state in digest["builds"]:
+            self.results[name] = RelativeResults.from_digest_state(
+                self.log, self.tolerance, self.stddev_tolerance, state)
+
     @staticmethod
     def _parse_metadata(name, path):
         metadata_path = os.path.join(path, "RUNPERF_METADATA")
@@ -718,9 +981,12 @@ class ResultsContainer:
         """
         metadata = self._parse_metadata(name, path)
         res = RelativeResults(self.log, self.tolerance, self.stddev_tolerance,
-                              self.models, self.modifiers, metadata)
+                              self.models, self.modifiers, metadata,
+                              self.aggregates)
         src_tests = list(self.src_results.keys())
-        for test, score, primary, params in iter_results(path, skip_incorrect):
+        for test, score, primary, params in iter_results(path, skip_incorrect,
+                                                         self.primary_only,
+                                                         self.results_filter):
             if test in src_tests:
                 res.record_result(test, self.src_results[test][0],
                                   score, primary, params=params, last=last)
@@ -735,6 +1001,34 @@ class ResultsContainer:
         return res
 
 
+class _XUnitEscapeTable(dict):
+
+    """
+    Lazily populated str.translate table to escape xunit attribute values
+
+    Characters outside of PRINTABLE are reported as "\\xNN", xml special
+    characters are replaced by their entities.
+    """
+
+    def __init__(self):
+        super().__init__({ord('&'): '&amp;', ord('<'): '&lt;',
+                          ord('>'): '&gt;', ord('"'): '&quot;'})
+
+    def __missing__(self, key):
+        char = chr(key)
+        value = char if char in PRINTABLE else f"\\x{key:02x}"
+        self[key] = value
+        return value
+
+
+_XUNIT_ESCAPE_TABLE = _XUnitEscapeTable()
+
+
+def xunit_escape(text):
+    """Escape text to be used as an xunit attribute value"""
+    return str(text).translate(_XUNIT_ESCAPE_TABLE)
+
+
 class RelativeResults:
 
     """
@@ -742,7 +1036,12 @@ class RelativeResults:
     """
 
     def __init__(self, log, mean_tolerance, stddev_tolerance, models,
-                 modifiers, metadata):
+                 modifiers, metadata, aggregates=None):
+        """
+        :param aggregates: dict to collect the aggregates (count, score_sum,
+                           failures) of results passed to modifiers into
+                           (broken records are not included)
+        """
         self.log = log
         self.mean_tolerance = mean_tolerance
         self.stddev_tolerance = stddev_tolerance
@@ -751,6 +1050,49 @@ class RelativeResults:
         self.models = models
         self.modifiers = modifiers
         self.metadata = metadata
+        self.aggregates = aggregates
+
+    def get_state(self):
+        """Report metadata and evaluated records in a serializable form"""
+        return {"metadata": dict(self.metadata),
+                "records": [_.get_state() for _ in self.records],
+                "grouped_records": [_.get_state()
+                                    for _ in self.grouped_records]}
+
+    @classmethod
+    def from_state(cls, log, mean_tolerance, stddev_tolerance, state):
+        """Restore results out of the `get_state` output"""
+        metadata = collections.defaultdict(lambda: "Unknown")
+        metadata.update(state["metadata"])
+        res = cls(log, mean_tolerance, stddev_tolerance, [], [], metadata)
+        res.records = [Result.from_state(_) for _ in state["records"]]
+        res.grouped_records = [Result.from_state(_)
+                               for _ in state["grouped_records"]]
+        return res
+
+    def get_digest_state(self):
+        """
+        Report the build metadata and records used by reports (see
+        `from_digest_state`)
+        """
+        return {"metadata": {key: value
+                             for key, value in self.metadata.items()
+                             if (key in DIGEST_METADATA or
+                                 key.startswith("environment_"))},
+                "records": [_.get_digest_state() for _ in self.records],
+                "grouped_records": [_.get_digest_state()
+                                    for _ in self.grouped_records]}
+
+    @classmethod
+    def from_digest_state(cls, log, mean_tolerance, stddev_tolerance, state):
+        """Restore results out of the `get_digest_state` output"""
+        metadata = collections.defaultdict(lambda: "Unknown")
+        metadata.update(state["metadata"])
+        res = cls(log, mean_tolerance, stddev_tolerance, [], [], metadata)
+        res.records = [Result.from_digest_state(_) for _ in state["records"]]
+        res.grouped_records = [Result.from_digest_state(_)
+                               for _ in state["grouped_records"]]
+        return res
 
     def record(self, result, grouped=False):
         """Insert result into database"""
@@ -803,6 +1145,12 @@ class RelativeResults:
                 raw_weight = 0
                 result.add(i, *mresult)
         result.add("", "raw", difference, raw_weight, src)
+        if self.aggregates is not None:
+            entry = self.aggregates.setdefault(test_name, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += result.score
+            if result.status < 0:
+                entry[2] += 1
         if last:
             for i, modifier in enumerate(self.modifiers):
                 for mresult in modifier.check_result(result):
@@ -813,59 +1161,78 @@ class RelativeResults:
                     result.add("", *mresult)
         return self.record(result, grouped=grouped)
 
-    def get_xunit(self):
-        """
-        Log the header (execute last when dynamic number of tests)
-
-        :param total_tests: Amount of executed tests (None=get from recrods)
+    @staticmethod
+    def _xunit_element_type(status):
+        """Report the xunit element type for a given status (or None)"""
+        if status >= PASS:
+            return None
+        # Use SKIP for gain to better distinguish these in Jenkins
+        if status == FAIL_GAIN:
+            return 'skipped'
+        if status in (FAIL, FAIL_LOSS):
+            return 'failure'
+        return 'error'
+
+    def write_xunit(self, xunit_fd, include_grouped=True):
         """
+        Stream the XUnit/JUnit results into a file-like object
 
-        def _str(text):
-            return ''.join(_ if _ in PRINTABLE else f"\\x{ord(_):02x}"
-                           for _ in str(text))
+        Uses two passes, first one to count the statuses for the testsuite
+        header and second one to write the individual testcases.
 
-        document = Document()
-        testsuite = document.createElement('testsuite')
-        testsuite.setAttribute('name', 'runperf')
-        testsuite.setAttribute('timestamp',
-                               _str(datetime.datetime.now().isoformat()))
-        document.appendChild(testsuite)
-        errors = 0
-        failures = 0
-        skipped = 0
-        for test in self.records + self.grouped_records:
+        :param xunit_fd: text file-like object to write the results to
+        :param include_grouped: Whether to include grouped results
+        """
+        records = self.records
+        if include_grouped:
+            records = records + self.grouped_records
+        counts = {'error': 0, 'failure': 0, 'skipped': 0}
+        primary_count = 0
+        for test in records:
             # Record only primary results
             if not test.primary:
                 continue
-            test_name = test.name.rsplit('/', 1)
-            testcase = document.createElement('testcase')
-            testcase.setAttribute('classname', _str(test_name[0]))
-            testcase.setAttribute('name', _str(test_name[1]))
-            testcase.setAttribute('time', "0.000")
-            status = test.status
-            if status < PASS:
-                # Use SKIP for gain to better distinguish these in Jenkins
-                if status == FAIL_GAIN:
-                    skipped += 1
-                    element_type = 'skipped'
-                elif status in (FAIL, FAIL_LOSS):
-                    failures += 1
-                    element_type = 'failure'
-                else:
-                    errors += 1
-                    element_type = 'error'
-                element = document.createElement(element_type)
-                element.setAttribute('type', _str(element_type))
-                element.setAttribute('message', _str(test.details))
-                testcase.appendChild(element)
-            testsuite.appendChild(testcase)
-
-        testsuite.setAttribute('tests', _str(len(self.records)))
-        testsuite.setAttribute('errors', _str(errors))
-        testsuite.setAttribute('failures', _str(failures))
-        testsuite.setAttribute('skipped', _str(skipped))
-        testsuite.setAttribute('time', "0.000")
-        return document.toprettyxml(encoding='UTF-8')
+            primary_count += 1
+            element_type = self._xunit_element_type(test.status)
+            if element_type:
+                counts[element_type] += 1
+        timestamp = xunit_escape(datetime.datetime.now().isoformat())
+        xunit_fd.write(f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                       f'<testsuite name="runperf" timestamp="{timestamp}" '
+                       f'tests="{len(self.records)}" '
+                       f'errors="{counts["error"]}" '
+                       f'failures="{counts["failure"]}" '
+                       f'skipped="{counts["skipped"]}" time="0.000"')
+        if not primary_count:
+            xunit_fd.write('/>\n')
+            return
+        xunit_fd.write('>\n')
+        for test in records:
+            if not test.primary:
+                continue
+            classname, name = test.name.rsplit('/', 1)
+            testcase = (f'\t<testcase classname="{xunit_escape(classname)}" '
+                        f'name="{xunit_escape(name)}" time="0.000"')
+            element_type = self._xunit_element_type(test.status)
+            if element_type:
+                xunit_fd.write(f'{testcase}>\n\t\t<{element_type} '
+                               f'type="{element_type}" '
+                               f'message="{xunit_escape(test.details)}"/>\n'
+                               '\t</testcase>\n')
+            else:
+                xunit_fd.write(f'{testcase}/>\n')
+        xunit_fd.write('</testsuite>\n')
+
+    def get_xunit(self, include_grouped=True):
+        """
+        Report the XUnit/JUnit results (see `write_xunit`)
+
+        :param include_grouped: Whether to include grouped results
+        :return: utf-8 encoded xunit results
+        """
+        xunit_fd = io.StringIO()
+        self.write_xunit(xunit_fd, include_grouped)
+        return xunit_fd.getvalue().encode("utf-8")
 
     def per_type_stats(self, merge=None, primary_only=True):
         """
@@ -1063,13 +1430,58 @@ class RelativeResults:
         return 0
 
 
-def closest_result(src_path, dst_path_groups, flatten_coefficient=1):
+def dump_state(results, path):
+    """
+    Store the evaluated `ResultsContainer` into a gzip compressed json file
+
+    :param results: `ResultsContainer` instance (ideally evaluated)
+    :param path: Path to the output file
+    """
+    with gzip.open(path, 'wt', encoding="utf-8") as state_fd:
+        json.dump(results.get_state(), state_fd, separators=(',', ':'))
+
+
+def load_state(log, path):
+    """
+    Load `ResultsContainer` previously stored by `dump_state`
+
+    :param log: logger to be used by the results
+    :param path: Path to the state file
+    """
+    with gzip.open(path, 'rt', encoding="utf-8") as state_fd:
+        return ResultsContainer.from_state(log, json.load(state_fd))
+
+
+def dump_digest(results, path):
+    """
+    Store the reference builds digest into a gzip compressed json file
+
+    :param results: `ResultsContainer` instance with reference results
+    :param path: Path to the output file
+    """
+    with gzip.open(path, 'wt', encoding="utf-8") as digest_fd:
+        json.dump(results.get_digest(), digest_fd, separators=(',', ':'))
+
+
+def load_digest(path):
+    """
+    Load the reference builds digest stored by `dump_digest`
+
+    :param path: Path to the digest file
+    """
+    with gzip.open(path, 'rt', encoding="utf-8") as digest_fd:
+        return json.load(digest_fd)
+
+
+def closest_result(src_path, dst_path_groups, flatten_coefficient=1,
+                   results_filter=None):
     """
     Compare results and find the one that has more results closer to the src
     one
 
     :param src_path: Path to the src result
     :param dst_paths: List of paths to results we are comparing to
+    :param results_filter: `ResultsFilter` to select only some results
     """
     def norm_normpdf(x, mean, sd):  # Using math symbols pylint: disable=C0103
         """
@@ -1109,7 +1521,8 @@ def closest_result(src_path, dst_path_groups, flatten_coefficient=1):
         storage = collections.defaultdict(
             lambda: [[None, None] for _ in range(len(dst_paths))])
         for idx, path in enumerate(dst_paths):
-            for test, score, _, _ in iter_results(path, True):
+            for test, score, _, _ in iter_results(path, True,
+                                                  results_filter=results_filter):
                 if test.endswith("stddev"):
                     # Skip stddev = 0 as that is basically no stddev
                     if score == 0:
@@ -1246,7 +1659,8 @@ def closest_result(src_path, dst_path_groups, flatten_coefficient=1):
 
     def _process_src(src_path):
         src = {}
-        for test, score, primary, _ in iter_results(src_path, True):
+        for test, score, primary, _ in iter_results(
+                src_path, True, results_filter=results_filter):
             if test.endswith("stddev"):
                 name = test[:-7]
                 if name not in src:
@@ -43,32 +43,40 @@ class BaseTest:
             os.makedirs(base_output_path)
         self.output = tempfile.mkdtemp(prefix="tmp", dir=base_output_path)
         self.metadata = metadata
+        # Per-machine time it took the machine to calm down before testing
+        self.settle_times = {}
 
     def setup(self):
         """
         Allow extra steps before test execution
         """
 
+    def _all_workers(self):
+        """
+        Report list of all (unique) workers
+        """
+        out = []
+        for workers in self.workers:
+            for worker in workers:
+                if worker not in out:
+                    out.append(worker)
+        return out
+
     def _all_machines_kmsg(self, msg):
         """
         Log a message on all workers' as well as host's kmsg
         """
-        sessions = []
-        try:
-            sessions.append(self.host.get_session())
-            for workers in self.workers:
-                for worker in workers:
-                    sessions.append(worker.get_session(hop=self.host))
-            msg = f"C{time.time():.0f}: {self.host.profile.name}: {msg}"
-            cmd = f"echo runperf: W$(date +%s): {shlex.quote(msg)} > /dev/kmsg"
-            for session in sessions:
-                session.sendline(cmd)
-            for session in sessions:
-                # Ensure all commands finished
-                session.cmd("true")
-        finally:
-            for session in sessions:
-                session.close()
+        def kmsg(machine):
+            hop = None if machine is self.host else self.host
+            with machine.get_session_cont(hop=hop, reuse=True) as session:
+                session.cmd(cmd)
+
+        msg = f"C{time.time():.0f}: {self.host.profile.name}: {msg}"
+        cmd = f"echo runperf: W$(date +%s): {shlex.quote(msg)} > /dev/kmsg"
+        machines = self._all_workers()
+        if self.host not in machines:
+            machines.insert(0, self.host)
+        utils.fan_out(machines, kmsg, timeout=600)
 
     def run(self):
         """Run the testing"""
@@ -106,13 +114,13 @@ class BaseTest:
             str_workers[i] = {worker.name: worker.get_info()
                               for worker in workers}
         meta['workers'] = str_workers
+        if self.settle_times:
+            meta['settle_times'] = self.settle_times
         dir_path = os.path.dirname(path)
         if session.cmd_status(f"[ -d '{dir_path}' ]") == 0:
             result_path = os.path.join(dir_path, "RUNPERF_METADATA.json")
             results_json = json.dumps(meta, indent=4, sort_keys=True)
-            utils.shell_write_content(
-                lambda cmd: session.cmd(cmd, timeout=600, print_func='mute'),
-                result_path, results_json)
+            self.host.write_file(result_path, results_json, session=session)
 
     def cleanup(self):
         """
@@ -134,7 +142,7 @@ class DummyTest(BaseTest):
                                    "result.json"),
                       encoding="utf-8") as src:
                 result.write(src.read() % {"hostname": self.host.get_addr()})
-        with self.host.get_session_cont() as session:
+        with self.host.get_session_cont(reuse=True) as session:
             self.inject_metadata(session, result_path)
 
 
@@ -239,7 +247,7 @@ class PBenchTest(BaseTest):
                                        f"{failed}") from thread.exc
                 raise RuntimeError(f"Failed to install pbench on {failed}")
         # Register the tools for all workers
-        with self.host.get_session_cont() as session:
+        with self.host.get_session_cont(reuse=True) as session:
             pbench.register_tools(session, self.pbench_tools, remotes)
         self._wait_for_workers_calm_down()
 
@@ -247,18 +255,15 @@ class PBenchTest(BaseTest):
         """
         Wait for the machines to calm down before the testing and use
         hop=self.host as the host will be executing the ssh commands.
+
+        All machines are checked concurrently and the per-machine settle
+        times are stored in the test metadata.
         """
-        for workers in self.workers:
-            for worker in workers:
-                with worker.get_session_cont(hop=self.host) as session:
-                    if not utils.wait_for_machine_calms_down(session,
-                                                             timeout=1800):
-                        worker.log.warning("Worker did not stabilize in 1800s,"
-                                           " proceeding on a loaded machine!")
-        with self.host.get_session_cont(hop=self.host) as session:
-            if not utils.wait_for_machine_calms_down(session, timeout=1800):
-                self.host.log.warning("Host did not stabilize in 1800s,"
-                                      " proceeding on a loaded machine!")
+        machines = self._all_workers()
+        if self.host not in machines:
+            machines.append(self.host)
+        self.settle_times = utils.wait_for_machines_calm_down(
+            machines, timeout=1800, hop=self.host)
 
     def _pbench_destructive_cleanup_on_failure(self, session):
         """
@@ -273,38 +278,41 @@ class PBenchTest(BaseTest):
                     "gpg-agent scdaemon fio uperf linpack; do "
                     "killall -9 $NAME; done")
         session.cmd_status(nuke_cmd)
-        for workers in self.workers:
-            for worker in workers:
-                with worker.get_session_cont(hop=self.host) as wsession:
-                    wsession.cmd_status(nuke_cmd)
+        utils.fan_out_cmd(self._all_workers(), nuke_cmd, hop=self.host)
 
     @staticmethod
-    def _run_with_watchdog(cmd, session, timeout, watchdog_timeout):
+    def _run_with_watchdog(cmd, session, timeout, watchdog_timeout,
+                           output_path=None):
         """
         Run a command while reading it's output ensuring it keeps producing
         output at least every `watchdog_timeout`s
+
+        :param output_path: file to stream the full output into (only the
+                            tail is kept in memory)
         """
         session.read_nonblocking(0.2, 10)
         session.sendline(cmd)
         end_time = time.time() + timeout
         watchdog_next = time.time() + watchdog_timeout
         re_prompt = re.compile(session.prompt)
-        output = ""
-        while time.time() < end_time:
-            out = session.read_nonblocking(1, min(1, end_time - time.time()))
-            if not out:
-                if watchdog_next <= time.time():
-                    raise RuntimeError(f"Output of {cmd} stalled for more "
-                                       f"than {watchdog_timeout}s. Output so "
-                                       "far:\n\n" + output)
-                continue
-            output += out
-            nonempty_lines = [_ for _ in output.splitlines() if _.strip()]
-            if nonempty_lines and re_prompt.search(nonempty_lines[-1]):
-                return output
-            watchdog_next = time.time() + watchdog_timeout
-        raise RuntimeError(f"{cmd} execution took longer than the {timeout}s. "
-                           "output so far:\n\n" + output)
+        with utils.OutputTail(output_path) as output:
+            while time.time() < end_time:
+                out = session.read_nonblocking(1, min(1, end_time -
+                                                      time.time()))
+                if not out:
+                    if watchdog_next <= time.time():
+                        raise RuntimeError(f"Output of {cmd} stalled for more"
+                                           f" than {watchdog_timeout}s. "
+                                           "Output so far:\n\n" +
+                                           output.get_tail())
+                    continue
+                output.feed(out)
+                if re_prompt.search(output.last_nonempty_line()):
+                    return output.get_tail()
+                watchdog_next = time.time() + watchdog_timeout
+            raise RuntimeError(f"{cmd} execution took longer than the "
+                               f"{timeout}s. output so far:\n\n" +
+                               output.get_tail())
 
     def _run(self):
         # We only need one group of workers
@@ -327,7 +335,9 @@ class PBenchTest(BaseTest):
                     self.host.log.debug("Sending command: %s", cmd)
                     self._run_with_watchdog(cmd, session,
                                             self.timeout,
-                                            self.watchdog_timeout)
+                                            self.watchdog_timeout,
+                                            os.path.join(self.output,
+                                                         "watchdog_output.log"))
                 else:
                     session.cmd_output(prefix + self._cmd,
                                        timeout=self.timeout)
@@ -397,7 +407,7 @@ class Linpack(PBenchTest):
 
     def _run(self):
         # For pbench-agent<=0.69 use pbench-run-benchmark to support clients
-        with self.host.get_session_cont() as session:
+        with self.host.get_session_cont(reuse=True) as session:
             pbench_help = session.cmd_output("pbench-linpack -h")
             # When linpack is not specified by the user we need to detect
             # and append it now as it was probably installed during
@@ -493,41 +503,50 @@ class PBenchNBD(PBenchFio):
                   encoding="utf-8") as fio:
             fio_tpl = utils.shell_write_content_cmd(self.fio_job_file,
                                                     fio.read())
-        for workers in self.workers:
-            for worker in workers:
-                with worker.get_session_cont() as session:
-                    session.runperf_stage("Start NBD listener")
-                    session.cmd("mkdir -p " + self.base_path)
-                    session.cmd(fio_check_tpl)
-                    ret = session.cmd_status(
-                        f"fio --parse-only {self.base_path}/nbd-check.fio")
-                    if ret:
-                        raise exceptions.TestSkip(
-                            f"Fio {session.cmd('which fio')} does not support "
-                            f"ioengine=nbd on worker {worker}")
-                    session.cmd("dd bs=1M count=256 if=/dev/urandom "
-                                f"of='{self.base_path}/disk.img'")
-                    session.cmd(f"nohup qemu-nbd -t -k {self.base_path}/socket"
-                                f" -f raw {self.base_path}/disk.img &> "
-                                f"$(mktemp {self.base_path}/qemu_nbd_XXXX.log)"
-                                f" & echo $! >> {self.base_path}/kill_pids")
-                    # Sometimes nohup is not enough, use disown
-                    session.cmd(f"for PID in $(cat {self.base_path}/kill_pids)"
-                                "; do disown -h $PID; done")
-        with self.host.get_session_cont(hop=self.host) as session:
+
+        def setup_worker(worker):
+            with worker.get_session_cont() as session:
+                session.runperf_stage("Start NBD listener")
+                session.cmd("mkdir -p " + self.base_path)
+                session.cmd(fio_check_tpl)
+                ret = session.cmd_status(
+                    f"fio --parse-only {self.base_path}/nbd-check.fio")
+                if ret:
+                    raise exceptions.TestSkip(
+                        f"Fio {session.cmd('which fio')} does not support "
+                        f"ioengine=nbd on worker {worker}")
+                session.cmd("dd bs=1M count=256 if=/dev/urandom "
+                            f"of='{self.base_path}/disk.img'")
+                session.cmd(f"nohup qemu-nbd -t -k {self.base_path}/socket"
+                            f" -f raw {self.base_path}/disk.img &> "
+                            f"$(mktemp {self.base_path}/qemu_nbd_XXXX.log)"
+                            f" & echo $! >> {self.base_path}/kill_pids")
+                # Sometimes nohup is not enough, use disown
+                session.cmd(f"for PID in $(cat {self.base_path}/kill_pids)"
+                            "; do disown -h $PID; done")
+
+        try:
+            utils.fan_out(self._all_workers(), setup_worker)
+        except exceptions.FanOutError as exc:
+            for err in exc.errors.values():
+                if isinstance(err, exceptions.TestSkip):
+                    raise err from exc
+            raise
+        with self.host.get_session_cont(hop=self.host, reuse=True) as session:
             session.cmd("mkdir -p " + self.base_path)
             session.cmd(fio_tpl)
 
     def cleanup(self):
-        for workers in self.workers:
-            for worker in workers:
-                with worker.get_session_cont() as session:
-                    pids = session.cmd(f"cat {self.base_path}/kill_pids "
-                                       "2>/dev/null || true")
-                    for pid in pids.splitlines():
-                        session.cmd_status(f"kill -9 '{pid}'")
-                    session.cmd("rm -Rf " + self.base_path)
-        with self.host.get_session_cont(hop=self.host) as session:
+        def cleanup_worker(worker):
+            with worker.get_session_cont(reuse=True) as session:
+                pids = session.cmd(f"cat {self.base_path}/kill_pids "
+                                   "2>/dev/null || true")
+                for pid in pids.splitlines():
+                    session.cmd_status(f"kill -9 '{pid}'")
+                session.cmd("rm -Rf " + self.base_path)
+
+        utils.fan_out(self._all_workers(), cleanup_worker)
+        with self.host.get_session_cont(hop=self.host, reuse=True) as session:
             session.cmd(f"rm -Rf {self.base_path}")
         PBenchFio.cleanup(self)
 
@@ -588,37 +607,40 @@ class PBenchLibblkio(PBenchFio):
                   encoding="utf-8") as fio:
             fio_tpl = utils.shell_write_content_cmd(
                 self.fio_job_file, fio.read() % self._params["hipri"])
-        for workers in self.workers:
-            for worker in workers:
-                with worker.get_session_cont() as session:
-                    session.runperf_stage("Start libblkio export")
-                    if self._params.get("setup_ramdisk"):
-                        session.cmd("modprobe brd rd_nr=1 rd_size=1048576 "
-                                    "max_part=0")
-                    session.cmd("mkdir -p " + self.base_path)
-                    session.cmd(f"nohup {self._params['storage_daemon_cmd']} "
-                                "&> "
-                                f"$(mktemp {self.base_path}/libblkio_XXXX.log)"
-                                f" & echo $! >> {self.base_path}/kill_pids")
-                    # Sometimes nohup is not enough, use disown
-                    session.cmd(f"for PID in $(cat {self.base_path}/kill_pids)"
-                                "; do disown -h $PID; done")
-        with self.host.get_session_cont(hop=self.host) as session:
+
+        def setup_worker(worker):
+            with worker.get_session_cont() as session:
+                session.runperf_stage("Start libblkio export")
+                if self._params.get("setup_ramdisk"):
+                    session.cmd("modprobe brd rd_nr=1 rd_size=1048576 "
+                                "max_part=0")
+                session.cmd("mkdir -p " + self.base_path)
+                session.cmd(f"nohup {self._params['storage_daemon_cmd']} "
+                            "&> "
+                            f"$(mktemp {self.base_path}/libblkio_XXXX.log)"
+                            f" & echo $! >> {self.base_path}/kill_pids")
+                # Sometimes nohup is not enough, use disown
+                session.cmd(f"for PID in $(cat {self.base_path}/kill_pids)"
+                            "; do disown -h $PID; done")
+
+        utils.fan_out(self._all_workers(), setup_worker)
+        with self.host.get_session_cont(hop=self.host, reuse=True) as session:
             session.cmd("mkdir -p " + self.base_path)
             session.cmd(fio_tpl)
 
     def cleanup(self):
-        for workers in self.workers:
-            for worker in workers:
-                with worker.get_session_cont() as session:
-                    pids = session.cmd(f"cat {self.base_path}/kill_pids "
-                                       "2>/dev/null || true")
-                    for pid in pids.splitlines():
-                        session.cmd_status(f"kill -9 '{pid}'")
-                    if self._params.get("setup_ramdisk"):
-                        session.cmd_status("rmmod brd")
-                    session.cmd("rm -Rf " + self.base_path)
-        with self.host.get_session_cont(hop=self.host) as session:
+        def cleanup_worker(worker):
+            with worker.get_session_cont(reuse=True) as session:
+                pids = session.cmd(f"cat {self.base_path}/kill_pids "
+                                   "2>/dev/null || true")
+                for pid in pids.splitlines():
+                    session.cmd_status(f"kill -9 '{pid}'")
+                if self._params.get("setup_ramdisk"):
+                    session.cmd_status("rmmod brd")
+                session.cmd("rm -Rf " + self.base_path)
+
+        utils.fan_out(self._all_workers(), cleanup_worker)
+        with self.host.get_session_cont(hop=self.host, reuse=True) as session:
             session.cmd(f"rm -Rf {self.base_path}")
         PBenchFio.cleanup(self)
 
@@ -14,13 +14,21 @@
 # Author: Lukas Doktor <ldoktor@redhat.com>
 # Some of the methods are inspired by https://github.com/avocado-framework/
 #     avocado/tree/master/avocado/utils
+import atexit
+import base64
+import collections
+import contextlib
 import errno
 import glob
+import gzip
 import hashlib
 import itertools
+import json
 import logging
 import os
+import queue
 import random
+import re
 import shlex
 import shutil
 import string
@@ -29,10 +37,19 @@ import sys
 import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
 from importlib.metadata import entry_points
 
 import aexpect
 
+from .. import exceptions
+
+#: Name of the file (inside the results root) to store the operations trace
+TRACE_FILE = "RUNPERF_TRACE.jsonl"
+TIMELINE_FILE = "RUNPERF_TIMELINE.jsonl"
+#: Maximum length of the command stored in the operations trace
+TRACE_CMD_LENGTH = 200
+
 
 # : String containing all fs-unfriendly chars (Windows-fat/Linux-ext3)
 FS_UNSAFE_CHARS = '<>:"/\\|?*;'
@@ -58,6 +75,184 @@ class ThreadWithStatus(threading.Thread):
             self.exc = exc
 
 
+class FanOutExecutor:
+    """
+    Bounded thread pool shared by all `fan_out` calls
+
+    Tasks submitted from within another fan-out task are executed by
+    a dedicated executor to avoid exhausting the shared pool.
+    """
+
+    def __init__(self, max_workers=32):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _run(self, func, args, kwargs):
+        self._local.active = True
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._local.active = False
+
+    def submit_all(self, tasks, dedicated=False):
+        """
+        Submit all tasks for execution
+
+        :param tasks: list of (func, args, kwargs) tasks
+        :param dedicated: execute the tasks by a dedicated executor (eg.
+                          when they might outlive the caller)
+        :return: list of futures (in the order of tasks)
+        """
+        nested = getattr(self._local, "active", False)
+        if dedicated or nested:
+            prefix = "fan-out-nested" if nested else "fan-out-dedicated"
+            executor = ThreadPoolExecutor(max(len(tasks), 1),
+                                          thread_name_prefix=prefix)
+            futures = [executor.submit(self._run, *task) for task in tasks]
+            executor.shutdown(wait=False)
+            return futures
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="fan-out")
+        return [self._executor.submit(self._run, *task) for task in tasks]
+
+
+FAN_OUT_EXECUTOR = FanOutExecutor()
+
+
+def fan_out(machines, func, args=tuple(), kwargs=None, timeout=None):
+    """
+    Run ``func(machine, *args, **kwargs)`` on all machines concurrently
+
+    :param machines: list of machines
+    :param func: callable to be executed per each machine
+    :param args: positional arguments forwarded to the func
+    :param kwargs: key word arguments forwarded to the func
+    :param timeout: overall timeout in seconds (None means no limit)
+    :return: list of per-machine results (in the order of machines)
+    :raise exceptions.FanOutError: when any of the tasks failed or did
+                                   not finish in time
+    :note: Threads can not be interrupted, tasks that did not finish in
+           time keep running in background until they finish on their own
+           and their results are discarded. To not block the shared pool
+           the tasks are executed by a dedicated executor when timeout
+           is set.
+    """
+    if kwargs is None:
+        kwargs = {}
+    futures = FAN_OUT_EXECUTOR.submit_all([(func, (machine,) + tuple(args),
+                                            kwargs)
+                                           for machine in machines],
+                                          dedicated=timeout is not None)
+    done = futures_wait(futures, timeout).done
+    results = []
+    errors = {}
+    for machine, future in zip(machines, futures):
+        if future not in done:
+            errors[machine] = TimeoutError(f"Task {func} did not finish in "
+                                           f"{timeout}s")
+            results.append(None)
+        elif future.exception() is not None:
+            errors[machine] = future.exception()
+            results.append(None)
+        else:
+            results.append(future.result())
+    if errors:
+        raise exceptions.FanOutError(errors,
+                                     results) from next(iter(errors.values()))
+    return results
+
+
+def fan_out_cmd(machines, cmd, timeout=60, hop=None):
+    """
+    Run a command on all machines concurrently
+
+    :param machines: list of machines
+    :param cmd: command to be executed
+    :param timeout: per-machine command timeout
+    :param hop: ssh proxy machine to be used for the sessions
+    :return: list of per-machine (status, output) tuples
+    :raise exceptions.FanOutError: when any of the executions failed
+    """
+    def run(machine):
+        with machine.get_session_cont(hop=hop) as session:
+            return session.cmd_status_output(cmd, timeout=timeout)
+
+    return fan_out(machines, run)
+
+
+class OutputTail:
+    """
+    Incremental reader of a (possibly endless) command output
+
+    Only the last ``max_lines`` complete lines are kept in memory, the full
+    output is optionally streamed into a file.
+    """
+
+    def __init__(self, path=None, max_lines=200):
+        """
+        :param path: path to a file to stream the full output into
+        :param max_lines: number of lines to be kept in memory
+        """
+        self.lines = collections.deque(maxlen=max_lines)
+        self.partial = ""
+        self.last_nonempty = ""
+        self.path = path
+        self._fd = (open(path, "w", encoding="utf-8")  # pylint: disable=R1732
+                    if path else None)
+
+    def feed(self, data):
+        """
+        Process new chunk of output
+        """
+        if self._fd:
+            self._fd.write(data)
+            self._fd.flush()
+        lines = (self.partial + data).splitlines(True)
+        if lines and lines[-1] == lines[-1].rstrip("\r\n"):
+            self.partial = lines.pop()
+        else:
+            self.partial = ""
+        for line in lines:
+            self.lines.append(line)
+            if line.strip():
+                self.last_nonempty = line.rstrip("\r\n")
+
+    def last_nonempty_line(self):
+        """
+        Report the last non-empty line (including the incomplete one)
+        """
+        if self.partial.strip():
+            return self.partial
+        return self.last_nonempty
+
+    def get_tail(self):
+        """
+        Report the tail of the output (with pointer to the full output)
+        """
+        out = "".join(self.lines) + self.partial
+        if self.path:
+            return f"(full output: {self.path})\n...\n{out}"
+        return out
+
+    def close(self):
+        """
+        Close the output file
+        """
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class MutableShellSession(aexpect.ShellSession):  # lgtm [py/missing-call-to-init]
     """
     Mute-able aexpect.ShellSession
@@ -86,7 +281,7 @@ class MutableShellSession(aexpect.ShellSession):  # lgtm [py/missing-call-to-ini
         aexpect.ShellSession.send(self, cont=cont)
 
     def _muted(self, cmd):
-        def inner(*args, **kwargs):
+        def muted(*args, **kwargs):
             if kwargs.get('print_func') == 'mute':
                 kwargs['print_func'] = None
                 logger = logging.getLogger()
@@ -99,15 +294,27 @@ class MutableShellSession(aexpect.ShellSession):  # lgtm [py/missing-call-to-ini
                     self.set_output_func(self.__output_func)
             return cmd(*args, **kwargs)
 
+        def inner(*args, **kwargs):
+            machine = os.path.basename(self.name) if self.name else ""
+            with CONTEXT.trace(cmd.__name__, machine,
+                               args[0] if args else kwargs.get("cmd")):
+                return muted(*args, **kwargs)
+
         return inner
 
 
 class ContextManager:
     """
     Object to keep track of the current path
+
+    The content passed to ``store`` is written asynchronously by
+    a background thread, use ``flush`` to ensure everything was written
+    (this is done automatically on path changes and on exit).
     """
     profile = 0
     test = 1
+    # Maximum number of files kept open by the background writer
+    max_open_files = 64
 
     def __init__(self, log, root=None):
         self.log = log
@@ -115,10 +322,69 @@ class ContextManager:
         self._levels = []
         self._current = root
         self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._trace_local = threading.local()
+
+    def _start_writer(self):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop,
+                                                name="context-writer",
+                                                daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _write_loop(self):
+        """
+        Write the queued content using per-file buffered writers
+        """
+        files = collections.OrderedDict()
+        while True:
+            try:
+                path, content = self._queue.get(timeout=1)
+            except queue.Empty:
+                for out in files.values():
+                    out.flush()
+                continue
+            if path is None:
+                # Flush request, close all files and notify the requester
+                for out in files.values():
+                    out.close()
+                files.clear()
+                content.set()
+                continue
+            try:
+                out = files.pop(path, None)
+                if out is None:
+                    if len(files) >= self.max_open_files:
+                        files.popitem(last=False)[1].close()
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    out = open(path, 'a',  # pylint: disable=R1732
+                               encoding='utf-8')
+                files[path] = out
+                out.write(content)  # lgtm [py/clear-text-storage-sensitive-data]
+            except OSError as details:
+                logging.getLogger("Context").warning(
+                    "Failed to store content to %s: %s", path, details)
+
+    def flush(self, timeout=60):
+        """
+        Wait until all stored content is written
+
+        :param timeout: maximum time to wait for the background writer
+        :return: True when everything was written, False on timeout
+        """
+        if self._writer is None:
+            return True
+        done = threading.Event()
+        self._queue.put((None, done))
+        return done.wait(timeout)
 
     def _update_current(self, msg):
         if not self._root:
             raise RuntimeError("Root not set")
+        self.flush()
         new_path = os.path.join(self._root, *self._levels)
         if not os.path.exists(new_path):
             try:
@@ -169,17 +435,76 @@ class ContextManager:
         return self._current
 
     def store(self, path, content):
-        """Append $content to a file inside a dir structure"""
-        path = os.path.join(self._current, path)
-        dirname = os.path.dirname(path)
-        if not os.path.exists(dirname):
-            try:
-                os.makedirs(dirname)
-            except FileExistsError:
-                pass
-        with self._lock:
-            with open(path, 'a', encoding='utf-8') as output:
-                output.write(content)  # lgtm [py/clear-text-storage-sensitive-data]
+        """Append $content to a file inside a dir structure (asynchronously)"""
+        if self._writer is None:
+            self._start_writer()
+        self._queue.put((os.path.join(self._current, path), content))
+
+    @contextlib.contextmanager
+    def trace(self, kind, machine, cmd):
+        """
+        Record the duration of an operation into the $root/TRACE_FILE
+
+        Nested operations (eg. check_output executed by copy_to) are
+        only recorded as part of the outer one.
+
+        :param kind: type of the operation (eg. cmd_output, copy_to)
+        :param machine: name of the machine the operation is executed on
+        :param cmd: command (or other operation description)
+        """
+        if getattr(self._trace_local, "active", False) or not self._root:
+            yield
+            return
+        if isinstance(cmd, (list, tuple)):
+            cmd = " ".join(shlex.quote(str(_)) for _ in cmd)
+        self._trace_local.active = True
+        start = time.time()
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        finally:
+            self._trace_local.active = False
+            record = {"start": round(start, 3),
+                      "duration": round(time.time() - start, 3),
+                      "kind": kind, "machine": machine,
+                      "stage": "/".join(self._levels), "status": status,
+                      "cmd": str(cmd)[:TRACE_CMD_LENGTH]}
+            self._store_record(TRACE_FILE, record)
+
+    @contextlib.contextmanager
+    def phase(self, name, host, **details):
+        """
+        Record the wall-clock start and end of a phase into the
+        $root/TIMELINE_FILE
+
+        :param name: name of the phase (eg. setup, apply_profile, reboot)
+        :param host: name of the host the phase is executed on (use
+                     "controller" for phases involving all hosts)
+        :param details: extra details to be stored (eg. profile, attempt)
+        """
+        if not self._root:
+            yield
+            return
+        start = time.time()
+        status = "error"
+        try:
+            yield
+            status = "ok"
+        finally:
+            record = {"phase": name, "host": str(host),
+                      "start": round(start, 3), "end": round(time.time(), 3),
+                      "status": status}
+            record.update((key, value) for key, value in details.items()
+                          if value is not None)
+            self._store_record(TIMELINE_FILE, record)
+
+    def _store_record(self, name, record):
+        """Append json record as a line into $root/$name (asynchronously)"""
+        if self._writer is None:
+            self._start_writer()
+        self._queue.put((os.path.join(self._root, name),
+                         json.dumps(record, separators=(',', ':')) + "\n"))
 
 
 CONTEXT = ContextManager(logging.getLogger("Context").info)
@@ -264,7 +589,9 @@ def check_output(*args, **kwargs):
                    * when stderr is not present, subprocess.STDOUT is used
     :raise RuntimeError: In case of subprocess.CalledProcessError
     """
-    with open(os.devnull, "r+", encoding="utf-8") as devnull:
+    with open(os.devnull, "r+", encoding="utf-8") as devnull, \
+            CONTEXT.trace("check_output", "controller",
+                          args[0] if args else kwargs.get("args")):
         if "stderr" not in kwargs:
             kwargs["stderr"] = subprocess.STDOUT
         if "stdin" not in kwargs:
@@ -283,7 +610,8 @@ def check_output(*args, **kwargs):
             raise RuntimeError(f"{exc}\n{exc.output}") from exc
 
 
-def wait_for(func, timeout, step=1.0, args=None, kwargs=None):
+def wait_for(func, timeout, step=1.0, args=None, kwargs=None, backoff=1.0,
+             max_step=None):
     """
     Wait until func() evaluates to True.
 
@@ -293,6 +621,8 @@ def wait_for(func, timeout, step=1.0, args=None, kwargs=None):
     :param timeout: Timeout in seconds
     :param first: Time to sleep before first attempt
     :param step: Time to sleep between attempts in seconds
+    :param backoff: Multiply the step by this factor after each attempt
+    :param max_step: Upper limit of the step when using backoff
     :param text: Text to print while waiting, for debug purposes
     :param args: Positional arguments to func
     :param kwargs: Keyword arguments to func
@@ -309,6 +639,9 @@ def wait_for(func, timeout, step=1.0, args=None, kwargs=None):
             return output
 
         time.sleep(step)
+        step *= backoff
+        if max_step is not None:
+            step = min(step, max_step)
 
     return None
 
@@ -452,7 +785,8 @@ def shell_write_content_cmd(path, content, append=False):
     """
     Generate shell cmd to safely write/append content to file
 
-    With big files it might fail, use ``shell_write_content`` in such cases.
+    With big files it might fail, use ``shell_write_content_bulk_cmd`` in
+    such cases.
     """
     while True:
         eof = random_string(6)
@@ -490,6 +824,117 @@ def shell_write_content(run, path, content, append=False):
     run(shell_write_content_cmd(path, '', True))
 
 
+def shell_write_content_bulk_cmd(path, content, append=False):
+    """
+    Generate shell cmd to write/append (big) content to file in one go
+
+    The content is sent as a compressed base64 stream (wrapped into short
+    lines to fit the terminal limits) and its sha256 checksum is verified
+    before the destination file is touched. Similarly to
+    ``shell_write_content_cmd`` an extra newline is added to the content.
+    """
+    data = (content + "\n").encode("utf-8")
+    checksum = hashlib.sha256(data).hexdigest()
+    payload = base64.encodebytes(gzip.compress(data, mtime=0)).decode("ascii")
+    # "_" is not part of the base64 alphabet
+    eof = "RUNPERF_EOF"
+    return (f"RP_TMP=$(mktemp) && base64 -d << \\{eof} | gzip -dc > "
+            f"\"$RP_TMP\" && [ \"$(sha256sum < \"$RP_TMP\")\" = "
+            f"'{checksum}  -' ] && cat \"$RP_TMP\" "
+            f"{'>>' if append else '>'} {shlex.quote(path)}; RP_RET=$?; "
+            f"rm -f \"$RP_TMP\"; [ $RP_RET -eq 0 ]\n{payload}{eof}")
+
+
+def shell_batch_cmd(cmds, cmd_timeout=None):
+    """
+    Generate shell cmd to execute multiple commands in one go
+
+    Each command is executed in a subshell with stdin redirected from
+    /dev/null and its (stdout+stderr) output is reported as a base64
+    encoded section prefixed by "RUNPERF_BATCH:$index:$status:$length"
+    line. Use ``parse_batch_output`` to demultiplex the output.
+
+    :param cmds: list of commands
+    :param cmd_timeout: per-command timeout (commands are interrupted by
+                        the ``timeout`` utility and report status 124)
+    """
+    script = ["(", "RP_TMP=$(mktemp)"]
+    for i, cmd in enumerate(cmds):
+        if cmd_timeout:
+            cmd = f"timeout -k 5 {cmd_timeout} sh -c {shlex.quote(cmd)}"
+        script.append(f"( {cmd}\n) > \"$RP_TMP\" 2>&1 < /dev/null; RP_RET=$?; "
+                      "base64 -w0 < \"$RP_TMP\" > \"$RP_TMP.b64\"; "
+                      f"echo \"RUNPERF_BATCH:{i}:$RP_RET:"
+                      "$(wc -c < \"$RP_TMP.b64\")\"; cat \"$RP_TMP.b64\"; echo")
+    script.append("rm -f \"$RP_TMP\" \"$RP_TMP.b64\"")
+    script.append(")")
+    return "\n".join(script)
+
+
+# Not anchored to the line start as the output might follow a prompt
+_RE_BATCH_SECTION = re.compile(r"RUNPERF_BATCH:(\d+):(\d+):\s*(\d+)\r?\n"
+                               r"([A-Za-z0-9+/=]*)")
+
+
+def parse_batch_output(output, count, ignore_all_errors=False):
+    """
+    Demultiplex the output of ``shell_batch_cmd``
+
+    :param output: output of the ``shell_batch_cmd`` command
+    :param count: number of commands
+    :param ignore_all_errors: report missing/corrupted sections as
+                              (None, "") instead of raising an exception
+    :return: list of (status, output) per each command
+    :raise ValueError: when any section is missing or incomplete
+    """
+    results = [None] * count
+    for match in _RE_BATCH_SECTION.finditer(output):
+        idx, status, length, data = match.groups()
+        idx = int(idx)
+        if idx >= count or len(data) != int(length):
+            if ignore_all_errors:
+                continue
+            raise ValueError(f"Corrupted batch output section {idx}: "
+                             f"{match[0][:100]}")
+        results[idx] = (int(status),
+                        base64.b64decode(data).decode("utf-8",
+                                                      errors="replace"))
+    missing = [str(i) for i, result in enumerate(results) if result is None]
+    if ignore_all_errors:
+        return [(None, "") if result is None else result
+                for result in results]
+    if missing:
+        raise ValueError(f"Missing batch output sections {missing}:\n"
+                         f"{output[-1000:]}")
+    return results
+
+
+def batch_cmd_status_output(session, cmds, timeout=600,
+                            ignore_all_errors=False, cmd_timeout=None):
+    """
+    Execute multiple commands using a single session round trip
+
+    :param session: aexpect.ShellSession session
+    :param cmds: list of commands
+    :param timeout: timeout of all the commands together
+    :param ignore_all_errors: report (None, "") for commands whose output
+                              could not be obtained instead of raising
+                              an exception
+    :param cmd_timeout: per-command timeout (see ``shell_batch_cmd``)
+    :return: list of (status, output) per each command
+    """
+    if not cmds:
+        return []
+    try:
+        out = session.cmd_output(shell_batch_cmd(cmds, cmd_timeout),
+                                 timeout=timeout, print_func='mute')
+    except aexpect.ShellError:
+        if not ignore_all_errors:
+            raise
+        out = ""
+    return parse_batch_output(out, len(cmds), ignore_all_errors)
+
+
 def shell_find_command(session, command):
     """
     Helper to detect path to a command
@@ -538,6 +983,34 @@ def wait_for_machine_calms_down(session, timeout=600):
     return False
 
 
+def wait_for_machines_calm_down(machines, timeout=600, hop=None):
+    """
+    Wait until all machines calm down (see `wait_for_machine_calms_down`)
+
+    The machines are checked concurrently within a shared deadline.
+
+    :param machines: list of machines (`runperf.machine.BaseMachine`)
+    :param timeout: shared timeout for all the machines
+    :param hop: ssh proxy machine to be used for the sessions
+    :return: {machine.name: settle time in seconds or None when still busy}
+    """
+    start = time.time()
+    end = start + timeout
+
+    def wait(machine):
+        with machine.get_session_cont(hop=hop, reuse=True) as session:
+            remaining = int(max(end - time.time(), 0))
+            if wait_for_machine_calms_down(session, remaining):
+                return round(time.time() - start, 1)
+        machine.log.warning("Machine did not stabilize in %ss, proceeding "
+                            "on a loaded machine!", timeout)
+        return None
+
+    return {machine.name: settle_time
+            for machine, settle_time in zip(machines,
+                                            fan_out(machines, wait))}
+
+
 def sorted_entry_points(group):
     """
     Return alphabetically sorted entry points for a given group
@@ -670,22 +1143,35 @@ class LogFetcher:
         except FileExistsError:
             pass
         since = time.time()
+        paths = {}
+        for cmd in cmds:
+            path = os.path.join(out_path, string_to_safe_path(cmd))
+            # Avoid fetching the files multiple times
+            if os.path.exists(path):
+                continue
+            try:
+                paths[path] = cmd % self.params
+            except Exception:  # pylint: disable=W0703
+                pass
         try:
-            with host.get_session_cont() as session:
-                for cmd in cmds:
-                    path = os.path.join(out_path,
-                                        string_to_safe_path(cmd))
-                    if os.path.exists(path):
-                        # Avoid fetching the files multiple times
-                        continue
-                    try:
-                        with open(path, 'w', encoding="utf-8") as out_fd:
-                            out_fd.write(session.cmd_output(cmd % self.params,
-                                                            print_func='mute'))
-                    except Exception:  # pylint: disable=W0703
-                        pass
+            # Session is closed on failure (eg. a command stuck
+            # despite the per-command timeout)
+            with host.get_session_cont(reuse=True) as session:
+                outputs = batch_cmd_status_output(session,
+                                                  list(paths.values()),
+                                                  cmd_timeout=60)
         except Exception:  # pylint: disable=W0703
-            pass
+            # Fall back to per-command collection
+            outputs = [(None, "")] * len(paths)
+        for (path, cmd), (status, output) in zip(paths.items(), outputs):
+            try:
+                if status is None:
+                    with host.get_session_cont() as session:
+                        output = session.cmd_output(cmd, print_func='mute')
+                with open(path, 'w', encoding="utf-8") as out_fd:
+                    out_fd.write(output)
+            except Exception:  # pylint: disable=W0703
+                pass
         self.params["since"] = since
 
     def collect(self, path, host):
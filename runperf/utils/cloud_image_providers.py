@@ -12,6 +12,8 @@
 #
 # Copyright: Red Hat Inc. 2020
 # Author: Lukas Doktor <ldoktor@redhat.com>
+import hashlib
+import json
 import os
 import re
 import shlex
@@ -25,18 +27,72 @@ class BaseProvider:
     """Base provider to fetch and prepare a cloudinit image"""
 
     def __init__(self, distro, arch, pub_key, base_path, session,
-                 setup_script):
+                 setup_script, machine=None, image_cache=None):
+        """
+        :param machine: machine the image is prepared for (required by
+                        the image_cache)
+        :param image_cache: controller-side image cache
+                            (:class:`runperf.utils.image_cache.ImageCache`)
+        """
         self.distro = distro
         self.arch = arch
         self.pubkey_content = pub_key
         self.base_path = base_path
         self.session = session
         self.setup_script_content = setup_script
-        self.image = os.path.join(base_path, self.distro + ".qcow2")
+        # Keep multiple versions of the image based on their content
+        self.image = os.path.join(base_path, f"{self.distro}-"
+                                  f"{self.get_fingerprint()}.qcow2")
         self.setup_script = self.image + ".setup_script.sh"
         self.pubkey = self.image + ".key.pub"
         self.paths = [self.image, self.setup_script, self.pubkey,
                       self.image + ".tmp"]
+        self.machine = machine
+        self.image_cache = image_cache
+
+    def get_fingerprint(self):
+        """
+        Fingerprint of the image based on distro, arch, setup script and
+        public key
+        """
+        def digest(content):
+            return hashlib.sha256(content.encode()).hexdigest()
+
+        return digest(json.dumps(
+            [self.distro, self.arch,
+             digest((self.setup_script_content or "").strip()),
+             digest((self.pubkey_content or "").strip())]))[:12]
+
+    def mark_used(self):
+        """Mark the image as recently used (see `evict_unused`)"""
+        self.session.cmd(f"touch '{self.pubkey}'")
+
+    def evict_unused(self, keep):
+        """
+        Remove all but ``keep`` most recently used images of this distro
+        from base_path
+
+        :param keep: number of images to keep (current image is always
+                     kept)
+        :return: list of removed images
+        """
+        out = self.session.cmd_output(
+            f"ls -t '{self.base_path}'/{shlex.quote(self.distro)}-*.key.pub "
+            "2>/dev/null", print_func='mute')
+        re_pubkey = re.compile(re.escape(self.distro) +
+                               r"-[0-9a-f]{12}\.qcow2\.key\.pub")
+        pubkeys = [_ for _ in out.split()
+                   if re_pubkey.fullmatch(os.path.basename(_))]
+        evicted = []
+        for pubkey in pubkeys[keep:]:
+            image = pubkey[:-len(".key.pub")]
+            if image == self.image:
+                continue
+            self.session.cmd("rm -f " + " ".join(
+                shlex.quote(_) for _ in (image, image + ".setup_script.sh",
+                                         pubkey, image + ".tmp")))
+            evicted.append(image)
+        return evicted
 
     @staticmethod
     def is_for(distro, arch):
@@ -100,9 +156,38 @@ class BaseProvider:
         url = self.get_url()
         if not url:
             return "Failed to get download URL"
+        if self.image_cache is not None and self.image_cache.mode == "prepare":
+            return self._install_prepared(url, default_password)
+        out = self._download(url)
+        if out:
+            return out
+        self._customize(default_password)
+        return ""
+
+    def _distribute(self, path, digest):
+        """Copy the image from the image_cache and verify it"""
+        out = self.image_cache.distribute(self.machine, self.session, path,
+                                          digest, self.image)
+        if out:
+            self.image_cache.verify(digest)
+            return out
+        self.session.cmd(f"chmod 666 '{self.image}'")
+        return ""
+
+    def _download(self, url):
+        """Download the base cloud image (or get it from the image_cache)"""
+        if self.image_cache is not None:
+            try:
+                return self._distribute(*self.image_cache.download(url))
+            except OSError as details:
+                return f"failed to download {url}: {details}"
         self.session.cmd(f"curl -L '{url}' -o '{self.image}'",
                          timeout=360)
         self.session.cmd(f"chmod 666 '{self.image}'")
+        return ""
+
+    def _customize(self, default_password):
+        """Resize and customize the downloaded image"""
         self.session.cmd(f"truncate -s 20G {self.image}.tmp")
         self.session.cmd("virt-resize --expand $(virt-filesystems --long -a "
                          f"{self.image} | sort -n -k 5 | tail -n 1 | "
@@ -123,6 +208,39 @@ class BaseProvider:
                 self.setup_script, self.setup_script_content))
             cloudinit += f" --run '{self.setup_script}'"
         self.session.cmd(cloudinit, timeout=2000)
+
+    def _install_prepared(self, url, default_password):
+        """
+        Prepare the image on the controller (only once) and install it
+        """
+        def create(staging):
+            session = utils.MutableShellSession(None, "bash")
+            try:
+                local = self.__class__(self.distro, self.arch,
+                                       self.pubkey_content, staging, session,
+                                       self.setup_script_content)
+                local.get_url = lambda: url
+                out = local.prepare(default_password)
+                if out:
+                    raise RuntimeError(f"Failed to prepare {self.distro} "
+                                       f"on controller: {out}")
+                return local.image
+            finally:
+                session.close()
+
+        key = hashlib.sha256(json.dumps(
+            [self.__class__.__name__, url, self.pubkey_content,
+             self.setup_script_content, default_password]).encode()).hexdigest()
+        try:
+            out = self._distribute(*self.image_cache.get(f"prepare:{key}",
+                                                          create))
+        except (OSError, RuntimeError) as details:
+            return str(details)
+        if out:
+            return out
+        if self.setup_script_content:
+            self.session.cmd(utils.shell_write_content_cmd(
+                self.setup_script, self.setup_script_content))
         return ""
 
 
@@ -0,0 +1,239 @@
+#!/bin/env python3
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2026
+# Author: Lukas Doktor <ldoktor@redhat.com>
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+
+LOG = logging.getLogger(__name__)
+# : Default location of the duration history file
+DEFAULT_PATH = os.path.join("~", ".cache", "runperf", "durations.json")
+# : Pseudo test names used to store non-test durations
+SETUP = "__SETUP__"
+PROFILE = "__PROFILE__"
+
+_RE_DURATION = re.compile(r"^(\d+(?:\.\d*)?)\s*([smhd]?)$")
+_DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_duration(value):
+    """
+    Parse human duration (eg. "3600", "90m", "1.5h") into seconds
+
+    :raise ValueError: when the format is not supported
+    """
+    match = _RE_DURATION.match(str(value).strip().lower())
+    if not match:
+        raise ValueError(f"Unsupported duration {value}, use number "
+                         "optionally followed by s/m/h/d suffix")
+    return float(match[1]) * _DURATION_UNITS[match[2]]
+
+
+def format_duration(seconds):
+    """Format duration in seconds as H:MM:SS"""
+    seconds = int(round(seconds))
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class DurationHistory:
+
+    """
+    Local history of execution durations
+
+    The durations are stored per (host, profile, test, params) key keeping
+    the last ``max_samples`` samples and the estimate is the median of them.
+    """
+
+    # : Number of samples kept per key
+    max_samples = 10
+
+    def __init__(self, path=None):
+        """
+        :param path: path to the history file (None to only keep the
+                     history in memory)
+        """
+        self.path = os.path.expanduser(path) if path else None
+        self._durations = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, encoding="utf-8") as history_fd:
+                    self._durations = json.load(history_fd)
+            except (OSError, ValueError) as details:
+                LOG.warning("Failed to load duration history %s, starting "
+                            "from scratch: %s", self.path, details)
+
+    @staticmethod
+    def key(host, profile, test, params=None):
+        """
+        Generate history key
+
+        :param host: host(s) identifier
+        :param profile: profile identifier
+        :param test: test name
+        :param params: test params (dict)
+        """
+        return json.dumps([host, profile, test, params or {}],
+                          sort_keys=True)
+
+    def record(self, host, profile, test, params, duration):
+        """
+        Record the duration (use ``save`` to store it to disk)
+        """
+        samples = self._durations.setdefault(
+            self.key(host, profile, test, params), [])
+        samples.append(round(duration, 3))
+        del samples[:-self.max_samples]
+
+    def estimate(self, host, profile, test, params=None, default=None):
+        """
+        Estimate the duration based on the history
+
+        :return: median of the recorded durations or default when there
+                 is no record
+        """
+        samples = self._durations.get(self.key(host, profile, test, params))
+        if not samples:
+            return default
+        samples = sorted(samples)
+        middle = len(samples) // 2
+        if len(samples) % 2:
+            return samples[middle]
+        return (samples[middle - 1] + samples[middle]) / 2
+
+    def save(self):
+        """Atomically store the history into the history file"""
+        if not self.path:
+            return
+        dirname = os.path.dirname(self.path) or "."
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            with tempfile.NamedTemporaryFile("w", dir=dirname,
+                                             prefix=".durations-",
+                                             delete=False,
+                                             encoding="utf-8") as tmp:
+                json.dump(self._durations, tmp, sort_keys=True)
+            os.replace(tmp.name, self.path)
+        except OSError as details:
+            LOG.warning("Failed to store duration history %s: %s",
+                        self.path, details)
+
+
+def profile_key(profile, profile_args):
+    """
+    Identifier of the profile including params affecting the profile
+
+    :param profile: profile name
+    :param profile_args: profile extra params
+    """
+    args = {key: value for key, value in profile_args.items()
+            if key != "RUNPERF_TESTS"}
+    if not args:
+        return profile
+    return f"{profile}:{json.dumps(args, sort_keys=True)}"
+
+
+class Schedule:
+
+    """
+    Keeps track of the estimated remaining duration of the planned items
+    """
+
+    # : Portion of the budget that might be used before optional items
+    # : without any comparable history are skipped
+    unknown_budget_ratio = 0.5
+
+    def __init__(self, history, host, budget=None):
+        """
+        :param history: `DurationHistory` instance
+        :param host: host(s) identifier
+        :param budget: total time budget (in seconds) of this execution
+        """
+        self.history = history
+        self.host = host
+        self.budget = budget
+        self.start = time.time()
+        # item -> (estimate, optional)
+        self._pending = {}
+        # Known estimates of the planned tests
+        self._known = []
+
+    def add(self, item, profile, test, params=None, optional=False):
+        """
+        Plan an item
+
+        :param item: unique identifier of this item
+        :return: estimated duration (None when unknown)
+        """
+        estimate = self.history.estimate(self.host, profile, test, params)
+        self._pending[item] = (estimate, optional)
+        if estimate is not None and test not in (SETUP, PROFILE):
+            self._known.append(estimate)
+        return estimate
+
+    def done(self, item, profile=None, test=None, params=None,
+             duration=None):
+        """
+        Mark the item as finished (and record the duration if provided)
+        """
+        self._pending.pop(item, None)
+        if duration is not None:
+            self.history.record(self.host, profile, test, params, duration)
+
+    def remaining(self, optional=True):
+        """
+        Estimated remaining duration
+
+        :param optional: include the optional items
+        :return: tuple(estimated_duration, number_of_unknown_items)
+        """
+        known = [estimate for estimate, is_optional in self._pending.values()
+                 if optional or not is_optional]
+        return (sum(_ for _ in known if _ is not None),
+                sum(1 for _ in known if _ is None))
+
+    def fits(self, item):
+        """
+        Check whether the optional item fits into the time budget
+        (considering all the remaining mandatory items)
+
+        Items without history are expected to take as long as the longest
+        known planned test. When no test duration is known they are only
+        allowed while less than ``unknown_budget_ratio`` of the budget is
+        (going to be) used.
+        """
+        if self.budget is None:
+            return True
+        estimate, optional = self._pending.get(item, (None, True))
+        required = time.time() - self.start + self.remaining(False)[0]
+        if not optional:
+            return required <= self.budget
+        if estimate is None and self._known:
+            estimate = max(self._known)
+        if estimate is None:
+            return required <= self.budget * self.unknown_budget_ratio
+        return required + estimate <= self.budget
+
+    def eta(self):
+        """Human readable ETA"""
+        remaining, unknown = self.remaining()
+        end = time.localtime(time.time() + remaining)
+        out = (f"ETA {time.strftime('%H:%M', end)} (remaining "
+               f"{format_duration(remaining)}")
+        if unknown:
+            out += f", {unknown} items without history"
+        return out + ")"
@@ -0,0 +1,194 @@
+#!/bin/env python3
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+#
+# See LICENSE for more details.
+#
+# Copyright: Red Hat Inc. 2026
+# Author: Lukas Doktor <ldoktor@redhat.com>
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from urllib.request import urlopen
+
+
+LOG = logging.getLogger(__name__)
+# : Default location of the controller-side image cache
+DEFAULT_PATH = os.path.join("~", ".cache", "runperf", "images")
+# : Supported modes; "off" - hosts fetch and prepare images themselves,
+# : "download" - only download once on the controller, "prepare" - also
+# : prepare (resize, customize) the image on the controller
+MODES = ("off", "download", "prepare")
+
+
+def file_digest(path):
+    """Calculate sha256 hex digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as src:
+        for chunk in iter(lambda: src.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImageCache:
+
+    """
+    Controller-side content-addressed cache of guest images
+
+    Images are stored as ``objects/$sha256`` and the ``index.json`` maps
+    the keys describing how the image was created (eg. the download url)
+    to their digests, which allows to reuse them across runs. Each key
+    is created only once even when requested by multiple hosts
+    concurrently.
+    """
+
+    def __init__(self, path=None, mode="download"):
+        """
+        :param path: cache directory (`DEFAULT_PATH` by default)
+        :param mode: one of `MODES`
+        """
+        if mode not in MODES:
+            raise ValueError(f"Unsupported image cache mode {mode}, use one "
+                             f"of {', '.join(MODES)}")
+        self.path = os.path.expanduser(path or DEFAULT_PATH)
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # Hit/miss statistics
+        self.stats = collections.Counter()
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.path}, {self.mode})"
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.path, "index.json"),
+                      encoding="utf-8") as index_fd:
+                return json.load(index_fd)
+        except (OSError, ValueError):
+            return {}
+
+    def _update_index(self, key, digest):
+        with self._lock:
+            index = self._load_index()
+            if digest is None:
+                index.pop(key, None)
+            else:
+                index[key] = digest
+            with tempfile.NamedTemporaryFile("w", dir=self.path,
+                                             prefix=".index-", delete=False,
+                                             encoding="utf-8") as tmp:
+                json.dump(index, tmp, sort_keys=True)
+            os.replace(tmp.name, os.path.join(self.path, "index.json"))
+
+    def object_path(self, digest):
+        """Path to the cached object of given digest"""
+        return os.path.join(self.path, "objects", digest)
+
+    def lookup(self, key):
+        """
+        Report digest of the cached image
+
+        :param key: key describing how the image was created
+        :return: digest or None when not cached
+        """
+        digest = self._load_index().get(key)
+        if digest and os.path.exists(self.object_path(digest)):
+            return digest
+        return None
+
+    def get(self, key, create):
+        """
+        Get the cached image, create it when not yet cached
+
+        :param key: key describing how the image was created
+        :param create: ``create(staging_dir)`` function to create the image
+                       inside the staging dir returning its path
+        :return: tuple(path, digest)
+        """
+        with self._get_key_lock(key):
+            digest = self.lookup(key)
+            if digest:
+                LOG.debug("Reusing cached image %s (%s)", digest, key)
+                with self._lock:
+                    self.stats["hit"] += 1
+                return self.object_path(digest), digest
+            with self._lock:
+                self.stats["miss"] += 1
+            os.makedirs(os.path.join(self.path, "objects"), exist_ok=True)
+            staging = tempfile.mkdtemp(prefix=".staging-", dir=self.path)
+            try:
+                path = create(staging)
+                digest = file_digest(path)
+                os.replace(path, self.object_path(digest))
+            finally:
+                shutil.rmtree(staging, ignore_errors=True)
+            self._update_index(key, digest)
+            LOG.debug("Cached image %s (%s)", digest, key)
+            return self.object_path(digest), digest
+
+    def download(self, url):
+        """
+        Download the url (only once)
+
+        :return: tuple(path, digest)
+        """
+        def create(staging):
+            path = os.path.join(staging, "image")
+            LOG.debug("Downloading %s", url)
+            with urlopen(url) as src, open(path, "wb") as dst:  # nosec
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            return path
+
+        return self.get(f"download:{url}", create)
+
+    def verify(self, digest):
+        """
+        Verify the cached object and remove it when corrupted
+
+        :return: True when the object is intact
+        """
+        path = self.object_path(digest)
+        if os.path.exists(path) and file_digest(path) == digest:
+            return True
+        LOG.warning("Removing corrupted cached image %s", digest)
+        for key, value in self._load_index().items():
+            if value == digest:
+                self._update_index(key, None)
+        if os.path.exists(path):
+            os.unlink(path)
+        return False
+
+    @staticmethod
+    def distribute(machine, session, path, digest, dst):
+        """
+        Copy the cached image to the machine and verify its checksum
+
+        :param machine: destination machine
+        :param session: session to the destination machine
+        :param path: cached image path
+        :param digest: expected sha256 digest
+        :param dst: destination path
+        :return: None on success, explanation of the failure otherwise
+        """
+        machine.copy_to(path, dst)
+        out = session.cmd_output(f"sha256sum '{dst}'", timeout=600)
+        if out.split(" ", 1)[0].strip() != digest:
+            return (f"checksum of {dst} does not match the cached image "
+                    f"{digest}")
+        return None
@@ -15,7 +15,7 @@
 import collections
 import os
 
-from . import shell_write_content_cmd
+from . import fan_out, shell_write_content_cmd
 from ..utils import sorted_entry_points
 
 
@@ -138,9 +138,12 @@ def register_tools(session, tools, clients):
     Unregister all tools and then register the provided ones
     """
     # Cleanup previous tools configuration
-    for client in clients:
-        with client.get_session_cont() as csession:
+    def cleanup_tools(client):
+        with client.get_session_cont(reuse=True) as csession:
             csession.cmd_output("rm -rf /var/lib/pbench-agent/tools-*default")
+
+    clients = list(clients)
+    fan_out(clients, cleanup_tools)
     # Register tools on all clients
     addrs = ','.join(_.get_addr() for _ in clients)
     if not tools:
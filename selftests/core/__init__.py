@@ -12,9 +12,11 @@
 #
 # Copyright: Red Hat Inc. 2020
 # Author: Lukas Doktor <ldoktor@redhat.com>
+import os
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
 from runperf import utils
 from runperf.machine import Host, ShellSession, Controller
@@ -50,6 +52,12 @@ class Selftest(unittest.TestCase):
     def setUp(self):
         self.tmpdir = tempfile.mkdtemp(prefix="runperf-selftest")
         utils.CONTEXT.set_root(self.tmpdir)
+        # Do not touch user's duration history
+        history_patch = mock.patch(
+            "runperf.utils.history.DEFAULT_PATH",
+            os.path.join(self.tmpdir, "__history__", "durations.json"))
+        history_patch.start()
+        self.addCleanup(history_patch.stop)
 
     def check_calls(self, acts, exps):
         """
@@ -67,5 +75,6 @@ class Selftest(unittest.TestCase):
                             "\n".join(str(_) for _ in acts)))
 
     def tearDown(self):
+        utils.CONTEXT.flush()
         if self.tmpdir:
             shutil.rmtree(self.tmpdir)
@@ -22,7 +22,7 @@ import re
 import shutil
 from unittest import mock
 
-from runperf import ComparePerf, StripPerf
+from runperf import ComparePerf, DigestPerf, RenderPerf, StripPerf
 
 from . import Selftest
 
@@ -35,19 +35,33 @@ class RunPerfTest(Selftest):
         self.base_dir = os.path.dirname(os.path.dirname(
             os.path.dirname(__file__)))
 
-    def _run(self, args, base_dir):
+    def _run(self, args, base_dir, klass=ComparePerf):
         old_path = os.getcwd()
         try:
             os.chdir(base_dir)
             with mock.patch("sys.argv", args):
                 with mock.patch("logging.getLogger"):
-                    return ComparePerf()()
+                    return klass()()
         finally:
             os.chdir(old_path)
 
+    def check_html_and_xunit(self, html_path, xunit_path):
+        with open(os.path.join(self.base_dir, "docs", "source", "_static",
+                               "html_result.html")) as exp:
+            with open(html_path) as act:
+                self.assertEqual(exp.read(), act.read())
+        with open(os.path.join(self.base_dir, "selftests", ".assets",
+                               "results", "result.xunit")) as exp:
+            with open(xunit_path) as act:
+                act_filt = re.sub('timestamp="[^"]+"',
+                                  'timestamp="FILTERED"',
+                                  act.read())
+                self.assertEqual(exp.read(), act_filt)
+
     def test_full_and_stripped(self):
         html_path = os.path.join(self.tmpdir, "result.html")
         xunit_path = os.path.join(self.tmpdir, "result.xunit")
+        state_path = os.path.join(self.tmpdir, "result.state")
         model_path = "selftests/.assets/results/1_base/linear_model.json"
         results = ["selftests/.assets/results/1_base/"
                    "result_20200726_080654",
@@ -62,19 +76,19 @@ class RunPerfTest(Selftest):
                 "--tolerance", "5", "--stddev-tolerance", "10",
                 "--model-linear-regression", model_path,
                 "--model-builds-average", "1", "--n-out-of-results", "1",
-                "--html", html_path, "--xunit", xunit_path, "--"]
+                "--html", html_path, "--xunit", xunit_path,
+                "--dump-state", state_path, "--"]
         self.assertEqual(self._run(args + results, self.base_dir), 2)
-        with open(os.path.join(self.base_dir, "docs", "source", "_static",
-                               "html_result.html")) as exp:
-            with open(html_path) as act:
-                self.assertEqual(exp.read(), act.read())
-        with open(os.path.join(self.base_dir, "selftests", ".assets",
-                               "results", "result.xunit")) as exp:
-            with open(xunit_path) as act:
-                act_filt = re.sub('timestamp="[^"]+"',
-                                  'timestamp="FILTERED"',
-                                  act.read())
-                self.assertEqual(exp.read(), act_filt)
+        self.check_html_and_xunit(html_path, xunit_path)
+
+        # Re-render the results out of the stored state
+        os.unlink(html_path)
+        os.unlink(xunit_path)
+        self.assertEqual(self._run(["render-perf", "--html-with-charts",
+                                    "--html", html_path, "--xunit",
+                                    xunit_path, state_path], self.base_dir,
+                                   RenderPerf), 2)
+        self.check_html_and_xunit(html_path, xunit_path)
 
         # Now try it again but using a stripped results
         old_path = os.getcwd()
@@ -97,17 +111,76 @@ class RunPerfTest(Selftest):
         finally:
             os.chdir(old_path)
         self.assertEqual(self._run(args + results, self.tmpdir), 2)
-        with open(os.path.join(self.base_dir, "docs", "source", "_static",
-                               "html_result.html")) as exp:
-            with open(html_path) as act:
-                self.assertEqual(exp.read(), act.read())
+        self.check_html_and_xunit(html_path, xunit_path)
+
+    def test_baseline_digest(self):
+        html_path = os.path.join(self.tmpdir, "result.html")
+        xunit_path = os.path.join(self.tmpdir, "result.xunit")
+        digest_path = os.path.join(self.tmpdir, "digest.json.gz")
+        model_path = "selftests/.assets/results/1_base/linear_model.json"
+        src = "selftests/.assets/results/1_base/result_20200726_080654"
+        references = ["selftests/.assets/results/1_base/"
+                      "result_20200726_112748",
+                      "selftests/.assets/results/2_kernel_update/"
+                      "result_20200726_114437",
+                      "selftests/.assets/results/3_kernel_and_less_cpus/"
+                      "result_20200726_125851"]
+        dst = ("selftests/.assets/results/"
+               "4_kernel_and_less_cpus_and_different_duration/"
+               "result_20200726_130256")
+        self.assertEqual(self._run(["digest-perf", "--tolerance", "5",
+                                    "--stddev-tolerance", "10",
+                                    "--model-linear-regression", model_path,
+                                    "-o", digest_path, "--", src] +
+                                   references, self.base_dir, DigestPerf), 0)
+        # Using digest instead of reference results should produce the
+        # same results (only the reference details and params are not
+        # available in the html report)
+        args = ["compare-perf", "--html-with-charts",
+                "--tolerance", "5", "--stddev-tolerance", "10",
+                "--model-linear-regression", model_path,
+                "--model-builds-average", "1", "--n-out-of-results", "1",
+                "--html", html_path, "--xunit", xunit_path,
+                "--baseline-digest", digest_path, "--", src, dst]
+        self.assertEqual(self._run(args, self.base_dir), 2)
         with open(os.path.join(self.base_dir, "selftests", ".assets",
                                "results", "result.xunit")) as exp:
             with open(xunit_path) as act:
-                act_filt = re.sub('timestamp="[^"]+"',
-                                  'timestamp="FILTERED"',
-                                  act.read())
-                self.assertEqual(exp.read(), act_filt)
+                self.assertEqual(exp.read(),
+                                 re.sub('timestamp="[^"]+"',
+                                        'timestamp="FILTERED"', act.read()))
+        with open(html_path) as html:
+            self.assertIn("(from digest)", html.read())
+        # Digest is not usable with different models
+        args = ["compare-perf", "--tolerance", "5", "--stddev-tolerance",
+                "10", "--baseline-digest", digest_path, "--", src, dst]
+        self.assertRaises(ValueError, self._run, args, self.base_dir)
+
+    def test_primary_only(self):
+        xunit_path = os.path.join(self.tmpdir, "result.xunit")
+        args = ["compare-perf", "--tolerance", "5", "--stddev-tolerance", "10",
+                "--model-linear-regression",
+                "selftests/.assets/results/1_base/linear_model.json",
+                "--model-builds-average", "1", "--n-out-of-results", "1",
+                "--xunit", xunit_path, "--primary-only", "--",
+                "selftests/.assets/results/1_base/result_20200726_080654",
+                "selftests/.assets/results/1_base/result_20200726_112748",
+                "selftests/.assets/results/2_kernel_update/"
+                "result_20200726_114437",
+                "selftests/.assets/results/3_kernel_and_less_cpus/"
+                "result_20200726_125851", "selftests/.assets/results/"
+                "4_kernel_and_less_cpus_and_different_duration/"
+                "result_20200726_130256"]
+        self.assertEqual(self._run(args, self.base_dir), 2)
+        # Only the number of tests should differ as non-primary results
+        # were not processed at all
+        with open(os.path.join(self.base_dir, "selftests", ".assets",
+                               "results", "result.xunit")) as exp:
+            exp = exp.read().splitlines()
+        with open(xunit_path) as act:
+            act = act.read().splitlines()
+        self.assertEqual(exp[2:], act[2:])
+        self.assertIn('tests="8"', act[1])
 
     def test(self):
         args = ["compare-perf", "--", "selftests/.assets/results/1_base/"
@@ -19,9 +19,13 @@ Tests for the machine handling
 # pylint: disable=W0212
 
 import argparse
+import base64
 import os
+import time
 from unittest import mock
 
+import aexpect
+
 from runperf import machine
 from runperf.machine import Controller, LibvirtGuest, BaseMachine
 
@@ -64,7 +68,8 @@ class DummyController(Controller):
                                   provisioner=None, host_setup_script=None,
                                   host_setup_script_reboot=False, metadata={},
                                   output=output, host_rpms=[],
-                                  worker_rpms=[])
+                                  worker_rpms=[], image_cache="off",
+                                  image_cache_dir=None)
         super().__init__(args, mock.Mock())
         # Make sure we will not harm localhost
         for host in self.hosts:
@@ -139,14 +144,174 @@ class TestBasics(Selftest):
                          "ControlPersist=60 root@addr3",
                          machine3.get_ssh_cmd(machine1))
 
+    def test_session_pool(self):
+        args = self.get_args(["addr1", "addr2"])
+        machine1 = machine.Host(mock.Mock(), 'name1', 'addr1', None, args)
+        machine2 = machine.Host(mock.Mock(), 'name2', 'addr2', None, args)
+        sessions = [mock.Mock(name=f"session{_}") for _ in range(4)]
+        machine1.get_session = mock.Mock(side_effect=sessions)
+        with machine1.get_session_cont(reuse=True) as session:
+            self.assertEqual(sessions[0], session)
+            # Nested usage must not reuse the borrowed session
+            with machine1.get_session_cont(reuse=True) as session:
+                self.assertEqual(sessions[1], session)
+        # Different hop uses different session
+        with machine1.get_session_cont(hop=machine2, reuse=True) as session:
+            self.assertEqual(sessions[2], session)
+        # Idle sessions are reused
+        with machine1.get_session_cont(reuse=True) as session:
+            self.assertIn(session, sessions[:2])
+        self.assertEqual(3, machine1.get_session.call_count)
+        # Dead sessions are closed and not reused
+        for session in sessions[:2]:
+            session.is_alive.return_value = False
+        with machine1.get_session_cont(reuse=True) as session:
+            self.assertEqual(sessions[3], session)
+        sessions[0].close.assert_called()
+        sessions[1].close.assert_called()
+        # Failures close the session
+        try:
+            with machine1.get_session_cont(hop=machine2, reuse=True) as session:
+                raise ValueError("Failure")
+        except ValueError:
+            pass
+        sessions[2].close.assert_called_once()
+        # close_sessions closes all idle sessions
+        machine1.close_sessions()
+        sessions[3].close.assert_called_once()
+        self.assertEqual({}, machine1._session_pool)
+
+    def test_session_pool_no_reuse(self):
+        args = self.get_args(["addr1"])
+        machine1 = machine.Host(mock.Mock(), 'name1', 'addr1', None, args)
+        machine1.get_session = mock.Mock(
+            side_effect=lambda *_: aexpect.ShellSession(
+                "sh", prompt=r"[\#\$] $"))
+        try:
+            # Sessions are not pooled by default
+            with machine1.get_session_cont() as session:
+                session.cmd("export RUNPERF_SOURCED=yes")
+            with machine1.get_session_cont(reuse=True) as session:
+                self.assertIn("<>", session.cmd_output(
+                    "echo \"<$RUNPERF_SOURCED>\""))
+                session.cmd("export RUNPERF_SOURCED=yes")
+            # Reusable sessions keep the state
+            with machine1.get_session_cont(reuse=True) as session:
+                self.assertIn("<yes>", session.cmd_output(
+                    "echo \"<$RUNPERF_SOURCED>\""))
+            self.assertEqual(2, machine1.get_session.call_count)
+        finally:
+            machine1.close_sessions()
+
+    def test_get_info_cache(self):
+        args = self.get_args(["addr1"])
+        host = machine.Host(mock.Mock(), 'name1', 'addr1', None, args)
+        session = mock.Mock()
+        session.cmd.return_value = "boot1\n"
+        host.get_session = mock.Mock(return_value=session)
+        distro_info = mock.Mock(side_effect=lambda _: {"info": "value"})
+        entry = mock.Mock(**{"load.return_value": distro_info})
+        with mock.patch("runperf.machine.utils.sorted_entry_points",
+                        return_value=[entry]):
+            info = host.get_info()
+            self.assertEqual("value", info["info"])
+            self.assertIn("params", info)
+            info["info"] = "modified"
+            self.assertEqual("value", host.get_info()["info"])
+            self.assertEqual(1, distro_info.call_count)
+            # New boot ID
+            session.cmd.return_value = "boot2\n"
+            host.get_info()
+            self.assertEqual(2, distro_info.call_count)
+            # Profile change
+            host.profile = mock.Mock()
+            host.profile.name = "profile"
+            host.get_info()
+            self.assertEqual(3, distro_info.call_count)
+            host.get_info()
+            self.assertEqual(3, distro_info.call_count)
+            # Explicit invalidation
+            host.invalidate_info()
+            host.get_info()
+            self.assertEqual(4, distro_info.call_count)
+            # Unknown boot ID disables caching
+            session.cmd.return_value = ""
+            host.get_info()
+            host.get_info()
+            self.assertEqual(6, distro_info.call_count)
+
+    def test_reboot(self):
+        args = self.get_args(["addr1"])
+        host = machine.Host(mock.Mock(), 'name1', 'addr1', None, args)
+        session = mock.Mock()
+        session.cmd.return_value = "boot1\n"
+        host.get_session = mock.Mock(return_value=session)
+        # Unreachable, old system still running, new system booted
+        host.try_get_boot_id = mock.Mock(side_effect=[None, "boot1", "",
+                                                      "boot2"])
+        with mock.patch("time.sleep") as sleep:
+            host.reboot()
+        self.assertIn(mock.call(machine.REBOOT_CMD, print_func='mute',
+                                ignore_all_errors=True),
+                      session.cmd.call_args_list)
+        # No fixed delays, only backoff between attempts
+        self.assertEqual([mock.call(1), mock.call(2), mock.call(4)],
+                         sleep.call_args_list)
+        self.assertEqual(4, host.try_get_boot_id.call_count)
+        # Wait for systemd to finish booting
+        host.try_get_boot_id = mock.Mock(return_value="boot3")
+        session.cmd_output.side_effect = ["starting\n", "degraded\n"]
+        with mock.patch("time.sleep"):
+            self.assertEqual("boot3", host.wait_for_boot(
+                "boot2", system_running=True))
+        self.assertEqual(2, session.cmd_output.call_count)
+        # Timeout
+        host.try_get_boot_id = mock.Mock(return_value="boot3")
+        with mock.patch("time.sleep"):
+            self.assertRaises(RuntimeError, host.wait_for_boot, "boot3", 0)
+
+    def test_reboot_cmd_detached(self):
+        fake_bin = os.path.join(self.tmpdir, "bin")
+        os.mkdir(fake_bin)
+        marker = os.path.join(self.tmpdir, "rebooted")
+        # Never use the real commands, fail systemd-run to check the
+        # fallback as well
+        for name, content in (("reboot", f"touch '{marker}'"),
+                              ("systemd-run", "exit 1")):
+            path = os.path.join(fake_bin, name)
+            with open(path, "w", encoding="utf-8") as script:
+                script.write(f"#!/bin/sh\n{content}\n")
+            os.chmod(path, 0o755)
+        session = aexpect.ShellSession("sh", prompt=r"[\#\$] $")
+        try:
+            session.cmd(f"export PATH='{fake_bin}':$PATH")
+            session.cmd(machine.REBOOT_CMD)
+        finally:
+            session.close()
+        # Reboot is executed even though the session was closed
+        end = time.time() + 10
+        while not os.path.exists(marker) and time.time() < end:
+            time.sleep(0.1)
+        self.assertTrue(os.path.exists(marker))
+
 
 class GetDistroInfo(Selftest):
     """Tests for get_distro_info"""
 
     def check(self, cmd, cmd_status, exp):
+        # cmd contains outputs of all but "which rpm" (and "rpm -qa" when
+        # cmd_status is non-zero) commands
+        outputs = list(cmd)
+        if cmd_status:
+            outputs.insert(3, "")
+        outputs.insert(3, "")
+        sections = []
+        for i, output in enumerate(outputs):
+            data = base64.b64encode(output.encode()).decode()
+            status = cmd_status if i == 3 else 0
+            sections.append(f"RUNPERF_BATCH:{i}:{status}:{len(data)}\n{data}")
         session = mock.Mock()
-        session.cmd.side_effect = cmd
-        session.cmd_status.return_value = cmd_status
+        session.cmd_output.return_value = "\n".join(sections)
         mymachine = mock.MagicMock()
         mymachine.get_session_cont.return_value.__enter__.return_value = session
         mymachine.name = "My Machine"
@@ -233,7 +398,7 @@ class ControllerTests(Selftest):
         mod_profiles = mock.Mock()
         mod_profiles.get.return_value = profile
         with mock.patch("runperf.machine.profiles", mod_profiles):
-            with mock.patch("runperf.machine.time"):
+            with mock.patch("runperf.machine.Host.wait_for_boot"):
                 controller = DummyController(self.tmpdir)
                 workers = controller.apply_profile("dummy", {})
                 self.assertEqual(len(profile.mock_calls), 3,
@@ -241,6 +406,40 @@ class ControllerTests(Selftest):
                 self.assertEqual(workers, [['worker1', 'worker2']])
 
 
+    def test_image_stats(self):
+        controller = DummyController(self.tmpdir)
+        controller.for_each_host_retry = mock.Mock()
+        controller.cleanup()
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir,
+                                                     "RUNPERF_METADATA")))
+        controller.hosts[0].image_stats.update(hit=2, miss=1)
+        controller.hosts[0].image_cache = mock.Mock(stats={"miss": 1})
+        controller.cleanup()
+        with open(os.path.join(self.tmpdir, "RUNPERF_METADATA"),
+                  encoding="utf-8") as metadata_fd:
+            self.assertEqual('\nguest_image_cache:{"addr": {"hit": 2, '
+                             '"miss": 1}, "controller": {"miss": 1}}',
+                             metadata_fd.read())
+
+    def test_plan_profiles(self):
+        controller = DummyController(self.tmpdir)
+        tuned_irq = ("TunedLibvirt", {"irqbalance": 0})
+        profile_defs = [("TunedLibvirt", {}), ("Localhost", {}), tuned_irq,
+                        ("TunedLibvirt", {"__NAME__": "Tuned2"}),
+                        ("DefaultLibvirt", {})]
+        plan = controller.plan_profiles(profile_defs, False)
+        self.assertEqual([0, 1, 2, 3, 4], [_.index for _ in plan])
+        self.assertFalse(any(_.keep_persistent for _ in plan))
+        self.assertEqual(6, controller.estimate_reboots(plan))
+        plan = controller.plan_profiles(profile_defs)
+        self.assertEqual([0, 3, 1, 4, 2], [_.index for _ in plan])
+        self.assertEqual([True, False, False, False, False],
+                         [_.keep_persistent for _ in plan])
+        self.assertEqual(4, controller.estimate_reboots(plan))
+        self.assertEqual([tuned_irq], [(_.profile, _.extra)
+                                       for _ in plan[-1:]])
+
+
 class LibvirtGuestTests(Selftest):
 
     """Tests for the LibvirtGuest class"""
@@ -264,6 +463,68 @@ class LibvirtGuestTests(Selftest):
         vm.distro = "NOT-RHEL-8.0"
         self.assertRaises(NotImplementedError, vm._get_os_variant, session)
 
+    def test_discover_addrs(self):
+        session = mock.Mock()
+        host = BaseMachine(mock.Mock(), "host", "distro")
+        host.get_session_cont = mock.MagicMock()
+        host.get_session_cont.return_value.__enter__.return_value = session
+        vms = [LibvirtGuest(host, f"vm{i}", "distro", "image", "smp", "mem")
+               for i in range(2)]
+        marker = machine.ADDR_MARKER
+        ifaddr = (" Name MAC address Protocol Address\n-----\n vnet0 "
+                  "52:54:00:4c:a3:21 ipv4 192.168.122.%s/24\n")
+        session.cmd_output.side_effect = [
+            f"{marker}host.vm0\n{marker}host.vm1\n",
+            f"{marker}host.vm0\n{marker}host.vm1\n{ifaddr % 11}",
+            f"{marker}host.vm0\n{ifaddr % 10}"]
+        with mock.patch("time.sleep") as sleep:
+            self.assertEqual([], LibvirtGuest.discover_addrs(vms))
+        self.assertEqual("192.168.122.10", vms[0].get_addr())
+        self.assertEqual("192.168.122.11", vms[1].get_addr())
+        # Single command per round, resolved guests are not queried
+        cmds = [_[1][0] for _ in session.cmd_output.mock_calls]
+        self.assertEqual(3, len(cmds))
+        self.assertIn("host.vm1", cmds[1])
+        self.assertNotIn("host.vm1", cmds[2])
+        self.assertEqual([mock.call(1), mock.call(2)],
+                         sleep.call_args_list)
+        # Timeout
+        vms[0]._addr = None
+        session.cmd_output.side_effect = None
+        session.cmd_output.return_value = f"{marker}host.vm0\n"
+        self.assertEqual([vms[0]], LibvirtGuest.discover_addrs(vms, 0))
+        with mock.patch.object(LibvirtGuest, "discover_addrs",
+                               return_value=[vms[0]]):
+            self.assertRaises(RuntimeError, vms[0].get_addr)
+
+    def test_create_image(self):
+        def create(strategy, fmt="qcow2", reflink_status=0):
+            session = mock.Mock()
+            session.cmd_status.return_value = reflink_status
+            vm = LibvirtGuest(host, "vm1", "distro", "/base.qcow2", "smp",
+                              "mem", extra_params={"image_strategy":
+                                                   strategy})
+            vm._create_image(session, f"/base-vm1.{fmt}", fmt, "qcow2")
+            return ([_[1][0] for _ in session.cmd_status.mock_calls] +
+                    [_[1][0] for _ in session.cmd.mock_calls])
+
+        host = BaseMachine(mock.Mock(), "host", "distro")
+        self.assertEqual(["\\cp -f /base.qcow2 /base-vm1.qcow2", "sync"],
+                         create("copy"))
+        self.assertEqual(["qemu-img convert -f qcow2 -O raw /base.qcow2 "
+                          "/base-vm1.raw", "sync"], create("copy", "raw"))
+        self.assertEqual(["qemu-img create -f qcow2 -F qcow2 -b /base.qcow2 "
+                          "/base-vm1.qcow2"], create("overlay"))
+        self.assertRaises(ValueError, create, "overlay", "raw")
+        self.assertRaises(ValueError, create, "unknown")
+        reflink = "\\cp -f --reflink=always /base.qcow2 /base-vm1.qcow2"
+        self.assertEqual([reflink], create("reflink"))
+        # Fallback to full copy
+        self.assertEqual([reflink, "\\cp -f /base.qcow2 /base-vm1.qcow2",
+                          "sync"], create("reflink", reflink_status=1))
+        self.assertEqual(["qemu-img convert -f qcow2 -O raw /base.qcow2 "
+                          "/base-vm1.raw", "sync"], create("reflink", "raw"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -19,12 +19,17 @@ Tests for the profiles handling
 # pylint: disable=W0212
 
 import argparse
+import base64
+import io
 import os
 import shutil
+import tarfile
+import threading
 import unittest
 from unittest import mock
 
 from runperf import profiles
+from runperf.utils import cloud_image_providers
 from runperf.machine import Host, ShellSession
 from runperf.profiles import Localhost, DefaultLibvirt, DefaultLibvirtMulti
 
@@ -62,7 +67,8 @@ class ProfileUnitTests(Selftest):
         args = argparse.Namespace(guest_distro="__test_distro__",
                                   default_passwords="foo", paths=[asset_path],
                                   force_params=[])
-        with mock.patch("runperf.profiles.CONFIG_DIR", self.tmpdir):
+        with mock.patch("runperf.profiles.CONFIG_DIR",
+                        self.tmpdir + os.path.sep):
             host = Host(mock.Mock(), "selftest", "addr", "__test_distro__",
                         args)
             host.get_session = lambda *args, **kwargs: ShellSession(None, "sh")
@@ -88,7 +94,8 @@ class ProfileUnitTests(Selftest):
         args = argparse.Namespace(guest_distro="__test_distro__",
                                   default_passwords="foo", paths=[asset_path],
                                   force_params=[])
-        with mock.patch("runperf.profiles.CONFIG_DIR", self.tmpdir):
+        with mock.patch("runperf.profiles.CONFIG_DIR",
+                        self.tmpdir + os.path.sep):
             host = Host(mock.Mock(), "selftest", "addr", "__test_distro__",
                         args)
             host.get_session = lambda *args, **kwargs: ShellSession(None, "sh")
@@ -139,54 +146,99 @@ class ProfileUnitTests(Selftest):
             self.assertTrue(session.closed)
 
     def test_libvirt_image_up_to_date(self):
-        asset_path = os.path.join(os.path.dirname(os.path.dirname(__file__)),
-                                  ".assets")
-        args = argparse.Namespace(guest_distro="__test_distro__",
-                                  default_passwords="foo", paths=[asset_path],
-                                  force_params=[])
-        with mock.patch("runperf.profiles.CONFIG_DIR", self.tmpdir):
-            host = Host(mock.Mock(), "selftest", "addr", "__test_distro__",
-                        args)
-            host.get_session = lambda *args, **kwargs: ShellSession(None, "sh")
-            profile = DefaultLibvirt(host, self.tmpdir, {})
-            pubkey = os.path.join(self.tmpdir, "pubkey")
-            image = os.path.join(self.tmpdir, "image")
-            setup_script = "foo"
-            setup_script_path = os.path.join(self.tmpdir, "setup_script")
-            # missing image
-            self.assertEqual("does not exists", profile._image_up_to_date(
-                profile.session, pubkey, image, setup_script,
-                setup_script_path))
-            profile.shared_pub_key = "aaa"
-            with open(image, 'w'):
-                pass
-            with open(pubkey, 'w') as fd_pubkey:
-                fd_pubkey.write("bbb\n")
-            self.assertEqual("has wrong public key", profile._image_up_to_date(
-                profile.session, pubkey, image, setup_script,
-                setup_script_path))
-            with open(pubkey, 'w') as fd_pubkey:
-                fd_pubkey.write("aaa\n")
-            out = profile._image_up_to_date(profile.session, pubkey, image,
-                                            setup_script, setup_script_path)
-            self.assertEqual("not created with setup script", out)
-            with open(setup_script_path, 'w') as fd_setup_script:
-                fd_setup_script.write("bar\n")
-            out = profile._image_up_to_date(profile.session, pubkey, image,
-                                            setup_script, setup_script_path)
-            self.assertEqual("created with a different setup script", out)
-            out = profile._image_up_to_date(profile.session, pubkey, image,
-                                            None, setup_script_path)
-            self.assertEqual("created with setup script", out)
-            with open(setup_script_path, 'w') as fd_setup_script:
-                fd_setup_script.write("foo\n")
-            out = profile._image_up_to_date(profile.session, pubkey, image,
-                                            setup_script, setup_script_path)
-            self.assertEqual(None, out)
-            os.unlink(setup_script_path)
-            out = profile._image_up_to_date(profile.session, pubkey, image,
-                                            None, setup_script_path)
-            self.assertEqual(None, out)
+        session = ShellSession(None, "sh")
+        self.addCleanup(session.close)
+
+        def provider(pubkey, setup_script):
+            return cloud_image_providers.BaseProvider(
+                "Distro", "arch", pubkey, self.tmpdir, session, setup_script)
+
+        plugin = provider("aaa", "foo")
+        # Images are stored per distro, arch, setup script and pubkey
+        self.assertEqual(plugin.image, provider("aaa\n", "foo\n").image)
+        self.assertNotEqual(plugin.image, provider("bbb", "foo").image)
+        self.assertNotEqual(plugin.image, provider("aaa", None).image)
+        # missing image
+        self.assertEqual("does not exists", plugin.is_up_to_date())
+        with open(plugin.image, 'w'):
+            pass
+        with open(plugin.pubkey, 'w') as fd_pubkey:
+            fd_pubkey.write("bbb\n")
+        self.assertEqual("has wrong public key", plugin.is_up_to_date())
+        with open(plugin.pubkey, 'w') as fd_pubkey:
+            fd_pubkey.write("aaa\n")
+        self.assertEqual("not created with setup script",
+                         plugin.is_up_to_date())
+        with open(plugin.setup_script, 'w') as fd_setup_script:
+            fd_setup_script.write("bar\n")
+        self.assertEqual("created with a different setup script",
+                         plugin.is_up_to_date())
+        with open(plugin.setup_script, 'w') as fd_setup_script:
+            fd_setup_script.write("foo\n")
+        self.assertEqual("", plugin.is_up_to_date())
+        plugin.setup_script_content = None
+        self.assertEqual("created with setup script", plugin.is_up_to_date())
+        os.unlink(plugin.setup_script)
+        self.assertEqual("", plugin.is_up_to_date())
+
+    def test_libvirt_image_evict(self):
+        session = ShellSession(None, "sh")
+        self.addCleanup(session.close)
+        base_path = os.path.join(self.tmpdir, "images")
+        os.mkdir(base_path)
+        plugins = []
+        for i in range(4):
+            plugin = cloud_image_providers.BaseProvider(
+                "Distro", "arch", "key", base_path, session, f"script{i}")
+            for path in plugin.paths[:3]:
+                with open(path, "w", encoding="utf-8"):
+                    pass
+            os.utime(plugin.pubkey, (i, i))
+            plugins.append(plugin)
+        # Unrelated files are not touched
+        other = os.path.join(base_path, "Distro-DefaultLibvirt0.qcow2")
+        with open(other, "w", encoding="utf-8"):
+            pass
+        # Current (even least recently used) image is always kept
+        self.assertEqual([plugins[1].image], plugins[0].evict_unused(2))
+        self.assertEqual([], plugins[0].evict_unused(2))
+        plugins[0].mark_used()
+        self.assertEqual([plugins[2].image], plugins[0].evict_unused(2))
+        self.assertEqual(sorted([other] + plugins[0].paths[:3] +
+                                plugins[3].paths[:3]),
+                         sorted(os.path.join(base_path, _)
+                                for _ in os.listdir(base_path)))
+
+    def test_libvirt_image_evict_distros(self):
+        session = ShellSession(None, "sh")
+        self.addCleanup(session.close)
+        base_path = os.path.join(self.tmpdir, "images")
+        os.mkdir(base_path)
+        plugins = {}
+        # "Distro-2" images also match the "Distro-*" prefix
+        for distro in ("Distro", "Distro-2", "Other"):
+            plugins[distro] = []
+            for i in range(3):
+                plugin = cloud_image_providers.BaseProvider(
+                    distro, "arch", "key", base_path, session, f"script{i}")
+                for path in plugin.paths[:3]:
+                    with open(path, "w", encoding="utf-8"):
+                        pass
+                os.utime(plugin.pubkey, (i, i))
+                plugins[distro].append(plugin)
+        # Only images of the same distro are evicted
+        self.assertEqual([plugins["Distro"][0].image],
+                         plugins["Distro"][2].evict_unused(2))
+        self.assertEqual([plugins["Distro-2"][1].image,
+                          plugins["Distro-2"][0].image],
+                         plugins["Distro-2"][2].evict_unused(1))
+        self.assertEqual([], plugins["Other"][2].evict_unused(3))
+        exp = (plugins["Distro"][1].paths[:3] + plugins["Distro"][2].paths[:3]
+               + plugins["Distro-2"][2].paths[:3])
+        for plugin in plugins["Other"]:
+            exp.extend(plugin.paths[:3])
+        self.assertEqual(sorted(exp), sorted(os.path.join(base_path, _)
+                                             for _ in os.listdir(base_path)))
 
     def test_name(self):
         profile = profiles.Localhost(mock.Mock(), None, {})
@@ -203,6 +255,18 @@ class RunPerfTest(Selftest):
 
     """Full runperf workflow tests"""
 
+    @staticmethod
+    def state_output(state):
+        """Generate PersistentState load output out of the state dict"""
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+            for key, value in state.items():
+                data = value.encode()
+                info = tarfile.TarInfo("./" + key)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        return "RUNPERF_STATE:" + base64.b64encode(buf.getvalue()).decode()
+
     def test_tuned_libvirt(self):
         # runperf dir must end with '/'
         runperf_dir = os.path.join(self.tmpdir, "runperf") + os.path.sep
@@ -212,8 +276,15 @@ class RunPerfTest(Selftest):
         args = argparse.Namespace(guest_distro="__test_distro__",
                                   default_passwords="foo", paths=[asset_path],
                                   force_params=[])
-        # For "tuned-adm" we need to return "something : virtual-host"
-        # session = mock.Mock(**{'cmd.return_value': "something : virtual-host"})
+        state = {}
+        output = ["some:value"]
+
+        def cmd_output(cmd, *args, **kwargs):
+            del args, kwargs
+            if "RUNPERF_STATE" in cmd:
+                return self.state_output(state)
+            return output[0]
+
         session = mock.Mock()
         host = Host(mock.Mock(), "selftest", "addr", "__test_distro__",
                     args)
@@ -225,25 +296,32 @@ class RunPerfTest(Selftest):
             # Persistent apply, should ask for reboot
             session.cmd.return_value = "some:value"
             session.cmd_status.return_value = 1
-            session.cmd_output.return_value = "some:value"
+            session.cmd_output.side_effect = cmd_output
             self.assertEqual(True, profile.apply(None))
+            # Backups are written before each modification
             self.check_calls(session.mock_calls,
                              ["set_profile",
-                              "persistent_profile_expected << ", "rc_local",
+                              "persistent_profile_expected",
+                              "persistent_setup/rc_local_was_missing",
+                              "/etc/rc.d/rc.local",
+                              "persistent_setup/tuned_adm_profile",
                               "tuned-adm profile virtual-host",
-                              "persistent_setup/grub_args <<"])
+                              "persistent_setup/grub_args",
+                              "grubby --args",
+                              "set_profile"])
             session.reset_mock()
             # Non-persistent apply, should report (mocked) VMs
-            session.cmd_output.return_value = "rc_local"
-            session.cmd_status.side_effect = [1, 0, 0, 0, 0, 0, 0, 0, 0, 0]
+            state = {"persistent_setup_expected": "rc_local\n"}
+            output[0] = "rc_local"
+            session.cmd_status.return_value = 0
             self.assertEqual([host], profile.apply(None))
-            self.assertIn("persistent_setup_expected", str(session.mock_calls))
-            self.assertIn("persistent_setup_finished", str(session.mock_calls))
-            session.cmd_status.side_effect = None
+            self.check_calls(session.mock_calls,
+                             ["RUNPERF_STATE", "persistent_setup_finished",
+                              "applied_profile"])
             session.reset_mock()
             # Running apply when profile already applied should fail
-            session.cmd_status.return_value = 0
-            session.cmd_output.return_value = "some:value"
+            state = {"set_profile": "TunedLibvirt\n"}
+            output[0] = "some:value"
             self.assertRaises(RuntimeError, profile.apply, None)
             session.reset_mock()
             # get_info should combine default get info and persistent get_info
@@ -260,13 +338,214 @@ class RunPerfTest(Selftest):
                               'guest0_systemctl', 'guest0_runperf_sysinfo',
                               'guest0_params'], info)
             # Revert the profile
-            session.cmd_status.side_effect = (0, 1, 0, 0, 0, 0)
-            session.cmd_output.return_value = "TunedLibvirt"
+            state = {"set_profile": "TunedLibvirt\n",
+                     "persistent_setup/grub_args": "foo=bar\n",
+                     "persistent_setup/tuned_adm_profile": "balanced\n",
+                     "persistent_setup/rc_local": "rc_local\n"}
             profile.revert()
             for cmd in ("set_profile", "grub_args", "tuned_adm_profile",
                         "rc_local", "persistent_setup_finished",
                         "persistent_setup_expected"):
                 self.assertIn(cmd, str(session.mock_calls))
+            self.assertIn('grubby --remove-args="foo=bar"',
+                          str(session.mock_calls))
+            self.assertIn("tuned-adm profile balanced",
+                          str(session.mock_calls))
+
+    def test_persistent_setup(self):
+        runperf_dir = os.path.join(self.tmpdir, "runperf") + os.path.sep
+        os.makedirs(runperf_dir)
+        asset_path = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                  ".assets")
+        args = argparse.Namespace(guest_distro="__test_distro__",
+                                  default_passwords="foo", paths=[asset_path],
+                                  force_params=[])
+        state = {}
+
+        def cmd_output(cmd, *args, **kwargs):
+            del args, kwargs
+            if "RUNPERF_STATE" in cmd:
+                return self.state_output(state)
+            return "rc_local"
+
+        session = mock.Mock()
+        session.cmd_output.side_effect = cmd_output
+        session.cmd.return_value = "some:value"
+        host = Host(mock.Mock(), "selftest", "addr", "__test_distro__",
+                    args)
+        host.get_session = lambda *args, **kwargs: session
+        # Describe the setup without touching the machine
+        extra = {}
+        tuned = profiles.get_persistent_setup("TunedLibvirt", extra, host)
+        self.assertEqual({}, extra)
+        self.assertEqual(["grub_args", "rc_local", "tuned_adm_profile"],
+                         sorted(tuned))
+        self.assertIn("hugepages=22", tuned["grub_args"])
+        self.assertEqual((True, True),
+                         profiles.persistent_setup_reboots(tuned))
+        self.assertEqual(tuned, profiles.get_persistent_setup(
+            "TunedLibvirt", {}, host))
+        self.assertNotEqual(tuned, profiles.get_persistent_setup(
+            "TunedLibvirt", {"irqbalance": 0}, host))
+        self.assertEqual({}, profiles.get_persistent_setup("DefaultLibvirt",
+                                                           {}, host))
+        self.assertEqual({}, profiles.get_persistent_setup("Localhost", {},
+                                                           host))
+        self.assertEqual((False, False), profiles.persistent_setup_reboots(
+            {"tuned_adm_profile": "virtual-host"}))
+        with mock.patch("runperf.profiles.CONFIG_DIR", runperf_dir):
+            # Keep the persistent setup on revert
+            profile = TunedLibvirt(host, [asset_path], {})
+            profile.selftest_root = runperf_dir
+            state = {"set_profile": "TunedLibvirt\n",
+                     "persistent_setup/grub_args": "foo=bar\n",
+                     "persistent_setup_expected": "rc_local\n",
+                     "persistent_setup_fingerprint":
+                     profile._persistent_fingerprint() + "\n"}
+            self.assertFalse(profile.revert(keep_persistent=True))
+            self.assertNotIn("grubby", str(session.mock_calls))
+            self.assertIn("set_profile", str(session.mock_calls))
+            self.assertNotIn("persistent_setup_expected",
+                             str(session.mock_calls))
+            # Matching persistent setup is re-used without reboot
+            session.reset_mock()
+            del state["set_profile"]
+            session.cmd_status.return_value = 0
+            profile = TunedLibvirt(host, [asset_path], {})
+            profile.selftest_root = runperf_dir
+            self.assertEqual([host], profile.apply(None))
+            self.assertNotIn("grubby", str(session.mock_calls))
+            # Different persistent setup is replaced and requires reboot
+            session.reset_mock()
+            state["persistent_setup_fingerprint"] = "other\n"
+            session.cmd_status.return_value = 1
+            profile = TunedLibvirt(host, [asset_path], {})
+            profile.selftest_root = runperf_dir
+            self.assertEqual(True, profile.apply(None))
+            self.assertIn('grubby --remove-args="foo=bar"',
+                          str(session.mock_calls))
+            # The new setup is applied after reboot
+            self.assertNotIn("grubby --args", str(session.mock_calls))
+            # Backups are stored before the system is modified
+            session.reset_mock()
+            state = {}
+            profile._persistent_grub_args(["foo=bar"])
+            cmds = [str(call) for call in session.cmd.mock_calls]
+            backup = [i for i, cmd in enumerate(cmds)
+                      if "persistent_setup/grub_args" in cmd]
+            grubby = [i for i, cmd in enumerate(cmds)
+                      if 'grubby --args="foo=bar"' in cmd]
+            self.assertTrue(backup)
+            self.assertTrue(grubby)
+            self.assertLess(backup[0], grubby[0])
+
+    def test_persistent_setup_switch(self):
+        runperf_dir = os.path.join(self.tmpdir, "runperf") + os.path.sep
+        os.makedirs(runperf_dir)
+        asset_path = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                  ".assets")
+        args = argparse.Namespace(guest_distro="__test_distro__",
+                                  default_passwords="foo", paths=[asset_path],
+                                  force_params=[])
+        state = {}
+        cmdline = ["common=1 foo=bar"]
+
+        def cmd_output(cmd, *args, **kwargs):
+            del args, kwargs
+            if "RUNPERF_STATE" in cmd:
+                return self.state_output(state)
+            if "/proc/cmdline" in cmd:
+                return cmdline[0]
+            return ""
+
+        session = mock.Mock()
+        session.cmd_output.side_effect = cmd_output
+        session.cmd.return_value = "some:value"
+        session.cmd_status.return_value = 0
+        host = Host(mock.Mock(), "selftest", "addr", "__test_distro__",
+                    args)
+        host.get_session = lambda *args, **kwargs: session
+        with mock.patch("runperf.profiles.CONFIG_DIR", runperf_dir):
+            first = TunedLibvirt(host, [asset_path],
+                                 {"grub_args": ["common=1", "foo=bar"]})
+            state = {"persistent_setup/grub_args": "common=1 foo=bar\n",
+                     "persistent_setup_expected": "rc_local\n",
+                     "persistent_setup_fingerprint":
+                     first._persistent_fingerprint() + "\n"}
+            # Previous setup is reverted and reboot requested
+            second = TunedLibvirt(host, [asset_path],
+                                  {"grub_args": ["common=1", "baz=qux"]})
+            self.assertEqual(True, second.apply(None))
+            self.assertIn('grubby --remove-args="common=1 foo=bar"',
+                          str(session.mock_calls))
+            self.assertNotIn("grubby --args", str(session.mock_calls))
+            # After reboot all args (including the reverted ones) are set
+            session.reset_mock()
+            state = {}
+            cmdline[0] = ""
+            host.reboot_request = False
+            second = TunedLibvirt(host, [asset_path],
+                                  {"grub_args": ["common=1", "baz=qux"]})
+            self.assertEqual(True, second.apply(None))
+            grubby = [str(call) for call in session.cmd.mock_calls
+                      if "grubby --args" in str(call)]
+            self.assertEqual(1, len(grubby), session.mock_calls)
+            self.assertIn("common=1", grubby[0])
+            self.assertIn("baz=qux", grubby[0])
+
+    def test_persistent_state(self):
+        session = ShellSession(None, "sh")
+        config_dir = os.path.join(self.tmpdir, "runperf") + os.path.sep
+        with mock.patch("runperf.profiles.CONFIG_DIR", config_dir):
+            state = profiles.PersistentState(lambda: session)
+            self.assertEqual(-1, state.get("foo"))
+            state.set("foo", "bar")
+            state.append("list/items", "a")
+            state.append("list/items", "b")
+            state.set("nested/remove/me", "value")
+            # Nothing written before flush
+            self.assertFalse(os.path.exists(config_dir))
+            state.flush()
+            # Revert-critical entries are written immediately
+            state.set("backup", "orig", flush=True)
+            state.set("bulk", "value")
+            self.assertFalse(os.path.exists(config_dir + "bulk"))
+            state._cache = None
+            self.assertEqual("orig", state.get("backup"))
+            state.remove("backup")
+            state.remove("bulk")
+            state.flush()
+            with open(config_dir + "foo", encoding="utf-8") as fd_foo:
+                self.assertEqual("bar\n", fd_foo.read())
+            with open(config_dir + "list/items", encoding="utf-8") as fd_list:
+                self.assertEqual("a\nb\n", fd_list.read())
+            # Removal of nested keys and persistence after refresh
+            state.remove("nested")
+            state.refresh()
+            self.assertFalse(os.path.exists(config_dir + "nested"))
+            self.assertEqual({"foo": "bar\n", "list/items": "a\nb\n"},
+                             state._load())
+            # Compatibility with the per-file layout
+            os.makedirs(config_dir + "runperf-nbd")
+            with open(config_dir + "runperf-nbd/disk.img", "w",
+                      encoding="utf-8") as fd_img:
+                fd_img.write("ignored")
+            with open(config_dir + "set_profile", "w",
+                      encoding="utf-8") as fd_profile:
+                fd_profile.write("Profile")
+            state.refresh()
+            self.assertEqual("Profile", state.get("set_profile"))
+            self.assertFalse(state.exists("runperf-nbd/disk.img"))
+            # Big files are loaded as well
+            state.set("big", "x" * 2 * 1024 * 1024)
+            state.refresh()
+            self.assertEqual("x" * 2 * 1024 * 1024, state.get("big"))
+            self.assertEqual("Profile", state.get("set_profile"))
+            # No staging leftovers
+            self.assertEqual(["big", "foo", "list", "runperf-nbd",
+                              "set_profile"], sorted(os.listdir(config_dir)))
+        session.close()
+
 
 class DefaultLibvirtTest(Selftest):
     """Check DefaultLibvirt specific handlings"""
@@ -277,6 +556,9 @@ class DefaultLibvirtTest(Selftest):
             self.kwargs = kwargs
         def start(self):
             pass
+        @staticmethod
+        def discover_addrs(guests):
+            return []
         def __str__(self):
             return "%s\n%s" % (self.args, self.kwargs)
         def __repr__(self):
@@ -288,7 +570,7 @@ class DefaultLibvirtTest(Selftest):
         """
         Initialize the profile, deploy vms and check they are as expected
         """
-        def get_session_cont():
+        def get_session_cont(**_):
             session = mock.Mock()
             session.__enter__ = mock.Mock(return_value=mock.Mock())
             session.__exit__ = mock.Mock(return_value=False)
@@ -321,6 +603,18 @@ class DefaultLibvirtTest(Selftest):
         self.check(params, {"force_no_vms": 3, "force_guest_mem": 10}, 3, 5,
                    10, DefaultLibvirtMulti)
 
+    def test_parallel_start(self):
+        barrier = threading.Barrier(4, timeout=10)
+
+        class FakeGuest(self.FakeGuest):
+            """Only proceeds when all guests are starting concurrently"""
+            def start(self):
+                barrier.wait()
+
+        params = {"guest_cpus": 16, "guest_mem_m": 32768}
+        with mock.patch.object(self, "FakeGuest", FakeGuest):
+            self.check(params, {"force_no_vms": 4}, 4, 16, 8192)
+
 
 if __name__ == '__main__':
     unittest.main()
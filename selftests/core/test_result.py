@@ -18,7 +18,11 @@ Tests for the result.py module
 
 # pylint: disable=W0212
 
+import os
 import unittest
+from unittest import mock
+import xml.etree.ElementTree as ET  # nosec
+
 from runperf import result
 
 
@@ -34,3 +38,112 @@ class ResultUtils(unittest.TestCase):
         self.assertEqual(result.get_uncertainty(50), 1)
         self.assertRaises(ValueError, result.get_uncertainty, 0)
         self.assertRaises(ValueError, result.get_uncertainty, -5)
+
+    def test_xunit(self):
+        res = result.RelativeResults(mock.Mock(), 5, 5, [], [], {})
+        res.record_broken("a/b/0000:./c-d/throughput/e.error",
+                          'Bad "<&>" \x01\nthing', True)
+        res.record_result("a/b/0000:./c-d/throughput/e.mean", 10, 20, True)
+        res.record_result("a/b/0000:./c-d/throughput/f.mean", 10, 1, True)
+        res.record_result("a/b/0000:./c-d/throughput/g.mean", 10, 10, True)
+        res.record_result("a/b/0000:./c-d/throughput/h.mean", 10, 1)
+        xunit = res.get_xunit()
+        suite = ET.fromstring(xunit)  # nosec
+        self.assertEqual({"name": "runperf", "tests": "5", "errors": "1",
+                          "failures": "1", "skipped": "1", "time": "0.000"},
+                         {key: value for key, value in suite.attrib.items()
+                          if key != "timestamp"})
+        self.assertEqual(["e.error", "e.mean", "f.mean", "g.mean"],
+                         [_.get("name") for _ in suite])
+        self.assertEqual(['error', 'skipped', 'failure'],
+                         [_[0].tag for _ in suite if len(_)])
+        self.assertIn('Bad "<&>" \\x01', suite[0][0].get("message"))
+        # Empty results
+        res = result.RelativeResults(mock.Mock(), 5, 5, [], [], {})
+        suite = ET.fromstring(res.get_xunit())  # nosec
+        self.assertEqual("0", suite.get("tests"))
+        self.assertEqual(0, len(suite))
+
+    def test_results_filter(self):
+        filt = result.ResultsFilter(["Tuned*", "*/fio/read-*"],
+                                    ["*/*/*/latency", "*/uperf"])
+        self.assertTrue(filt.is_selected())
+        self.assertTrue(filt.is_selected("TunedLibvirt"))
+        self.assertTrue(filt.is_selected("Localhost"))
+        self.assertTrue(filt.is_selected("Localhost", "fio"))
+        self.assertFalse(filt.is_selected("Localhost", "uperf"))
+        self.assertFalse(filt.is_selected("TunedLibvirt", "uperf"))
+        self.assertTrue(filt.is_selected("Localhost", "fio", "read-4KiB"))
+        self.assertFalse(filt.is_selected("Localhost", "fio", "write-4KiB"))
+        self.assertTrue(filt.is_selected("Localhost", "fio", "read-4KiB",
+                                         "throughput"))
+        self.assertFalse(filt.is_selected("Localhost", "fio", "read-4KiB",
+                                          "latency"))
+        self.assertRaises(ValueError, result.ResultsFilter,
+                          ["too/many/parts/in/here"])
+
+    def test_iter_results_filter(self):
+        path = os.path.join(os.path.dirname(__file__), os.path.pardir,
+                            ".assets", "results", "1_base",
+                            "result_20200726_080654")
+        all_tests = [_[0] for _ in result.iter_results(path)]
+        self.assertTrue(any(_.startswith("Localhost2/") for _ in all_tests))
+        filt = result.ResultsFilter(exclude=["Localhost2"])
+        with mock.patch("json.load", wraps=result.json.load) as json_load:
+            tests = [_[0] for _ in result.iter_results(path,
+                                                       results_filter=filt)]
+        self.assertEqual([_ for _ in all_tests
+                          if not _.startswith("Localhost2/")], tests)
+        # Excluded results should not be even opened
+        self.assertEqual(len(list(result.iter_results_jsons(
+            path, results_filter=filt))), json_load.call_count)
+        filt = result.ResultsFilter(["*/*/read-64KiB"])
+        tests = [_[0] for _ in result.iter_results(path, results_filter=filt)]
+        self.assertTrue(tests)
+        self.assertTrue(all("/read-64KiB/" in _ for _ in tests), tests)
+
+    def test_digest_aggregates(self):
+        assets = os.path.join(os.path.dirname(__file__), os.path.pardir,
+                              ".assets", "results")
+        src = os.path.join(assets, "1_base", "result_20200726_080654")
+        references = [os.path.join(assets, "1_base",
+                                   "result_20200726_112748"),
+                      os.path.join(assets, "3_kernel_and_less_cpus",
+                                   "result_20200726_125851")]
+
+        def get_container(digest=False, models=()):
+            modifiers = [result.AveragesModifier(1),
+                         result.NOutOfResultsModifier(1, 1)]
+            return result.ResultsContainer(mock.Mock(), 5, 10, list(models),
+                                           "src", src, modifiers,
+                                           digest=digest), modifiers
+
+        results, modifiers = get_container(True)
+        for i, path in enumerate(references):
+            results.add_result_by_path(str(i), path)
+        # Make sure broken records are part of the results
+        self.assertTrue(any(record.status == result.ERROR
+                            for res in results for record in res.records))
+        digest = results.get_digest()
+        digest_results, digest_modifiers = get_container()
+        digest_results.add_digest(digest)
+        self.assertEqual(dict(modifiers[0].averages),
+                         dict(digest_modifiers[0].averages))
+        self.assertEqual(dict(modifiers[1].failures),
+                         dict(digest_modifiers[1].failures))
+        # Only score/status/primary are kept per each result
+        for res, digest_res in zip(results, digest_results):
+            self.assertEqual(
+                [(_.name, _.score, _.status, _.primary) for _ in res.records],
+                [(_.name, _.score, _.status, _.primary)
+                 for _ in digest_res.records])
+            self.assertTrue(all(_.params is None
+                                for _ in digest_res.records))
+        # Aggregates are only collected when requested
+        self.assertRaises(RuntimeError, digest_results.get_digest)
+        self.assertEqual(None, digest_results.aggregates)
+        # Digest can not be used with different models
+        model = result.ModelLinearRegression(5, 10)
+        model.model = {"foo": {"raw": None, "equation": [1, 0]}}
+        digest_results, _ = get_container(models=[model])
+        self.assertRaises(ValueError, digest_results.add_digest, digest)
@@ -91,12 +91,17 @@ class RunPerfTest(Selftest):
                       "https://foo/192.168.122.5/details,"
                       "https://foo/192.168.122.6/details", metadata)
 
-    def test_full_workflow(self):
+    def _run_full_workflow(self, extra_args=None,
+                           test_names=("DummyTest", "DummyTest")):
         asset_path = os.path.join(os.path.dirname(os.path.dirname(__file__)),
                                   ".assets")
         args = ["run-perf", "--hosts", "addr", "--profiles", "Localhost",
                 "--output", os.path.join(self.tmpdir, "result"),
-                "--paths", asset_path, '--', 'DummyTest', 'DummyTest']
+                "--paths", asset_path]
+        if extra_args:
+            args.extend(extra_args)
+        args.append('--')
+        args.extend(test_names)
         with mock.patch("runperf.profiles.CONFIG_DIR",
                         os.path.join(self.tmpdir, "var/")):
             with mock.patch("sys.argv", args):
@@ -112,6 +117,9 @@ class RunPerfTest(Selftest):
                                 with mock.patch("runperf.tests.BaseTest"
                                                 "._all_machines_kmsg"):
                                     main()
+
+    def test_full_workflow(self):
+        self._run_full_workflow()
         # Check only for test dirs, metadata are checked in other tests
         self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "result")))
         for serial in ["0000", "0001"]:
@@ -123,6 +131,170 @@ class RunPerfTest(Selftest):
                 out = json.load(fd_result)
                 self.assertIn("profile", out)
                 self.assertIn("workers", out)
+        # Check the timeline
+        runperf.utils.CONTEXT.flush()
+        result_path = os.path.join(self.tmpdir, "result")
+        timeline = runperf.TimelinePerf.load_timeline(result_path)
+        phases = [(_["host"], runperf.TimelinePerf.phase_name(_))
+                  for _ in timeline]
+        for exp in [("controller", "setup"), ("addr", "setup"),
+                    ("controller", "apply_profile Localhost"),
+                    ("addr", "apply_profile Localhost"),
+                    ("controller", "test_setup Localhost/DummyTest"),
+                    ("controller", "test_run Localhost/DummyTest"),
+                    ("controller", "test_cleanup Localhost/DummyTest"),
+                    ("addr", "revert_profile Localhost"),
+                    ("addr", "cleanup")]:
+            self.assertIn(exp, phases)
+        self.assertEqual(2, phases.count(("controller",
+                                          "test_run Localhost/DummyTest")))
+        self.assertEqual({"ok"}, set(_["status"] for _ in timeline))
+        html_path = os.path.join(self.tmpdir, "timeline.html")
+        with mock.patch("sys.argv", ["timeline-perf", "--html", html_path,
+                                     f"first:{result_path}",
+                                     f"second:{result_path}"]):
+            with mock.patch("builtins.print") as mock_print:
+                self.assertEqual(0, runperf.TimelinePerf()())
+        out = mock_print.call_args[0][0]
+        self.assertIn("Timeline of first (", out)
+        self.assertIn("Timeline of second (", out)
+        self.assertIn("Phase durations comparison:", out)
+        with open(html_path, encoding="utf-8") as html_fd:
+            html = html_fd.read()
+        self.assertIn("test_run Localhost/DummyTest", html)
+        self.assertIn("Phase durations comparison", html)
+
+    def test_resume(self):
+        result_path = os.path.join(self.tmpdir, "result")
+        self._run_full_workflow()
+        checkpoints = runperf.load_checkpoints(result_path)
+        self.assertEqual([{"profile": "Localhost", "profile_index": 0,
+                           "index": 0, "test": "DummyTest", "extra": {}},
+                          {"profile": "Localhost", "profile_index": 0,
+                           "index": 1, "test": "DummyTest", "extra": {}}],
+                         checkpoints)
+        # Nothing to be done, profile should not be even applied
+        with mock.patch("runperf.machine.Host.apply_profile") as apply:
+            self._run_full_workflow(["--resume"])
+            apply.assert_not_called()
+        self.assertEqual(["0000", "0001"], sorted(
+            os.listdir(os.path.join(result_path, "Localhost", "DummyTest"))))
+        # Remove the second result, only that one should be re-executed
+        shutil.rmtree(os.path.join(result_path, "Localhost", "DummyTest",
+                                   "0001"))
+        with open(os.path.join(result_path, "RUNPERF_METADATA"), "a",
+                  encoding="utf-8") as metadata_fd:
+            metadata_fd.write("\ncustom:value")
+        self._run_full_workflow(["--resume"])
+        self.assertEqual(["0000", "0001"], sorted(
+            os.listdir(os.path.join(result_path, "Localhost", "DummyTest"))))
+        self.assertEqual(2, len(runperf.load_checkpoints(result_path)))
+        with open(os.path.join(result_path, "RUNPERF_METADATA"),
+                  encoding="utf-8") as metadata_fd:
+            self.assertIn("\ncustom:value", metadata_fd.read())
+        # Without --resume the results are removed
+        self._run_full_workflow()
+        self.assertEqual(2, len(runperf.load_checkpoints(result_path)))
+
+    def test_resume_repeated_profile(self):
+        result_path = os.path.join(self.tmpdir, "result")
+        profiles = ["--profiles", "Localhost",
+                    'Localhost:{"__NAME__": "Local2"}']
+        self._run_full_workflow(profiles, ["DummyTest"])
+        self.assertEqual([(0, 0), (1, 0)], [
+            (_["profile_index"], _["index"])
+            for _ in runperf.load_checkpoints(result_path)])
+        # Only results of the second profile are missing
+        shutil.rmtree(os.path.join(result_path, "Local2"))
+        self._run_full_workflow(profiles + ["--resume"], ["DummyTest"])
+        for name in ("Localhost", "Local2"):
+            self.assertEqual(["0000"], os.listdir(
+                os.path.join(result_path, name, "DummyTest")))
+        self.assertEqual(2, len(runperf.load_checkpoints(result_path)))
+
+    def test_time_budget(self):
+        result_path = os.path.join(self.tmpdir, "result")
+        history_path = os.path.join(self.tmpdir, "durations.json")
+        durations = runperf.history.DurationHistory(history_path)
+        durations.record("addr", "Localhost", "DummyTest", None, 10000)
+        durations.save()
+        self._run_full_workflow(["--time-budget", "1h", "--duration-history",
+                                 history_path],
+                                ["DummyTest", 'DummyTest:{"__OPTIONAL__": 1}',
+                                 'DummyTest:{"__OPTIONAL__": "no"}'])
+        # The optional test does not fit into the budget
+        self.assertEqual([0, 2], [_["index"] for _ in
+                                  runperf.load_checkpoints(result_path)])
+        # Durations were updated by this execution
+        durations = runperf.history.DurationHistory(history_path)
+        self.assertLess(durations.estimate("addr", "Localhost", "DummyTest"),
+                        10000)
+        for name in (runperf.history.SETUP, runperf.history.PROFILE):
+            self.assertNotEqual(None, durations.estimate(
+                "addr", "Localhost" if name != runperf.history.SETUP else "",
+                name))
+
+    def test_schedule_profiles(self):
+        durations = runperf.history.DurationHistory()
+        for name, duration in (("a", 30), ("b", 10), ("c", 20)):
+            durations.record("host", "prof", name, None, duration)
+
+        def test_defs():
+            return [(mock.Mock(name=name), {}, {"index": i}, False)
+                    for i, name in enumerate(("a", "unknown", "b", "c"))]
+
+        for order, exp in (("given", ["a", "unknown", "b", "c"]),
+                           ("shortest", ["b", "c", "a", "unknown"]),
+                           ("longest", ["unknown", "a", "c", "b"])):
+            pending = [("prof", {}, test_defs())]
+            for test, _, _, _ in pending[0][2]:
+                test.name = test._mock_name
+            schedule = runperf.history.Schedule(durations, "host")
+            plan = [runperf.machine.ProfilePlan(0, "prof", {}, [{}], False)]
+            runperf.schedule_profiles(plan, pending, schedule, order)
+            self.assertEqual(exp, [_[0].name for _ in pending[0][2]])
+            self.assertEqual((60, 3), schedule.remaining())
+
+    def test_dry_run(self):
+        asset_path = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                  ".assets")
+        result_path = os.path.join(self.tmpdir, "result")
+        args = ["run-perf", "--hosts", "addr", "--profiles", "TunedLibvirt",
+                "Localhost", "TunedLibvirt:{\"__NAME__\": \"Tuned2\"}",
+                "--output", result_path, "--paths", asset_path,
+                "--dry-run", "--plan-profiles", "--", "DummyTest"]
+        with mock.patch("sys.argv", args):
+            with mock.patch("builtins.print") as mock_print:
+                self.assertEqual(0, main())
+        self.assertFalse(os.path.exists(result_path))
+        out = mock_print.call_args[0][0]
+        self.assertRegex(out, r"\n0 +TunedLibvirt +grub_args,rc_local,"
+                         r"tuned_adm_profile +keep persistent\n1 +TunedLibvirt "
+                         r"+grub_args,rc_local,tuned_adm_profile +full\n"
+                         r"2 +Localhost +- +full\n")
+        self.assertIn("Estimated number of reboots: 2", out)
+
+    def test_timeline_render_text(self):
+        def rec(phase, host, start, end, status="ok", **details):
+            return dict(phase=phase, host=host, start=start, end=end,
+                        status=status, **details)
+        src = [rec("setup", "controller", 100, 110),
+               rec("apply_profile", "host1", 110, 130, profile="Localhost"),
+               rec("reboot", "host1", 115, 125, reason="apply_profile",
+                   profile="Localhost"),
+               rec("apply_profile", "host1", 125, 130, profile="Localhost",
+                   attempt=1)]
+        dst = [rec("setup", "controller", 0, 20, status="error")]
+        out = runperf.TimelinePerf.render_text([("src", src), ("dst", dst)],
+                                               10)
+        self.assertIn("Timeline of src (30.0s):", out)
+        self.assertIn("|###       |", out)
+        self.assertIn("|   #######|", out)
+        self.assertIn("reboot Localhost (apply_profile)", out)
+        self.assertIn("apply_profile Localhost #1", out)
+        self.assertIn("|!!!!!!!!!!|", out)
+        self.assertRegex(out, r"\ncontroller +setup +10\.0 +20\.0 +\+100\.0%")
+        self.assertRegex(out, r"\nhost1 +apply_profile Localhost +25\.0 +- *\n")
 
     def test_create_metadata(self):
         args = argparse.Namespace(metadata=[], distro=None, guest_distro=None,
@@ -69,7 +69,8 @@ class PBenchTest(Selftest):
                            guest_distro or distro, args)
         worker.mock_session = mock.Mock(
             **{'cmd_status.return_value': 0,
-               'cmd.return_value': ""})
+               'cmd.return_value': "",
+               'cmd_output.return_value': ""})
         test = klass(host, [[worker]], self.tmpdir, metadata, extra)
         with tempfile.NamedTemporaryFile(delete=True) as local_json_fd:
             shutil.copy(os.path.join(asset_path, "tests",
@@ -131,11 +132,15 @@ class PBenchTest(Selftest):
         self.assertEqual(tst.pbench_tools, ["extra", "set"])
 
     def test_uperf(self):
-        self.check(tests.UPerf, {}, {}, 'PERL5LIB=/opt/pbench-agent/tool-'
-                   'scripts/postprocess/:/opt/pbench-agent/bench-scripts/'
-                   'postprocess/ pbench-uperf  --message-sizes=1,64,16384 '
-                   '--protocols=tcp --runtime=60 --samples=3 '
-                   '--test-types=stream --clients=addr2 --servers addr2')
+        tst = self.check(tests.UPerf, {}, {}, 'PERL5LIB=/opt/pbench-agent/'
+                         'tool-scripts/postprocess/:/opt/pbench-agent/bench-'
+                         'scripts/postprocess/ pbench-uperf  --message-sizes='
+                         '1,64,16384 --protocols=tcp --runtime=60 --samples=3 '
+                         '--test-types=stream --clients=addr2 --servers addr2')
+        # Runtime enables watchdog which streams the output into a file
+        with open(os.path.join(tst.output, "watchdog_output.log"),
+                  encoding="utf-8") as fd_output:
+            self.assertEqual("PROMPT", fd_output.read())
 
     def test_linpack(self):
         with mock.patch("runperf.tests.utils.shell_find_command",
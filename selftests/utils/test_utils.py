@@ -15,11 +15,17 @@
 
 import os
 import re
+import subprocess
 import tempfile
+import threading
+import time
 from unittest import mock
 import unittest
 
-from runperf import utils
+import aexpect
+
+from runperf import exceptions, utils, TracePerf
+from runperf.utils import cloud_image_providers, history, image_cache
 import shutil
 import contextlib
 
@@ -94,6 +100,13 @@ class BasicUtils(unittest.TestCase):
         with mock.patch("time.time", mock.Mock(side_effect=[0, 0, 1])):
             ret = utils.wait_for(lambda: False, 1)
             self.assertEqual(None, ret)
+        with mock.patch("time.time", mock.Mock(side_effect=[0, 0, 0, 0,
+                                                            1])):
+            with mock.patch("time.sleep") as sleep:
+                ret = utils.wait_for(lambda: False, 1, backoff=2, max_step=3)
+            self.assertEqual(None, ret)
+            self.assertEqual([mock.call(1.0), mock.call(2.0), mock.call(3)],
+                             sleep.call_args_list)
 
     def test_tabular_output(self):
         self.assertEqual("", utils.tabular_output([]))
@@ -129,6 +142,56 @@ class BasicUtils(unittest.TestCase):
         self.assertNotEqual(match, None)
         self.assertEqual(match[1], match[2])
 
+    def test_shell_write_content_bulk_cmd(self):
+        swcbc = utils.shell_write_content_bulk_cmd
+        content = "".join(chr(i % 0x3000 + 32) for i in range(20000))
+        cmd = swcbc("/path/to/file", content)
+        self.assertLess(max(len(line) for line in cmd.splitlines()), 4096)
+        with tempfile.TemporaryDirectory(prefix="runperf-") as tmpdir:
+            path = os.path.join(tmpdir, "it's a file")
+            subprocess.run(["bash", "-c", swcbc(path, content)], check=True)
+            subprocess.run(["bash", "-c", swcbc(path, "appended", True)],
+                           check=True)
+            with open(path, encoding="utf-8") as fd_content:
+                self.assertEqual(content + "\nappended\n", fd_content.read())
+            # Checksum mismatch must not touch the file
+            cmd = re.sub("= '[0-9a-f]+", "= 'deadbeef", swcbc(path, "bad"))
+            self.assertNotEqual(0, subprocess.run(["bash", "-c", cmd],
+                                                  check=False).returncode)
+            with open(path, encoding="utf-8") as fd_content:
+                self.assertEqual(content + "\nappended\n", fd_content.read())
+
+    def test_batch_cmd_status_output(self):
+        cmds = ["echo hello; echo err >&2", "false", "printf 'no newline'",
+                "cat", "exit 3", "printf '\\xc5\\x99\\n' # comment"]
+        session = mock.Mock()
+        session.cmd_output.side_effect = lambda cmd, **_: subprocess.run(
+            ["bash", "-c", cmd], capture_output=True, text=True,
+            check=True).stdout
+        self.assertEqual([(0, "hello\nerr\n"), (1, ""), (0, "no newline"),
+                          (0, ""), (3, ""), (0, "\u0159\n")],
+                         utils.batch_cmd_status_output(session, cmds))
+        self.assertEqual(1, session.cmd_output.call_count)
+        self.assertEqual([], utils.batch_cmd_status_output(session, []))
+        # Missing/corrupted sections
+        session.cmd_output.side_effect = None
+        session.cmd_output.return_value = ("RUNPERF_BATCH:0:0:4\nT1VU\n"
+                                           "RUNPERF_BATCH:1:0:8\nT1VU\n")
+        self.assertRaises(ValueError, utils.batch_cmd_status_output,
+                          session, ["foo", "bar", "baz"])
+        self.assertEqual([(0, "OUT"), (None, ""), (None, "")],
+                         utils.batch_cmd_status_output(
+                             session, ["foo", "bar", "baz"],
+                             ignore_all_errors=True))
+        # Per-command timeout
+        session.cmd_output.side_effect = lambda cmd, **_: subprocess.run(
+            ["bash", "-c", cmd], capture_output=True, text=True,
+            check=True).stdout
+        self.assertEqual([(124, ""), (0, "ok\n")],
+                         utils.batch_cmd_status_output(
+                             session, ["sleep 10; echo late", "echo ok"],
+                             cmd_timeout=1))
+
     def test_shell_dnf_install_cmd(self):
         self.assertEqual("dnf install -y --nobest --skip-broken foo 'b a r'",
                          utils.shell_dnf_install_cmd(["foo", "b a r"]))
@@ -162,6 +225,100 @@ class BasicUtils(unittest.TestCase):
         with mock.patch("runperf.utils.entry_points", entries):
             self.assertRaises(KeyError, utils.named_entry_point, "", "missing")
 
+    def test_wait_for_machines_calm_down(self):
+        machines = []
+        for i, status in enumerate((0, 1, 0)):
+            machine = mock.MagicMock()
+            machine.name = f"machine{i}"
+            session = machine.get_session_cont.return_value.__enter__
+            session.return_value.cmd_status.return_value = status
+            machines.append(machine)
+        hop = mock.Mock()
+        settle_times = utils.wait_for_machines_calm_down(machines, 10, hop)
+        self.assertEqual(["machine0", "machine1", "machine2"],
+                         sorted(settle_times))
+        self.assertIsNone(settle_times["machine1"])
+        self.assertLess(settle_times["machine0"], 10)
+        self.assertLess(settle_times["machine2"], 10)
+        machines[1].log.warning.assert_called_once()
+        for machine in machines:
+            machine.get_session_cont.assert_called_once_with(hop=hop,
+                                                           reuse=True)
+        machines[2].get_session_cont.side_effect = RuntimeError("no session")
+        self.assertRaises(RuntimeError, utils.wait_for_machines_calm_down,
+                          machines, 10)
+
+    def test_fan_out(self):
+        def func(machine, add, mul=1):
+            if machine == "fail":
+                raise ValueError(machine)
+            if machine == "nested":
+                return utils.fan_out(range(3), func, (add,), {"mul": mul})
+            return (machine + add) * mul
+
+        self.assertEqual([2, 4, 6], utils.fan_out([0, 1, 2], func, (1,),
+                                                  {"mul": 2}))
+        self.assertEqual([], utils.fan_out([], func, (1,)))
+        self.assertEqual([1, [1, 2, 3]], utils.fan_out([0, "nested"], func,
+                                                       (1,)))
+        with self.assertRaises(exceptions.FanOutError) as exc:
+            utils.fan_out([0, "fail", 2], func, (1,))
+        self.assertEqual([1, None, 3], exc.exception.results)
+        self.assertEqual(["fail"], list(exc.exception.errors))
+        self.assertIsInstance(exc.exception.errors["fail"], ValueError)
+        self.assertIn("fail: ValueError('fail')", str(exc.exception))
+        event = threading.Event()
+        threads = []
+
+        def wait(timeout):
+            threads.append(threading.current_thread().name)
+            return event.wait(timeout) or 1
+
+        with self.assertRaises(exceptions.FanOutError) as exc:
+            utils.fan_out([0.1, 5], wait, timeout=1)
+        # Unfinished tasks must not occupy the shared pool
+        self.assertTrue(all(_.startswith("fan-out-dedicated")
+                            for _ in threads), threads)
+        event.set()
+        self.assertEqual([1, None], exc.exception.results)
+        self.assertIsInstance(exc.exception.errors[5], TimeoutError)
+
+    def test_fan_out_cmd(self):
+        machines = []
+        for i in range(3):
+            machine = mock.MagicMock()
+            session = machine.get_session_cont.return_value.__enter__
+            session.return_value.cmd_status_output.return_value = (i, str(i))
+            machines.append(machine)
+        hop = mock.Mock()
+        self.assertEqual([(0, "0"), (1, "1"), (2, "2")],
+                         utils.fan_out_cmd(machines, "true", 10, hop))
+        for machine in machines:
+            machine.get_session_cont.assert_called_once_with(hop=hop)
+            session = machine.get_session_cont.return_value.__enter__
+            session.return_value.cmd_status_output.assert_called_once_with(
+                "true", timeout=10)
+
+    def test_output_tail(self):
+        with tempfile.TemporaryDirectory(prefix="runperf-") as tmpdir:
+            path = os.path.join(tmpdir, "output.log")
+            with utils.OutputTail(path, 3) as tail:
+                tail.feed("first\nsec")
+                self.assertEqual("sec", tail.last_nonempty_line())
+                tail.feed("ond\n\n  \n")
+                self.assertEqual("second", tail.last_nonempty_line())
+                tail.feed("third\r\nPROMPT# ")
+                self.assertEqual("PROMPT# ", tail.last_nonempty_line())
+                self.assertEqual(f"(full output: {path})\n...\n\n  \n"
+                                 "third\r\nPROMPT# ", tail.get_tail())
+            with open(path, encoding="utf-8", newline="") as fd_output:
+                self.assertEqual("first\nsecond\n\n  \nthird\r\nPROMPT# ",
+                                 fd_output.read())
+        tail = utils.OutputTail()
+        tail.feed("foo\nbar")
+        self.assertEqual("foo\nbar", tail.get_tail())
+        tail.close()
+
     def test_human_to_bool(self):
         self.assertTrue(utils.human_to_bool("Yes"))
         self.assertTrue(utils.human_to_bool("true     \n"))
@@ -185,7 +342,7 @@ class Machine:
         shutil.copytree(src, dst)
 
     @contextlib.contextmanager
-    def get_session_cont(self):
+    def get_session_cont(self, **_):
         for session in self.sessions:
             yield session
 
@@ -226,6 +383,246 @@ class PathTracker(unittest.TestCase):
         tracker.set_level(1)
         self.assertEqual(join(self.tmpdir, "__NOT_SET__"), tracker.get())
 
+    def test_store(self):
+        tracker = utils.ContextManager(mock.Mock())
+        self.assertTrue(tracker.flush())
+        tracker.set_root(self.tmpdir)
+        tracker.max_open_files = 2
+
+        def store(i):
+            for j in range(100):
+                tracker.store(f"__sessions__/session{i % 3}", f"{i}:{j}\n")
+
+        threads = [threading.Thread(target=store, args=(i,))
+                   for i in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Path change flushes the content
+        tracker.set(0, "foo")
+        tracker.store("file", "content")
+        self.assertTrue(tracker.flush())
+        for i in range(3):
+            with open(os.path.join(self.tmpdir, "__sessions__",
+                                   f"session{i}"),
+                      encoding="utf-8") as fd_session:
+                lines = fd_session.read().splitlines()
+            self.assertEqual(200, len(lines))
+            for thread in (i, i + 3):
+                self.assertEqual([f"{thread}:{j}" for j in range(100)],
+                                 [_ for _ in lines
+                                  if _.startswith(f"{thread}:")])
+        with open(os.path.join(self.tmpdir, "foo", "file"),
+                  encoding="utf-8") as fd_file:
+            self.assertEqual("content", fd_file.read())
+
+    def test_trace(self):
+        tracker = utils.ContextManager(mock.Mock())
+        # No root, nothing to record
+        with tracker.trace("cmd", "machine", "true"):
+            pass
+        tracker.set_root(self.tmpdir)
+        tracker.set(0, "profile")
+        tracker.set(1, "test")
+        with tracker.trace("copy_to", "machine", "src -> dst"):
+            with tracker.trace("check_output", "controller",
+                               ["rsync", "a b"]):
+                pass
+        with self.assertRaises(ValueError):
+            with tracker.trace("cmd", "machine", "x" * 1000):
+                raise ValueError("failure")
+        tracker.set_level(1)
+        with tracker.trace("check_output", "controller", ["echo", "a b"]):
+            pass
+        self.assertTrue(tracker.flush())
+        records = TracePerf.load_trace(self.tmpdir)
+        self.assertEqual([("copy_to", "machine", "profile/test", "ok",
+                           "src -> dst"),
+                          ("cmd", "machine", "profile/test", "error",
+                           "x" * utils.TRACE_CMD_LENGTH),
+                          ("check_output", "controller", "profile", "ok",
+                           "echo 'a b'")],
+                         [(_["kind"], _["machine"], _["stage"], _["status"],
+                           _["cmd"]) for _ in records])
+        summary = TracePerf.summarize(records, 2)
+        self.assertIn("Top 2 slowest operations:", summary)
+        self.assertIn("Per-stage totals:", summary)
+        self.assertRegex(summary, r"\nprofile/test +2 ")
+        self.assertRegex(summary, r"\nprofile +1 ")
+
+    def tearDown(self):
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir)
+
+
+class History(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="runperf-selftest")
+
+    def test_parse_duration(self):
+        self.assertEqual(3600, history.parse_duration("3600"))
+        self.assertEqual(5400, history.parse_duration("90m"))
+        self.assertEqual(5400, history.parse_duration(" 1.5H"))
+        self.assertEqual(86400, history.parse_duration("1d"))
+        self.assertRaises(ValueError, history.parse_duration, "1 hour")
+        self.assertEqual("1:30:05", history.format_duration(5405.2))
+
+    def test_duration_history(self):
+        path = os.path.join(self.tmpdir, "dir", "durations.json")
+        durations = history.DurationHistory(path)
+        self.assertEqual(None, durations.estimate("host", "prof", "test"))
+        for duration in range(15):
+            durations.record("host", "prof", "test", {"a": 1}, duration)
+        durations.record("host", "prof", "test", None, 1)
+        durations.save()
+        durations = history.DurationHistory(path)
+        # Only the last 10 samples are kept
+        self.assertEqual(9.5, durations.estimate("host", "prof", "test",
+                                                 {"a": 1}))
+        self.assertEqual(1, durations.estimate("host", "prof", "test"))
+        self.assertEqual(-1, durations.estimate("host2", "prof", "test",
+                                                default=-1))
+        with open(path, "w", encoding="utf-8") as history_fd:
+            history_fd.write("corrupted")
+        self.assertEqual(None, history.DurationHistory(path).estimate(
+            "host", "prof", "test"))
+        self.assertEqual("prof", history.profile_key(
+            "prof", {"RUNPERF_TESTS": ["fio"]}))
+        self.assertEqual('prof:{"a": 1}', history.profile_key("prof",
+                                                              {"a": 1}))
+
+    def test_schedule(self):
+        durations = history.DurationHistory()
+        durations.record("host", "prof", "long", None, 100)
+        durations.record("host", "prof", "short", None, 10)
+        schedule = history.Schedule(durations, "host", 60)
+        self.assertEqual(100, schedule.add(1, "prof", "long", None, True))
+        self.assertEqual(10, schedule.add(2, "prof", "short"))
+        self.assertEqual(None, schedule.add(3, "prof", "unknown", None,
+                                            True))
+        self.assertEqual((110, 1), schedule.remaining())
+        self.assertEqual((10, 0), schedule.remaining(False))
+        self.assertIn("remaining 0:01:50, 1 items without history",
+                      schedule.eta())
+        self.assertFalse(schedule.fits(1))
+        self.assertTrue(schedule.fits(2))
+        # Unknown optional items are expected to be as long as the longest
+        self.assertFalse(schedule.fits(3))
+        schedule.budget = 120
+        self.assertTrue(schedule.fits(3))
+        schedule.budget = 60
+        schedule.done(1)
+        schedule.done(2, "prof", "short", None, 20)
+        self.assertEqual(15, durations.estimate("host", "prof", "short"))
+        self.assertEqual((0, 1), schedule.remaining())
+        self.assertTrue(history.Schedule(durations, "host").fits(1))
+        # Without any comparable history only while most budget is available
+        schedule = history.Schedule(durations, "host", 60)
+        schedule.add(1, "prof", "unknown", None, True)
+        self.assertTrue(schedule.fits(1))
+        schedule.add(2, "prof", "unknown2")
+        self.assertTrue(schedule.fits(1))
+        schedule.start -= 40
+        self.assertFalse(schedule.fits(1))
+        self.assertTrue(schedule.fits(2))
+
+    def tearDown(self):
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir)
+
+
+class ImageCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="runperf-selftest")
+
+    def test_download(self):
+        src = os.path.join(self.tmpdir, "src.qcow2")
+        with open(src, "w", encoding="utf-8") as src_fd:
+            src_fd.write("image")
+        digest = image_cache.file_digest(src)
+        cache_dir = os.path.join(self.tmpdir, "cache")
+        cache = image_cache.ImageCache(cache_dir)
+        path, act = cache.download(f"file://{src}")
+        self.assertEqual(digest, act)
+        self.assertEqual(os.path.join(cache_dir, "objects", digest), path)
+        # Reused across runs (without downloading)
+        os.unlink(src)
+        cache = image_cache.ImageCache(cache_dir)
+        self.assertEqual((path, digest), cache.download(f"file://{src}"))
+        self.assertRaises(OSError, cache.download, f"file://{src}.missing")
+        # Corrupted objects are removed
+        with open(path, "w", encoding="utf-8") as obj_fd:
+            obj_fd.write("corrupted")
+        self.assertFalse(cache.verify(digest))
+        self.assertEqual(None, cache.lookup(f"download:file://{src}"))
+        self.assertRaises(ValueError, image_cache.ImageCache, cache_dir,
+                          "unknown")
+
+    def test_get_once(self):
+        def create(staging):
+            with lock:
+                calls.append(staging)
+            time.sleep(0.1)
+            path = os.path.join(staging, "image")
+            with open(path, "w", encoding="utf-8") as image_fd:
+                image_fd.write("prepared")
+            return path
+
+        calls = []
+        lock = threading.Lock()
+        cache = image_cache.ImageCache(self.tmpdir, "prepare")
+        results = utils.fan_out(range(4), lambda _: cache.get("key", create))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, len(set(results)))
+        self.assertEqual({"miss": 1, "hit": 3}, cache.stats)
+        self.assertEqual(["index.json", "objects"],
+                         sorted(os.listdir(self.tmpdir)))
+
+    def test_provider(self):
+        class Provider(cloud_image_providers.BaseProvider):
+            def get_url(self):
+                return f"file://{src}"
+
+            def _extend_cloudinit_cmd(self, cmd):
+                return cmd
+
+        src = os.path.join(self.tmpdir, "src.qcow2")
+        with open(src, "w", encoding="utf-8") as src_fd:
+            src_fd.write("image")
+        digest = image_cache.file_digest(src)
+        cache = image_cache.ImageCache(os.path.join(self.tmpdir, "cache"))
+        machines = [mock.Mock(), mock.Mock()]
+        sessions = [mock.Mock(), mock.Mock()]
+        for session in sessions:
+            session.cmd_output.return_value = f"{digest}  /dst\n"
+        for machine, session in zip(machines, sessions):
+            provider = Provider("Distro", "arch", "KEY", "/base", session,
+                                None, machine=machine, image_cache=cache)
+            self.assertEqual("", provider.prepare("password"))
+            machine.copy_to.assert_called_once_with(
+                cache.object_path(digest), provider.image)
+            cmds = "\n".join(_[1][0] for _ in session.cmd.mock_calls)
+            self.assertNotIn("curl", cmds)
+            self.assertIn("virt-customize", cmds)
+        # Checksum mismatch
+        sessions[0].cmd_output.return_value = "corrupted  /dst\n"
+        self.assertIn("does not match", Provider(
+            "Distro", "arch", "KEY", "/base", sessions[0], None,
+            machine=machines[0], image_cache=cache).prepare("password"))
+
+    def test_distribute(self):
+        machine = mock.Mock()
+        session = mock.Mock()
+        session.cmd_output.return_value = "abcd  /dst\n"
+        self.assertEqual(None, image_cache.ImageCache.distribute(
+            machine, session, "/src", "abcd", "/dst"))
+        machine.copy_to.assert_called_once_with("/src", "/dst")
+        self.assertIn("does not match", image_cache.ImageCache.distribute(
+            machine, session, "/src", "dcba", "/dst"))
+
     def tearDown(self):
         if self.tmpdir:
             shutil.rmtree(self.tmpdir)
@@ -249,7 +646,7 @@ class LogFetcher(unittest.TestCase):
             fd_tmp.write('LAST')
         fetcher.paths.add(os.path.join(self.tmpdir, 'TO'))
         session = mock.Mock()
-        session.cmd_output.return_value = 'OUTPUT'
+        session.cmd_output.return_value = 'RUNPERF_BATCH:0:0:8\nT1VUUFVU\n'
         machine = Machine('vm1', [session])
         fetcher.collect(self.tmpdir, machine)
         prefix = os.path.join(self.tmpdir, 'vm1') + '/'
@@ -263,6 +660,29 @@ class LogFetcher(unittest.TestCase):
                   '--since=@%(since)s') as fd_tmp:
             self.assertEqual('OUTPUT', fd_tmp.read())
 
+    def test_cmds_fallback(self):
+        fetcher = utils.LogFetcher(cmds=["first", "bad %(missing)s",
+                                         "second"])
+
+        def cmd_output(cmd, **_):
+            if "RUNPERF_BATCH" in cmd:
+                self.assertIn("timeout -k 5 60 sh -c", cmd)
+                raise aexpect.ShellTimeoutError(cmd, "")
+            if cmd == "second":
+                raise aexpect.ShellTimeoutError(cmd, "")
+            return "FIRST"
+
+        session = mock.Mock()
+        session.cmd_output.side_effect = cmd_output
+        fetcher.collect(self.tmpdir, Machine('vm1', [session]))
+        # Batch failure falls back to per-command collection, invalid
+        # commands are skipped
+        self.assertEqual(3, session.cmd_output.call_count)
+        path = os.path.join(self.tmpdir, 'vm1', 'COMMANDS')
+        self.assertEqual(["first"], os.listdir(path))
+        with open(os.path.join(path, "first"), encoding="utf-8") as fd_out:
+            self.assertEqual("FIRST", fd_out.read())
+
     def test_fail_to_get_session(self):
         fetcher = utils.LogFetcher()
         fetcher.paths.add('/foo/bar/baz')